@@ -2,7 +2,7 @@ import io
 import statevector
 import expvalues
 import initialconditions
-from io import load_cppqed, load_statevector, save_statevector, split_cppqed
+from io import load_cppqed, iter_cppqed, load_statevector, save_statevector, split_cppqed
 from initialconditions import gaussian
-from statevector import StateVector
-
+from statevector import StateVector, ProductOperator, ProductStateVector
+from sparsestatevector import SparseStateVector
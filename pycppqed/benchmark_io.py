@@ -0,0 +1,215 @@
+"""
+Benchmarks for reading and writing C++QED files.
+
+Run all benchmarks with::
+
+    $ python -m pycppqed.benchmark_io
+"""
+import os
+import time
+import tempfile
+import numpy
+import bz2
+import io
+import statevector
+import parallelbz2
+import compression
+
+
+def _timeit(func, *args, **kwargs):
+    """
+    Return the result of the given function and the time it took in seconds.
+    """
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - t0
+
+def _write_trajectory(path, nrows, ncols=14):
+    """
+    Write a C++QED like output file with nrows expectation value rows.
+    """
+    f = open(path, "w")
+    f.write("# Benchmark trajectory\n\n")
+    data = numpy.random.rand(1000, ncols-2)
+    for start in range(0, nrows, 1000):
+        for i in range(min(1000, nrows-start)):
+            row = data[i]
+            f.write("%-12r %-12r \t%s\n" % (float(start+i), 1e-3,
+                    "\t".join(["%-10.6g" % x for x in row])))
+    f.close()
+
+def benchmark_evrows(nrows=10**6):
+    """
+    Compare the line by line expectation value parser with the bulk parser.
+    """
+    fd, path = tempfile.mkstemp(prefix="pycppqed_bench_")
+    os.close(fd)
+    try:
+        _write_trajectory(path, nrows)
+        f = open(path)
+        rows = [line for line in f if not line.startswith("#") and line.strip()]
+        f.close()
+        old, t_old = _timeit(lambda: numpy.array(
+                [io._parse_evrow(row) for row in rows]).swapaxes(0,1))
+        new, t_new = _timeit(io._parse_evrows, rows)
+        assert (old == new).all()
+        print "Parsing %i expectation value rows:" % nrows
+        print "    line by line: %.2fs" % t_old
+        print "    bulk:         %.2fs (%.1fx faster)" % (t_new, t_old/t_new)
+        _, t_load = _timeit(io.load_cppqed, path)
+        print "    load_cppqed:  %.2fs" % t_load
+    finally:
+        os.remove(path)
+
+def benchmark_columns(nrows=10**6, columns=(0, 3, 5)):
+    """
+    Compare loading all expectation value columns with loading only a few,
+    like :func:`teazertools.mean.calculateMeans` does.
+    """
+    fd, path = tempfile.mkstemp(prefix="pycppqed_bench_")
+    os.close(fd)
+    try:
+        _write_trajectory(path, nrows)
+        full, t_full = _timeit(io.load_cppqed, path)
+        part, t_part = _timeit(io.load_cppqed, path, columns=columns,
+                               statevectors=False)
+        assert (numpy.asarray(full[0])[list(columns)] == part[0]).all()
+        print "Loading %i expectation value rows:" % nrows
+        print "    all columns:  %.2fs" % t_full
+        print "    %i columns:    %.2fs (%.1fx faster)" % (len(columns),
+                                                          t_part,
+                                                          t_full/t_part)
+    finally:
+        os.remove(path)
+
+def benchmark_skip(nrows=10**4, svsize=10**4, every=100):
+    """
+    Compare skipping the state vectors of a trajectory line by line with
+    skipping them at the byte level.
+    """
+    def skip_lines(f):
+        # Collect the lines of every block like the scanner did before.
+        rows = 0
+        block = None
+        for line in f:
+            if block is not None:
+                block.append(line)
+                if line.endswith(" ]\n"):
+                    "".join(block)
+                    block = None
+            elif line.startswith("("):
+                block = [line]
+            elif line.strip() and not line.startswith("#"):
+                rows += 1
+        f.close()
+        return rows
+    def skip_blocks(f):
+        rows = sum(1 for kind, data in io._scan_cppqed(f, ("sv", "basis"))
+                   if kind == "ev")
+        f.close()
+        return rows
+    fd, path = tempfile.mkstemp(prefix="pycppqed_bench_")
+    os.close(fd)
+    try:
+        _write_trajectory(path, nrows)
+        sv = numpy.random.rand(svsize/10, 10) + 1j*numpy.random.rand(svsize/10, 10)
+        f = open(path)
+        lines = f.readlines()
+        f.close()
+        f = open(path, "w")
+        for i, line in enumerate(lines):
+            f.write(line)
+            if i > 2 and i % every == 0:
+                io._write_blitz(f, sv)
+        f.close()
+        size = os.path.getsize(path)
+        compression.codecs["gz"].compress_file(path)
+        print "Skipping the state vectors of a %.1f MB trajectory:" % (size/1e6)
+        for p in (path + ".gz", compression.codecs["gz"].decompress_file(
+                                                            path + ".gz")):
+            n_old, t_old = _timeit(skip_lines, compression.open(p))
+            n_new, t_new = _timeit(skip_blocks, compression.open(p))
+            assert n_old == n_new == nrows
+            print "    %s:" % ("gzip" if p.endswith(".gz") else "plain")
+            print "        line by line: %.2fs" % t_old
+            print "        byte level:   %.2fs (%.1fx faster)" % (t_new,
+                                                                t_old/t_new)
+    finally:
+        for p in (path, path + ".gz"):
+            if os.path.exists(p):
+                os.remove(p)
+
+def benchmark_save_statevector(size=10**6):
+    """
+    Compare the old recursive blitz formatter with the chunked writer.
+    """
+    def numpy2blitz(array):
+        # The formatter that was used before the chunked writer.
+        datastr = " \n  ".join([" ".join(["(%s,%s)" % (n.real, n.imag)
+                                           for n in row])
+                                 for row in array.reshape((-1, array.shape[-1]))])
+        dims = " x ".join(["(0,%s)" % (d-1) for d in array.shape])
+        return "%s \n[ %s ]\n\n" % (dims, datastr)
+    sv = statevector.StateVector(numpy.random.rand(size)
+                                 + 1j*numpy.random.rand(size))
+    fd, path = tempfile.mkstemp(prefix="pycppqed_bench_")
+    os.close(fd)
+    try:
+        _, t_old = _timeit(numpy2blitz, sv)
+        print "Formatting a state vector with %i entries:" % size
+        print "    recursive: %.2fs" % t_old
+        cio = io.cio
+        for name, c in (("python", None), ("c", cio)):
+            if name == "c" and cio is None:
+                continue
+            io.cio = c
+            _, t_new = _timeit(io.save_statevector, path, sv)
+            print "    chunked (%s): %.2fs (%.1fx faster)" % (name, t_new,
+                                                            t_old/t_new)
+        io.cio = cio
+    finally:
+        os.remove(path)
+
+def benchmark_bz2(nrows=10**6, streamsize=900000):
+    """
+    Compare reading a bzip2 compressed trajectory with bz2.BZ2File and with
+    the parallel multi-stream reader.
+    """
+    fd, path = tempfile.mkstemp(prefix="pycppqed_bench_")
+    os.close(fd)
+    try:
+        _write_trajectory(path, nrows)
+        f = open(path)
+        data = f.read()
+        f.close()
+        # A single stream like bzip2 writes and several streams like pbzip2.
+        f = open(path + ".bz2", "wb")
+        f.write(bz2.compress(data))
+        f.close()
+        f = open(path + ".multi.bz2", "wb")
+        for i in range(0, len(data), streamsize):
+            f.write(bz2.compress(data[i:i+streamsize]))
+        f.close()
+        def count(f):
+            n = sum(1 for line in f)
+            f.close()
+            return n
+        n_old, t_old = _timeit(lambda: count(bz2.BZ2File(path + ".bz2")))
+        n_new, t_new = _timeit(lambda: count(
+                        parallelbz2.ParallelBZ2File(path + ".multi.bz2")))
+        assert n_old == n_new
+        print "Reading %.1f MB of bzip2 compressed data:" % (len(data)/1e6)
+        print "    bz2.BZ2File:     %.2fs" % t_old
+        print "    ParallelBZ2File: %.2fs (%.1fx faster)" % (t_new, t_old/t_new)
+    finally:
+        for p in (path, path + ".bz2", path + ".multi.bz2"):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+if __name__ == "__main__":
+    benchmark_evrows()
+    benchmark_columns()
+    benchmark_skip()
+    benchmark_save_statevector()
+    benchmark_bz2()
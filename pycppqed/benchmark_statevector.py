@@ -0,0 +1,219 @@
+"""
+Benchmarks for calculations with state vectors.
+
+Run all benchmarks with::
+
+    $ python -m pycppqed.benchmark_statevector
+"""
+import time
+import numpy
+import statevector
+
+
+def _timeit(func, *args, **kwargs):
+    """
+    Return the result of the given function and the time it took in seconds.
+    """
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - t0
+
+def _trajectory(ntimes, dims):
+    """
+    Return a StateVectorTrajectory with random state vectors.
+    """
+    shape = (ntimes,) + tuple(dims)
+    data = numpy.random.rand(*shape) + 1j*numpy.random.rand(*shape)
+    return statevector.StateVectorTrajectory(data,
+                        time=numpy.linspace(0, 1, ntimes), copy=False)
+
+def _compare(title, old, new, labels=("mapped", "batched")):
+    """
+    Time the old and the new version of a calculation.
+    """
+    r_old, t_old = _timeit(old)
+    r_new, t_new = _timeit(new)
+    assert numpy.allclose(numpy.asarray(r_old), numpy.asarray(r_new))
+    print "    %-14s %s: %6.3fs  %s: %6.3fs (%.1fx faster)" % (
+            title, labels[0], t_old, labels[1], t_new, t_old/t_new)
+
+def benchmark_trajectory(ntimes=10**4, dims=(8, 16)):
+    """
+    Compare the StateVectorTrajectory methods mapped over every single
+    StateVector with the batched implementations.
+    """
+    svt = _trajectory(ntimes, dims)
+    size = numpy.prod(dims)
+    op = numpy.random.rand(size, size)
+    op = op.reshape(dims + dims).transpose(0, 2, 1, 3)
+    op0 = numpy.random.rand(dims[0], dims[0])
+    diag = numpy.random.rand(*dims)
+    print "Operations on %i state vectors of shape %s:" % (ntimes, dims)
+    _compare("norm", lambda: svt.map(lambda sv: sv.norm(), False), svt.norm)
+    _compare("normalize", lambda: svt.map(lambda sv: sv.normalize()),
+             svt.normalize)
+    _compare("reduce", lambda: svt.map(lambda sv: sv.reduce(1)),
+             lambda: svt.reduce(1))
+    _compare("fft", lambda: svt.map(lambda sv: sv.fft()), svt.fft)
+    _compare("expvalue", lambda: svt.map(lambda sv: sv.expvalue(op), False),
+             lambda: svt.expvalue(op))
+    _compare("expvalue(0)",
+             lambda: svt.map(lambda sv: sv.expvalue(op0, 0), False),
+             lambda: svt.expvalue(op0, 0))
+    _compare("diagexpvalue",
+             lambda: svt.map(lambda sv: sv.diagexpvalue(diag), False),
+             lambda: svt.diagexpvalue(diag))
+
+def benchmark_expvalue(size=2000, sparsesize=10**4):
+    """
+    Compare the expectation value via the full density tensor with the
+    direct contraction, and show the latter for a large sparse operator.
+    """
+    import scipy.sparse
+    def expvalue(sv, op):
+        # The implementation that formed the density tensor.
+        A = sv^sv.conjugate()
+        return (A*op).sum()
+    sv = statevector.StateVector(numpy.random.rand(size)
+                                 + 1j*numpy.random.rand(size))
+    op = numpy.random.rand(size, size)
+    print "Expectation value of a dense operator (dimension %i):" % size
+    ev_old, t_old = _timeit(expvalue, sv, op)
+    ev_new, t_new = _timeit(sv.expvalue, op)
+    assert numpy.allclose(ev_old, ev_new)
+    print "    density tensor: %.3fs (%.0f MB temporary)" % (
+            t_old, 16.*size**2/2**20)
+    print "    contraction:    %.3fs (%.1fx faster)" % (t_new, t_old/t_new)
+    sv = statevector.StateVector(numpy.random.rand(sparsesize)
+                                 + 1j*numpy.random.rand(sparsesize))
+    a = numpy.sqrt(numpy.arange(1, sparsesize))
+    op = scipy.sparse.diags([a, a], [1, -1], format="csr")
+    _, t = _timeit(sv.expvalue, op)
+    print "Expectation value of a sparse operator (dimension %i):" % sparsesize
+    print "    contraction:    %.3fs (the density tensor would need %.0f MB)" % (
+            t, 16.*sparsesize**2/2**20)
+
+def benchmark_multi(nops=20, dims=(16, 16, 16), ntimes=1000):
+    """
+    Compare evaluating several operators one after the other with the
+    stacked evaluation, for one StateVector and for a trajectory.
+    """
+    def expvalues(sv, ops, indices):
+        # The loop that was used before the operators were stacked.
+        A = sv.reducesquare(statevector._conjugate_indices(indices, sv.ndim))
+        index = range(0, A.ndim, 2) + range(1, A.ndim, 2)
+        return [(A*op.transpose(index)).sum() for op in ops]
+    d = dims[0]
+    ops = [numpy.random.rand(d, d) for i in range(nops)]
+    svt = _trajectory(ntimes, dims)
+    sv = svt.statevectors[0]
+    labels = ("loop", "stacked")
+    print "%i operators on the first subsystem of shape %s:" % (nops, dims)
+    _compare("one state", lambda: expvalues(sv, ops, (0,)),
+             lambda: sv.expvalue(ops, (0,), multi=True), labels)
+    _compare("%i states" % ntimes,
+             lambda: numpy.array([expvalues(sv, ops, (0,))
+                                  for sv in svt.statevectors]).T,
+             lambda: svt.expvalue(ops, (0,), multi=True), labels)
+    def diagexpvalues(sv, ops):
+        A = (sv*sv.conjugate()).sum(2).sum(1)
+        return [(A*op).sum() for op in ops]
+    diag = [numpy.random.rand(d) for i in range(nops)]
+    _compare("diagonal",
+             lambda: numpy.array([diagexpvalues(sv, diag)
+                                  for sv in svt.statevectors]).T,
+             lambda: svt.diagexpvalue(diag, 0, multi=True), labels)
+
+def benchmark_fft(shape=(256, 256), repeat=50, ntimes=10**4, dims=(64,)):
+    """
+    Compare the fftshift/fftn chain with the cached FFT plans.
+    """
+    def shifted(array, axes=None):
+        # The transform that was used before the plans.
+        f = numpy.fft
+        norm = 1/numpy.sqrt(numpy.prod([array.shape[i] for i in axes]))
+        return f.fftshift(f.fftn(f.ifftshift(array, axes=axes), axes=axes),
+                          axes=axes)*norm
+    sv = statevector.StateVector(numpy.random.rand(*shape)
+                                 + 1j*numpy.random.rand(*shape))
+    axes = range(len(shape))
+    labels = ("shifts", "plan")
+    print "Fourier transforms of state vectors:"
+    _compare("%ix %s" % (repeat, "x".join(map(str, shape))),
+             lambda: [shifted(sv, axes) for i in range(repeat)][-1],
+             lambda: [sv.fft() for i in range(repeat)][-1], labels)
+    def inplace():
+        for i in range(repeat):
+            sv.fft(inplace=True)
+            sv.ifft(inplace=True)
+        return sv
+    copy = sv.copy()
+    _, t = _timeit(inplace)
+    assert numpy.allclose(copy, sv)
+    print "    %-14s fft+ifft in place: %6.3fs" % ("", t)
+    svt = _trajectory(ntimes, dims)
+    _compare("%i states" % ntimes,
+             lambda: svt.map(lambda sv: shifted(sv, range(len(dims))), False),
+             svt.fft, labels)
+
+def benchmark_reduce(dims=(40, 40, 40, 40), ntimes=1000, tdims=(8, 8, 8, 8)):
+    """
+    Compare reducing rank 4 state vectors one index at a time with the
+    single pass reduction.
+    """
+    def reduce_loop(sv, indices):
+        # The implementation that summed and renormalized index by index.
+        for i in sorted(indices, reverse=True):
+            sv = sv.sum(axis=i).normalize()
+        return sv
+    def diag_loop(sv, op, indices):
+        # Summing the probabilities one traced index at a time.
+        P = numpy.asarray(sv*sv.conj())
+        for i in sorted(indices, reverse=True):
+            P = P.sum(axis=i)
+        return (op*P).sum()
+    sv = statevector.StateVector(numpy.random.rand(*dims)
+                                 + 1j*numpy.random.rand(*dims))
+    op = numpy.random.rand(dims[0])
+    print "Reducing a state vector of shape %s:" % (dims,)
+    _compare("reduce", lambda: reduce_loop(sv, (1, 2, 3)),
+             lambda: sv.reduce((1, 2, 3)), ("loop", "single"))
+    _compare("diagexpvalue", lambda: diag_loop(sv, op, (1, 2, 3)),
+             lambda: sv.diagexpvalue(op, 0), ("loop", "single"))
+    svt = _trajectory(ntimes, tdims)
+    print "Reducing %i state vectors of shape %s:" % (ntimes, tdims)
+    _compare("reduce", lambda: svt.map(lambda sv: reduce_loop(sv, (2, 3))),
+             lambda: svt.reduce((2, 3)))
+    _compare("reducesquare",
+             lambda: svt.map(lambda sv: sv.reducesquare((2, 3)), False),
+             lambda: svt.reducesquare((2, 3)))
+
+def benchmark_product(nmodes=5, dim=20):
+    """
+    Compare norms and single mode expectation values of a product state
+    calculated from the full StateVector and from the lazy product.
+    """
+    import initialconditions
+    modes = [initialconditions.coherent(1.5, dim).normalize()
+             for i in range(nmodes)]
+    a = numpy.diag(numpy.sqrt(numpy.arange(1, dim)), 1)
+    n = numpy.arange(dim)
+    def evs(sv):
+        return [sv.norm(), sv.expvalue(a, 2), sv.diagexpvalue(n, 0)]
+    def dense():
+        return evs(reduce(lambda x, y: x^y, modes))
+    def lazy():
+        return evs(reduce(lambda x, y: x^y, modes[1:],
+                          statevector.ProductStateVector(modes[:1])))
+    print "Product of %i modes with dimension %i (%.1f MB if formed):" % (
+            nmodes, dim, dim**nmodes*16/1e6)
+    _compare("norm+expvalue", dense, lazy, ("dense", "lazy"))
+
+
+if __name__ == "__main__":
+    benchmark_trajectory()
+    benchmark_expvalue()
+    benchmark_multi()
+    benchmark_fft()
+    benchmark_reduce()
+    benchmark_product()
@@ -0,0 +1,427 @@
+"""
+This module provides the compression codecs that can be used for C++QED files.
+
+Every codec is registered under a name and recognized by the suffix of a
+filename:
+
+    ======  ========  ==============================================
+    Name    Suffix    Requirements
+    ======  ========  ==============================================
+    bz2     .bz2      standard library (multi-stream, see
+                      :mod:`pycppqed.parallelbz2`)
+    gz      .gz       standard library
+    xz      .xz       :mod:`lzma` (or :mod:`backports.lzma`)
+    zstd    .zst      :mod:`zstandard`
+    lz4     .lz4      :mod:`lz4.frame`
+    ======  ========  ==============================================
+
+Most important are:
+    * :func:`open`
+    * :func:`get_codec`
+    * :func:`codec_for_filename`
+"""
+import __builtin__
+import os
+import zlib
+import bz2
+import cStringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# Size of the pieces which are read and written at once.
+_CHUNKSIZE = 2**20
+
+
+class ChunkedFile(object):
+    """
+    A read-only file object that splits decompressed chunks into lines.
+
+    *Arguments*
+        * *name*
+            Name of the file.
+
+        * *chunks*
+            A generator yielding the decompressed data in pieces.
+    """
+    def __init__(self, name, chunks):
+        self.name = name
+        self.closed = False
+        self._chunks = chunks
+        self._buffer = cStringIO.StringIO("")
+        self._rest = ""
+
+    def _fill(self):
+        """
+        Load the next decompressed chunk into the line buffer.
+
+        Returns False if the end of the file is reached.
+        """
+        for chunk in self._chunks:
+            data = self._rest + chunk
+            cut = data.rfind("\n") + 1
+            if not cut:
+                self._rest = data
+                continue
+            self._buffer = cStringIO.StringIO(data[:cut])
+            self._rest = data[cut:]
+            return True
+        if self._rest:
+            self._buffer = cStringIO.StringIO(self._rest)
+            self._rest = ""
+            return True
+        return False
+
+    def __iter__(self):
+        # The buffer always ends with a complete line, so iterating over it
+        # is the fastest way to split the lines.
+        while True:
+            for line in self._buffer:
+                yield line
+            if not self._fill():
+                return
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def readline(self):
+        """
+        Return the next line of the decompressed file.
+        """
+        line = self._buffer.readline()
+        if line.endswith("\n"):
+            return line
+        while self._fill():
+            line += self._buffer.readline()
+            if line.endswith("\n"):
+                break
+        return line
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes of the decompressed file, or everything if
+        size is negative.
+        """
+        result = [self._buffer.read(size)]
+        if size < 0:
+            while self._fill():
+                result.append(self._buffer.read())
+            return "".join(result)
+        size -= len(result[0])
+        while size > 0 and self._fill():
+            result.append(self._buffer.read(size))
+            size -= len(result[-1])
+        return "".join(result)
+
+    def close(self):
+        """
+        Stop decompressing and release all resources.
+        """
+        if not self.closed:
+            self._chunks.close()
+            self._buffer = cStringIO.StringIO("")
+            self._rest = ""
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CompressedWriter(object):
+    """
+    A write-only file object that compresses everything written to it.
+
+    *Arguments*
+        * *filename*
+            Path of the compressed file.
+
+        * *compressor*
+            A function returning a new compressor object with the methods
+            compress(data) and flush().
+
+        * *streamsize* (optional)
+            If given, a new compressor is started after this many bytes, so
+            that the file consists of independent streams.
+    """
+    def __init__(self, filename, compressor, streamsize=None):
+        self.name = filename
+        self.closed = False
+        self._file = __builtin__.open(filename, "wb")
+        self._new_compressor = compressor
+        self._compressor = compressor()
+        self._streamsize = streamsize
+        self._written = 0
+
+    def write(self, data):
+        if self._streamsize is not None:
+            while self._written + len(data) >= self._streamsize:
+                n = self._streamsize - self._written
+                self._file.write(self._compressor.compress(data[:n]))
+                self._file.write(self._compressor.flush())
+                self._compressor = self._new_compressor()
+                self._written = 0
+                data = data[n:]
+            self._written += len(data)
+        self._file.write(self._compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._file.write(self._compressor.flush())
+            finally:
+                self._file.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _decompress_chunks(filename, decompressor):
+    """
+    Decompress the given file incrementally.
+
+    A new decompressor is started whenever a stream ends before the end of
+    the file, so files consisting of several streams are read completely.
+    """
+    f = __builtin__.open(filename, "rb")
+    try:
+        d = decompressor()
+        while True:
+            data = f.read(_CHUNKSIZE)
+            if not data:
+                break
+            while data:
+                result = d.decompress(data)
+                if result:
+                    yield result
+                data = getattr(d, "unused_data", "")
+                if data:
+                    d = decompressor()
+    finally:
+        f.close()
+
+
+class Codec(object):
+    """
+    A compression codec for C++QED files.
+
+    *Arguments*
+        * *name*
+            Name used to choose the codec, e.g. in the submitter config.
+
+        * *suffix*
+            Filename suffix of compressed files, including the dot.
+
+        * *compressor*
+            A function returning a new compressor object with the methods
+            compress(data) and flush(), or None if the codec is not available.
+
+        * *decompressor*
+            A function returning a new decompressor object with the method
+            decompress(data).
+
+        * *streamsize* (optional)
+            Compressed files are written as independent streams of this many
+            uncompressed bytes.
+    """
+    def __init__(self, name, suffix, compressor, decompressor,
+                 streamsize=None):
+        self.name = name
+        self.suffix = suffix
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.streamsize = streamsize
+
+    @property
+    def available(self):
+        return self.compressor is not None
+
+    def open(self, filename, mode="r"):
+        """
+        Open a compressed file for reading ("r") or writing ("w").
+        """
+        if not self.available:
+            raise IOError("Compression codec '%s' is not available." % self.name)
+        if mode.startswith("r"):
+            return ChunkedFile(filename,
+                               _decompress_chunks(filename, self.decompressor))
+        elif mode.startswith("w"):
+            return CompressedWriter(filename, self.compressor, self.streamsize)
+        raise ValueError("Mode '%s' is not supported." % mode)
+
+    def compress_file(self, path):
+        """
+        Compress the given file, remove it and return the new path.
+        """
+        target = path + self.suffix
+        _copy(__builtin__.open(path, "rb"), self.open(target, "w"))
+        os.remove(path)
+        return target
+
+    def decompress_file(self, path):
+        """
+        Decompress the given file, keep it and return the new path.
+        """
+        assert path.endswith(self.suffix)
+        target = path[:-len(self.suffix)]
+        _copy(self.open(path), __builtin__.open(target, "wb"))
+        return target
+
+
+class BZ2Codec(Codec):
+    """
+    The bzip2 codec, which writes multi-stream files like pbzip2.
+
+    Reading uses :class:`pycppqed.parallelbz2.ParallelBZ2File`, which
+    decompresses the streams in parallel.
+    """
+    def __init__(self):
+        Codec.__init__(self, "bz2", ".bz2", bz2.BZ2Compressor,
+                       bz2.BZ2Decompressor, streamsize=900000)
+
+    def open(self, filename, mode="r"):
+        if mode.startswith("r"):
+            import parallelbz2
+            return parallelbz2.ParallelBZ2File(filename)
+        return Codec.open(self, filename, mode)
+
+
+def _copy(src, dst):
+    """
+    Copy everything from src to dst in chunks and close both files.
+    """
+    try:
+        while True:
+            data = src.read(_CHUNKSIZE)
+            if not data:
+                break
+            dst.write(data)
+    finally:
+        src.close()
+        dst.close()
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor().compressobj()
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+class _LZ4Compressor(object):
+    # lz4.frame needs an explicit begin() before the first block.
+    def __init__(self):
+        self._compressor = lz4frame.LZ4FrameCompressor()
+        self._started = False
+    def compress(self, data):
+        result = ""
+        if not self._started:
+            result = self._compressor.begin()
+            self._started = True
+        return result + self._compressor.compress(data)
+    def flush(self):
+        return self.compress("") + self._compressor.flush()
+
+
+codecs = {}
+
+def register_codec(codec):
+    """
+    Make the given :class:`Codec` available under its name.
+    """
+    codecs[codec.name] = codec
+
+register_codec(BZ2Codec())
+register_codec(Codec("gz", ".gz", _gzip_compressor, _gzip_decompressor))
+register_codec(Codec("xz", ".xz",
+                     lzma and lzma.LZMACompressor,
+                     lzma and lzma.LZMADecompressor))
+register_codec(Codec("zstd", ".zst",
+                     zstandard and _zstd_compressor,
+                     zstandard and _zstd_decompressor))
+register_codec(Codec("lz4", ".lz4",
+                     lz4frame and _LZ4Compressor,
+                     lz4frame and lz4frame.LZ4FrameDecompressor))
+
+DEFAULT = "bz2"
+
+def get_codec(name):
+    """
+    Return the codec with the given name.
+
+    If the codec is known but the module it needs is not installed, the
+    default codec (bz2) is returned instead.
+    """
+    if name not in codecs:
+        raise ValueError("Unknown compression codec '%s', choose one of %s."
+                         % (name, ", ".join(sorted(codecs))))
+    codec = codecs[name]
+    if not codec.available:
+        print "Compression codec '%s' not available, using '%s' ..." % (
+                name, DEFAULT)
+        codec = codecs[DEFAULT]
+    return codec
+
+def suffixes():
+    """
+    Return the filename suffixes of all registered codecs.
+    """
+    return [codec.suffix for codec in codecs.values()]
+
+def codec_for_filename(filename):
+    """
+    Return the codec the given file is compressed with, judged by its suffix,
+    or None if it is not compressed.
+    """
+    for codec in codecs.values():
+        if filename.endswith(codec.suffix):
+            return codec
+    return None
+
+def strip_suffix(filename):
+    """
+    Return the filename without the suffix of its compression codec.
+    """
+    codec = codec_for_filename(filename)
+    if codec is None:
+        return filename
+    return filename[:-len(codec.suffix)]
+
+def open(filename, mode="r"):
+    """
+    Open a file, which is compressed if its suffix belongs to a codec.
+    """
+    codec = codec_for_filename(filename)
+    if codec is None:
+        return __builtin__.open(filename, mode)
+    return codec.open(filename, mode)
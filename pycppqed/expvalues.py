@@ -104,8 +104,13 @@ class ExpectationValueCollection(numpy.ndarray):
                 titles = list(titles)
             titles = titles + [None]*(len(data) - len(titles))
             traj = [None]*len(data)
+            copy = kwargs.get("copy", True)
             for i, col in enumerate(data):
-                traj[i] = ExpectationValueTrajectory(col, time, titles[i])
+                if not copy:
+                    # Share the data storage with the collection.
+                    col = numpy.asarray(array[i])
+                traj[i] = ExpectationValueTrajectory(col, time, titles[i],
+                                                     copy=copy)
             array.evtrajectories = tuple(traj)
         if time is not None:
             array.time = time
@@ -0,0 +1,184 @@
+"""
+This module provides cached plans for the centered Fourier transforms of
+state vectors.
+
+:meth:`pycppqed.statevector.StateVector.fft` transforms between position and
+momentum space with the zero frequency in the middle of the array, which
+means an ``ifftshift`` before and an ``fftshift`` after the transform. Both
+shifts are equivalent to multiplying with phase factors, so a
+:class:`FFTPlan` computes these factors (together with the normalization)
+once per shape and axes and applies them in place.
+
+The fastest available backend is used:
+
+    * :mod:`scipy.fft` (scipy >= 1.4), multithreaded with *workers*
+    * :mod:`scipy.fftpack`, which can overwrite its input
+    * :mod:`numpy.fft`
+
+Most important are:
+    * :func:`get_plan`
+    * :class:`FFTPlan`
+"""
+
+import collections
+import numpy
+
+try:
+    import scipy.fft as _scipyfft
+except ImportError:
+    _scipyfft = None
+try:
+    import scipy.fftpack as _fftpack
+except ImportError:
+    _fftpack = None
+
+# Number of threads scipy.fft may use (-1 means all CPUs).
+workers = -1
+
+# Number of plans kept in the cache. Every plan holds phase factors of the
+# size of one state vector, so only the most recently used ones are kept.
+maxplans = 8
+
+_plans = collections.OrderedDict()
+
+
+def _phases(n, inverse):
+    """
+    Return the phase factors which replace ifftshift and fftshift.
+
+    *Returns*
+        * *(before, after)*
+            The input has to be multiplied with *before* and the transformed
+            array with *after*.
+    """
+    c = n//2
+    k = numpy.arange(n)
+    sign = -1 if inverse else 1
+    before = numpy.exp(sign*2j*numpy.pi*k*c/n)
+    after = numpy.exp(sign*2j*numpy.pi*c*(k - c)/n)
+    return before, after
+
+def _transform(array, axes, inverse, overwrite):
+    """
+    Fourier transform the array with the best available backend.
+    """
+    if _scipyfft is not None:
+        f = _scipyfft.ifftn if inverse else _scipyfft.fftn
+        return f(array, axes=axes, overwrite_x=overwrite, workers=workers)
+    if _fftpack is not None:
+        f = _fftpack.ifftn if inverse else _fftpack.fftn
+        return f(array, axes=axes, overwrite_x=overwrite)
+    f = numpy.fft.ifftn if inverse else numpy.fft.fftn
+    return f(array, axes=axes)
+
+
+class FFTPlan(object):
+    """
+    A centered and normalized Fourier transform for arrays of one shape.
+
+    *Usage*
+        >>> plan = FFTPlan((64, 32), axes=(0,))
+        >>> k = plan(x)
+        >>> plan(x, inplace=True)
+
+    *Arguments*
+        * *shape*
+            Shape of the arrays which are transformed.
+
+        * *axes* (optional)
+            Axes over which the transform is done. (Default is all)
+
+        * *inverse* (optional)
+            If True, the transform momentum space -> position space is done.
+            (Default is False)
+
+    The transform is normalized like :meth:`StateVector.fft`, i.e. it is
+    unitary. The phase factors are stored as arrays that are broadcast over
+    all axes which are not transformed, so a plan for a whole
+    StateVectorTrajectory needs only the memory of one state vector.
+    """
+    def __init__(self, shape, axes=None, inverse=False):
+        self.shape = tuple(shape)
+        if axes is None:
+            axes = range(len(shape))
+        elif isinstance(axes, int):
+            axes = (axes,)
+        self.axes = tuple([a % len(shape) for a in axes])
+        self.inverse = inverse
+        factorshape = [1]*len(shape)
+        for a in self.axes:
+            factorshape[a] = shape[a]
+        before = numpy.ones(factorshape, dtype=complex)
+        after = numpy.ones(factorshape, dtype=complex)
+        for a in self.axes:
+            b, c = _phases(shape[a], inverse)
+            s = [1]*len(shape)
+            s[a] = shape[a]
+            before *= b.reshape(s)
+            after *= c.reshape(s)
+        norm = numpy.sqrt(numpy.prod([shape[a] for a in self.axes]))
+        if inverse:
+            after *= norm
+        else:
+            after /= norm
+        self.before = before
+        self.after = after
+
+    def __call__(self, array, out=None, inplace=False):
+        """
+        Transform the given array.
+
+        *Arguments*
+            * *array*
+                The array with the shape of the plan.
+
+            * *out* (optional)
+                A complex array of the same shape that receives the result.
+                It can be reused for many transforms.
+
+            * *inplace* (optional)
+                If True, the result is written back into the array, which
+                has to be a complex array. The backend may still allocate a
+                temporary array for the transform. (Default is False)
+
+        *Returns*
+            * *result*
+                The transformed array (*array* or *out* if one of them was
+                used).
+        """
+        if array.shape != self.shape:
+            raise ValueError("Array has shape %s, the plan is for %s."
+                             % (array.shape, self.shape))
+        if inplace:
+            if array.dtype != complex:
+                raise TypeError("Only complex arrays can be transformed in "
+                                "place.")
+            out = array
+        elif out is None:
+            out = numpy.empty(self.shape, dtype=complex)
+        numpy.multiply(array, self.before, out)
+        result = _transform(out, self.axes, self.inverse, True)
+        if result is not out:
+            out[...] = result
+            del result
+        out *= self.after
+        return out
+
+
+def get_plan(shape, axes=None, inverse=False):
+    """
+    Return the cached :class:`FFTPlan` for the given shape and axes.
+
+    At most :data:`maxplans` plans are cached; the least recently used one is
+    dropped first.
+    """
+    if axes is not None and not isinstance(axes, int):
+        axes = tuple(axes)
+    key = (tuple(shape), axes, inverse)
+    plan = _plans.pop(key, None)
+    if plan is None:
+        plan = FFTPlan(shape, axes, inverse)
+        while len(_plans) >= maxplans:
+            _plans.popitem(last=False)
+    _plans[key] = plan
+    return plan
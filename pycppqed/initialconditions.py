@@ -9,6 +9,7 @@ At the moment the following initial conditions are implemented:
 import numpy
 import numpy.fft as fft
 import statevector
+import sparsestatevector
 
 
 def gaussian(x0=0, k0=0, sigma=0.5, fin=6, isItInK=False, cppqed=False):
@@ -81,7 +82,7 @@ def gaussian(x0=0, k0=0, sigma=0.5, fin=6, isItInK=False, cppqed=False):
     if not isItInK: Psi=Psi.fft()
     return Psi.normalize()
 
-def coherent(alpha=2, N=20):
+def coherent(alpha=2, N=20, threshold=None):
     r"""
     Generate a coherent StateVector in the Fock space.
 
@@ -98,6 +99,10 @@ def coherent(alpha=2, N=20):
             A number determining the dimension of the Fock space. (Default is
             20)
 
+        * *threshold* (optional)
+            If given, only amplitudes larger than this are kept and a
+            :class:`pycppqed.sparsestatevector.SparseStateVector` is returned.
+
     *Returns*
         * *sv*
             A :class:`pycppqed.statevector.StateVector`.
@@ -124,9 +129,11 @@ def coherent(alpha=2, N=20):
     for n in range(1,N):
         x[n] = x[n-1]*alpha/numpy.sqrt(n)
     x = numpy.exp(-numpy.abs(alpha)**2/2.)*x
+    if threshold is not None:
+        return sparsestatevector.fromdense(x, threshold)
     return statevector.StateVector(x)
 
-def fock(dim,i):
+def fock(dim,i,sparse=False):
     r"""
     Generate a Fock space basis vector.
 
@@ -142,10 +149,17 @@ def fock(dim,i):
         * *i*
             Genereate the i-th basis vector
 
+        * *sparse* (optional)
+            If True, a
+            :class:`pycppqed.sparsestatevector.SparseStateVector` is returned
+            without creating the dense vector. (Default is False)
+
     *Returns*
         * *sv*
             A :class:`pycppqed.statevector.StateVector`.
     """
+    if sparse:
+        return sparsestatevector.SparseStateVector((dim,), (i,), (1.,))
     psi=numpy.zeros(dim)
     psi[i]=1.
     return statevector.StateVector(psi)
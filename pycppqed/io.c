@@ -1,10 +1,73 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include <string.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <locale.h>
+#if defined(__APPLE__)
+#include <xlocale.h>
+#endif
+
+// Numbers are always parsed with the "C" locale, independent of the locale
+// of the running process.
+#if defined(_MSC_VER)
+typedef _locale_t locale_t;
+#define c_locale_new() _create_locale(LC_NUMERIC, "C")
+#define strtod_l _strtod_l
+#else
+#define c_locale_new() newlocale(LC_NUMERIC_MASK, "C", (locale_t)0)
+#endif
+
+static locale_t c_locale;
+
+
+// Parse length complex numbers of the form "(re,im)" starting at the cursor
+// pos and return how many were found, or length+1 if there are more.
+static npy_intp parse_complex(const char *pos, double *data, npy_intp length){
+    char *end;
+    npy_intp i;
+    for (i=0; i<length; i++){
+        pos = strchr(pos, '(');
+        if (pos == NULL) return i;
+        pos++;
+        data[2*i] = strtod_l(pos, &end, c_locale);
+        if (end == pos || *end != ',') return i;
+        pos = end + 1;
+        data[2*i+1] = strtod_l(pos, &end, c_locale);
+        if (end == pos || *end != ')') return i;
+        pos = end + 1;
+        }
+    // Check that there are no numbers left.
+    if (strchr(pos, '(') != NULL) return length + 1;
+    return length;
+    }
+
+// Parse datastr into the given complex128 array and set a python exception
+// if the number of entries doesn't match.
+static int parse_checked(const char *datastr, PyArrayObject *array){
+    npy_intp length = PyArray_SIZE(array);
+    double *data = (double*)PyArray_DATA(array);
+    npy_intp found;
+    Py_BEGIN_ALLOW_THREADS
+    found = parse_complex(datastr, data, length);
+    Py_END_ALLOW_THREADS
+    if (found < length){
+        PyErr_Format(PyExc_ValueError,
+                "Expected %ld numbers but found only %ld.",
+                (long)length, (long)found);
+        return -1;
+        }
+    if (found > length){
+        PyErr_Format(PyExc_ValueError,
+                "Expected %ld numbers but found more.", (long)length);
+        return -1;
+        }
+    return 0;
+    }
 
 static PyObject *parse(PyObject *self, PyObject *args){
     // Read in arguments: datastr, length
-    char *datastr;
+    const char *datastr;
     int length;
     if (!PyArg_ParseTuple(args, "si", &datastr, &length)) return NULL;
 
@@ -12,32 +75,201 @@ static PyObject *parse(PyObject *self, PyObject *args){
     npy_intp dims[1];
     dims[0] = length;
     PyArrayObject *array = (PyArrayObject *)
-        PyArray_SimpleNew(1, dims, PyArray_CDOUBLE);
+        PyArray_SimpleNew(1, dims, NPY_CDOUBLE);
+    if (array == NULL) return NULL;
+    if (parse_checked(datastr, array) < 0){
+        Py_DECREF(array);
+        return NULL;
+        }
+    return PyArray_Return(array);
+    }
+
+static PyObject *parse_into(PyObject *self, PyObject *args){
+    // Read in arguments: datastr, array
+    const char *datastr;
+    PyArrayObject *array;
+    if (!PyArg_ParseTuple(args, "sO!", &datastr, &PyArray_Type, &array))
+        return NULL;
+    if (PyArray_TYPE(array) != NPY_CDOUBLE || !PyArray_ISCARRAY(array)){
+        PyErr_SetString(PyExc_ValueError,
+                "Array has to be a writeable, contiguous complex128 array.");
+        return NULL;
+        }
+    if (parse_checked(datastr, array) < 0) return NULL;
+    Py_RETURN_NONE;
+    }
 
-    // Create pointer to data.
-    double *data;
-    data = (double*)array->data;
+static PyObject *parse_evrows(PyObject *self, PyObject *args){
+    // Read in arguments: datastr, buffer, columns (optional)
+    const char *datastr;
+    PyArrayObject *buffer;
+    PyArrayObject *columns = NULL;
+    if (!PyArg_ParseTuple(args, "sO!|O!", &datastr, &PyArray_Type, &buffer,
+                          &PyArray_Type, &columns))
+        return NULL;
+    if (PyArray_NDIM(buffer) != 2 || PyArray_TYPE(buffer) != NPY_DOUBLE ||
+            !PyArray_ISCARRAY(buffer)) {
+        PyErr_SetString(PyExc_ValueError,
+                "Buffer has to be a writeable, contiguous 2D float64 array.");
+        return NULL;
+        }
+    npy_intp rows = PyArray_DIM(buffer, 0);
+    npy_intp cols = PyArray_DIM(buffer, 1);
+    double *data = (double*)PyArray_DATA(buffer);
+
+    // Optionally only the given columns are converted, the others skipped.
+    npy_intp *colidx = NULL;
+    npy_intp j;
+    if (columns != NULL){
+        if (PyArray_NDIM(columns) != 1 || PyArray_TYPE(columns) != NPY_INTP ||
+                !PyArray_ISCARRAY_RO(columns) ||
+                PyArray_DIM(columns, 0) != cols){
+            PyErr_SetString(PyExc_ValueError,
+                    "Columns have to be a contiguous 1D intp array with one "
+                    "entry per buffer column.");
+            return NULL;
+            }
+        colidx = (npy_intp*)PyArray_DATA(columns);
+        for (j=0; j<cols; j++){
+            if (colidx[j] < 0 || (j && colidx[j] <= colidx[j-1])){
+                PyErr_SetString(PyExc_ValueError,
+                        "Columns have to be non-negative and increasing.");
+                return NULL;
+                }
+            }
+        }
+
+    // Go through the string row by row and extract the requested numbers.
+    const char *pos = datastr;
+    char *end;
+    npy_intp i, field;
+    int error = 0;
+    Py_BEGIN_ALLOW_THREADS
+    for (i=0; i<rows && !error; i++){
+        field = 0;
+        for (j=0; j<cols; j++){
+            // Skip the fields in front of the next requested column.
+            while (colidx != NULL && field < colidx[j]){
+                while (*pos == ' ' || *pos == '\t') pos++;
+                if (*pos == '\n' || *pos == '\0'){
+                    error = 1;
+                    break;
+                    }
+                while (*pos != ' ' && *pos != '\t' && *pos != '\n' &&
+                       *pos != '\0') pos++;
+                field++;
+                }
+            if (error) break;
+            while (*pos == ' ' || *pos == '\t') pos++;
+            // strtod_l would skip the newline and read from the next row.
+            if (*pos == '\n' || *pos == '\0'){
+                error = 1;
+                break;
+                }
+            data[i*cols+j] = strtod_l(pos, &end, c_locale);
+            if (end == pos){
+                error = 1;
+                break;
+                }
+            pos = end;
+            field++;
+            }
+        if (error) break;
+        // Skip surplus numbers until the end of the row.
+        pos = strchr(pos, '\n');
+        if (pos == NULL){
+            if (i != rows-1) error = 2;
+            break;
+            }
+        pos++;
+        }
+    Py_END_ALLOW_THREADS
+    if (error == 1){
+        PyErr_Format(PyExc_ValueError,
+                "Row %ld has less than %ld numbers.", (long)i,
+                (long)(colidx != NULL ? colidx[cols-1]+1 : cols));
+        return NULL;
+        }
+    if (error == 2){
+        PyErr_Format(PyExc_ValueError, "Found only %ld rows.", (long)(i+1));
+        return NULL;
+        }
+    Py_RETURN_NONE;
+    }
 
-    // Go through the string and extract all numbers.
-    strtok(datastr, "(");
+// Write value with enough digits to be read back exactly and return the
+// number of characters written. The decimal point is always '.', even if
+// the process uses a locale with a different one.
+static int write_double(char *buf, double value){
+    int n = snprintf(buf, 32, "%.17g", value);
     int i;
-    for (i=0; i<2*length; i+=2){
-        data[i] = strtod(strtok(NULL, ","), NULL);
-        data[i+1] = strtod(strtok(NULL, ")"), NULL);
-        strtok(NULL, "(");
+    for (i=0; i<n; i++){
+        if (buf[i] == ',') buf[i] = '.';
         }
-    return PyArray_Return(array);
+    return n;
+    }
+
+static PyObject *format(PyObject *self, PyObject *args){
+    // Read in arguments: array
+    PyArrayObject *array;
+    if (!PyArg_ParseTuple(args, "O!", &PyArray_Type, &array)) return NULL;
+    if (PyArray_NDIM(array) != 2 || PyArray_TYPE(array) != NPY_CDOUBLE ||
+            !PyArray_ISCARRAY_RO(array)){
+        PyErr_SetString(PyExc_ValueError,
+                "Array has to be a contiguous 2D complex128 array.");
+        return NULL;
+        }
+    npy_intp rows = PyArray_DIM(array, 0);
+    npy_intp cols = PyArray_DIM(array, 1);
+    double *data = (double*)PyArray_DATA(array);
+
+    // Numbers are written as "(re,im)", separated by " " within a row and
+    // by " \n  " between rows. Every entry needs at most 2*32+7 characters.
+    char *buf = PyMem_Malloc(72*rows*cols + 1);
+    if (buf == NULL) return PyErr_NoMemory();
+    char *pos = buf;
+    npy_intp i, j;
+    Py_BEGIN_ALLOW_THREADS
+    for (i=0; i<rows; i++){
+        for (j=0; j<cols; j++){
+            if (j) *pos++ = ' ';
+            else if (i){
+                memcpy(pos, " \n  ", 4);
+                pos += 4;
+                }
+            *pos++ = '(';
+            pos += write_double(pos, data[2*(i*cols+j)]);
+            *pos++ = ',';
+            pos += write_double(pos, data[2*(i*cols+j)+1]);
+            *pos++ = ')';
+            }
+        }
+    Py_END_ALLOW_THREADS
+    PyObject *result = PyString_FromStringAndSize(buf, pos - buf);
+    PyMem_Free(buf);
+    return result;
     }
 
 
 static PyMethodDef DataMethods[] = {
     {"parse", parse, METH_VARARGS, "Parse blitz array into numpy array."},
+    {"parse_into", parse_into, METH_VARARGS,
+        "Parse blitz array into a preallocated complex128 numpy array."},
+    {"parse_evrows", parse_evrows, METH_VARARGS,
+        "Parse (selected columns of) expectation value rows into a "
+        "preallocated 2D numpy array."},
+    {"format", format, METH_VARARGS,
+        "Format a 2D complex numpy array as the data part of a blitz array."},
     {NULL, NULL, 0, NULL},
     };
 
 
 PyMODINIT_FUNC initcio(void){
+    c_locale = c_locale_new();
+    if (c_locale == (locale_t)0){
+        PyErr_SetString(PyExc_ImportError, "Can't create C locale.");
+        return;
+        }
     Py_InitModule("cio", DataMethods);
     import_array();
     }
-
@@ -3,16 +3,26 @@ This module provides functions to read and write C++QED files.
 
 Most important are:
     * :func:`load_cppqed`
+    * :func:`iter_cppqed`
     * :func:`load_statevector`
     * :func:`save_statevector`
     * :func:`split_cppqed`
+    * :func:`convert_cppqed`
+    * :func:`last_time`
+    * :func:`build_index`
 """
+import os
+import tempfile
 import numpy
 import statevector
+import sparsestatevector
 import expvalues
 import utils
 import pycppqed
-import bz2
+import ast
+import cStringIO
+import compression
+import parallelbz2
 try:
     import cio
 except:
@@ -24,74 +34,230 @@ except:
     print "C++ extension to support binary statevector files not available..."
     ciobin = None
 
-def _blitz2numpy(blitzstr):
+def _blitz_dims(dimstr):
     """
-    Transform a string representation of a blitz array into a numpy array.
+    Return the shape described by the dimension line of a blitz array.
     """
-    # Split array into dimension and data part.
-    dimstr, datastr = blitzstr.split("\n", 1)
-    # Parse dimension part.
     dimensions = eval("(%s,)" % dimstr.replace(" x ", ","))
     dims = []
     for d in dimensions:
         dims.append(d[1] - d[0] + 1)
-    length = reduce(int.__mul__, dims)
+    return tuple(dims)
+
+def _blitz2numpy(blitzstr, out=None):
+    """
+    Transform a string representation of a blitz array into a numpy array.
+
+    If *out* is given, the data is parsed directly into this complex array,
+    which must have the shape of the blitz array.
+    """
+    # Split array into dimension and data part.
+    dimstr, datastr = blitzstr.split("\n", 1)
+    # Parse dimension part.
+    dims = _blitz_dims(dimstr)
+    if out is None:
+        array = numpy.empty(dims, dtype="complex")
+    elif out.shape != dims:
+        raise ValueError("Blitz array has shape %s, expected %s."
+                         % (dims, out.shape))
+    else:
+        array = out
     # Parse data part either with c-extension or with python code.
-    if cio is not None:
-        import locale
-        locale.setlocale(locale.LC_ALL, "en_US.utf8")
-        array = numpy.array(cio.parse(datastr, length))
+    if cio is not None and array.flags.c_contiguous:
+        cio.parse_into(datastr, array)
     else:
-        array = numpy.empty(length, dtype="complex")
         data = datastr.replace(" \n ", "").rstrip("\n")[3:-3].split(") (")
+        if len(data) != array.size:
+            raise ValueError("Expected %i numbers but found %i."
+                             % (array.size, len(data)))
+        flat = numpy.empty(array.size, dtype="complex")
         for i, entry in enumerate(data):
             re, im = entry.split(",")
-            array[i] = complex(float(re), float(im))
-    return array.reshape(*dims)
+            flat[i] = complex(float(re), float(im))
+        array[...] = flat.reshape(dims)
+    return array
+
+def _write_blitz(f, array, chunksize=2**16):
+    """
+    Write the blitz array string representation of the given array to f.
+
+    The numbers are formatted in chunks of at most *chunksize* entries, either
+    by the C extension or with a single string formatting operation per chunk,
+    and every chunk is written to the open file *f* immediately.
+    """
+    array = numpy.asarray(array)
+    dims = array.shape
+    f.write("%s \n[ " % " x ".join(["(0,%s)" % (d-1) for d in dims]))
+    # A 0-d array is written like a single row with one entry.
+    ncols = dims[-1] if dims else 1
+    size = array.size
+    if not size:
+        bounds = ()
+    elif ncols <= chunksize:
+        # Chunks consist of whole rows.
+        chunksize = (chunksize//ncols)*ncols
+        bounds = ((i, i+chunksize, ncols) for i in xrange(0, size, chunksize))
+    else:
+        # Rows are split into several chunks.
+        bounds = ((i, min(i+chunksize, r+ncols), None)
+                  for r in xrange(0, size, ncols)
+                  for i in xrange(r, r+ncols, chunksize))
+    fmts = {}
+    flat = array.reshape(-1)
+    for start, stop, rowlength in bounds:
+        chunk = flat[start:stop].astype("complex")
+        if rowlength is None:
+            rowlength = len(chunk)
+        chunk = chunk.reshape((-1, rowlength))
+        if start:
+            if start % ncols:
+                f.write(" ")
+            else:
+                f.write(" \n  ")
+        if cio is not None:
+            f.write(cio.format(chunk))
+            continue
+        if chunk.shape not in fmts:
+            rowfmt = " ".join(["(%r,%r)"]*chunk.shape[1])
+            fmts[chunk.shape] = " \n  ".join([rowfmt]*chunk.shape[0])
+        f.write(fmts[chunk.shape] % tuple(chunk.view("float").ravel().tolist()))
+    f.write(" ]\n\n")
 
 def _numpy2blitz(array):
     """
     Create blitz array string representation from the given numpy array.
     """
-    def data1D(array):
-        # Function handling 1D arrays.
-        datastr = ["(%s,%s)" % (number.real, number.imag) for number in array]
-        return " ".join(datastr)
-    def data2D(array):
-        # Function handling 2D arrays.
-        datastr = [data1D(row) for row in array]
-        return " \n  ".join(datastr)
-    def dataMD(array, dimensions):
-        # Function handling > 2D arrays.
-        dim0, otherdims = dimensions[0], dimensions[1:]
-        length = len(otherdims)
-        datastr = []
-        if length > 2:
-            for i in range(dim0[1] - dim0[0] + 1):
-                datastr.append(dataMD(array[i], otherdims))
-            return " \n  ".join(datastr)
-        elif length == 2:
-            for i in range(dim0[1] - dim0[0] + 1):
-                datastr.append(data2D(array[i]))
-            return " \n  ".join(datastr)
-    # Determine dimensionality of array.
-    if hasattr(array, "dimensions"):
-        dimensions = array.dimensions
-    else:
-        dimensions = array.shape
-    dimensions = [(0,dim-1) for dim in array.shape]
-    ndim = len(dimensions)
-    if ndim == 1:
-        datastr = data1D(array)
-    elif ndim == 2:
-        datastr = data2D(array)
-    elif ndim > 2:
-        datastr = dataMD(array, dimensions)
-    dims = []
-    for d in dimensions:
-        dims.append("(%s,%s)" % d)
-    dimensionstr = " x ".join(dims)
-    return "%s \n[ %s ]\n\n" % (dimensionstr, datastr)
+    f = cStringIO.StringIO()
+    _write_blitz(f, array)
+    return f.getvalue()
+
+class _BlockReader(object):
+    """
+    Read lines and whole Blitz arrays from an open file.
+
+    The file is read in large chunks. Lines are split off with a search for
+    the newline, and Blitz arrays end at the first closing " ]\n", so they
+    are found with a single buffered search instead of line by line.
+    """
+    def __init__(self, f, chunksize=2**20):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = ""
+        self.pos = 0
+        self.base = 0
+
+    def _more(self):
+        data = self.f.read(self.chunksize)
+        if not data:
+            return False
+        self.base += self.pos
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def tell(self):
+        """
+        Return the number of bytes consumed so far.
+        """
+        return self.base + self.pos
+
+    def readline(self):
+        """
+        Return the next line, or an empty string at the end of the file.
+        """
+        while True:
+            i = self.buf.find("\n", self.pos)
+            if i != -1:
+                line = self.buf[self.pos:i+1]
+                self.pos = i + 1
+                return line
+            if not self._more():
+                line = self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return line
+
+    def readblock(self, keep=True):
+        """
+        Read everything up to and including the next " ]\n".
+
+        Returns None if the end of the file is reached first. If *keep* is
+        False, the block is skipped and an empty string is returned.
+        """
+        pieces = []
+        while True:
+            i = self.buf.find(" ]\n", self.pos)
+            if i != -1:
+                if keep:
+                    pieces.append(self.buf[self.pos:i+3])
+                self.pos = i + 3
+                return "".join(pieces)
+            # The last two bytes could be the beginning of the marker.
+            cut = max(self.pos, len(self.buf) - 2)
+            if keep:
+                pieces.append(self.buf[self.pos:cut])
+            self.pos = cut
+            if not self._more():
+                return None
+
+def _scan_cppqed(f, skip=(), chunksize=2**20):
+    """
+    Iterate over the blocks of an open C++QED output file.
+
+    *Arguments*
+        * *f*
+            An open C++QED output file (anything with a read method).
+
+        * *skip* (optional)
+            Kinds of blocks ("sv" and/or "basis") which are skipped. Their
+            end is searched in the raw data and they are never turned into
+            strings.
+
+        * *chunksize* (optional)
+            The file is read in pieces of this many bytes.
+
+    *Yields*
+        * *(kind, data)*
+            A tuple where *kind* is one of "head", "ev", "sv" or "basis". For
+            "head", "ev" and "sv" *data* is the corresponding string, for
+            "basis" it is a tuple ``(header, svstr)``.
+
+    The "head" block is always yielded first. A Blitz array that is cut off
+    at the end of the file (e.g. because C++QED is still running) is silently
+    dropped.
+    """
+    reader = _BlockReader(f, chunksize)
+    buf = []
+    # Iterate over comment section.
+    line = reader.readline()
+    while line:
+        if line.strip(" \n") and not line.startswith("#"):
+            break
+        buf.append(line)
+        line = reader.readline()
+    yield "head", "".join(buf)
+    del buf
+
+    # Iterate over data section.
+    while line:
+        if not line.strip():
+            pass
+        elif line.startswith("# BASIS"):
+            block = reader.readblock("basis" not in skip)
+            if block is None:
+                return
+            if "basis" not in skip:
+                yield "basis", (line, block)
+        elif line.startswith("#"):
+            pass
+        elif line.startswith("("):
+            block = reader.readblock("sv" not in skip)
+            if block is None:
+                return
+            if "sv" not in skip:
+                yield "sv", line + block
+        else:
+            yield "ev", line
+        line = reader.readline()
 
 def _parse_cppqed(filename, head_handler, ev_handler, sv_handler, basis_handler):
     """
@@ -101,6 +267,10 @@ def _parse_cppqed(filename, head_handler, ev_handler, sv_handler, basis_handler)
         * *filename*
             Path to the C++QED output file that should be parsed.
 
+        * *head_handler*
+            A function that will be called with the comment section of the
+            C++QED output file.
+
         * *ev_handler*
             A function that will be called when an expectation value row is
             found.
@@ -111,74 +281,317 @@ def _parse_cppqed(filename, head_handler, ev_handler, sv_handler, basis_handler)
         * *basis_handler*
             A function that will be called when a basis vector is found.
 
-    *Returns*
-        * *commentstr*
-            A string containing the comment section of the C++QED output file.
+    Every handler can be None. State vector and basis blocks without handler
+    are skipped without reading them into strings.
     """
+    handlers = {
+        "head": head_handler,
+        "ev": ev_handler,
+        "sv": sv_handler,
+        "basis": basis_handler and (lambda data: basis_handler(*data)),
+        }
+    skip = [kind for kind in ("sv", "basis") if handlers[kind] is None]
     f = _open_possibly_bz2(filename)
-    buf = []
+    try:
+        for kind, data in _scan_cppqed(f, skip):
+            if handlers[kind] is not None:
+                handlers[kind](data)
+    finally:
+        f.close()
 
-    # Iterate over data section.
-    while True:
-        line = f.next()
-        if line.strip(" \n") and not line.startswith("#"):
-            break
-        buf.append(line)
-    head_handler("".join(buf))
-    del buf
+def _open_possibly_bz2(filename, mode="r"):
+    """
+    Return a file object that decompresses if filename ends with the suffix of
+    a compression codec (e.g. .bz2, .gz, .xz, .zst), else a regular file object
 
-    # Iterate over data section.
-    while True:
-        if not line.strip():
-            pass
-        elif line.startswith("# BASIS"):
-            header = line
-            buf = []
-            while True:
-                line = f.next()
-                buf.append(line)
-                if line.endswith(" ]\n"):
-                    break
-            basis_handler(header, "".join(buf))
-            del buf
-        elif line.startswith("#"):
-            pass
-        elif line.startswith("("):
-            buf = [line]
-            while True:
-                line = f.next()
-                buf.append(line)
-                if line.endswith(" ]\n"):
-                    break
-            sv_handler("".join(buf))
+    See :mod:`pycppqed.compression` for the available codecs.
+    """
+    return compression.open(filename, mode)
+
+def _parse_evrow(evstr, maxevs=None):
+    """
+    Transform an expectation value row of a C++QED output file into a list.
+    """
+    parts = evstr.split("\t")
+    ev = []
+    for part in parts:
+        ev.extend(map(float, part.split()))
+    if not maxevs is None: ev = ev[:maxevs]
+    return ev
+
+def _parse_evrows(rows, maxevs=None, columns=None):
+    """
+    Transform a list of expectation value rows into an array of shape
+    (ncols, nrows).
+
+    All rows are tokenized in one pass into a preallocated float64 buffer,
+    either by the C extension or by numpy. If the rows don't all have the
+    same number of columns, they are parsed line by line instead.
+
+    If *columns* is given, only these columns (starting with 0 for the time)
+    are returned in the given order and *maxevs* is ignored. The C extension
+    then skips all other fields without converting them.
+    """
+    if columns is not None:
+        columns = numpy.asarray(columns, dtype=numpy.intp)
+        fields = numpy.unique(columns)
+        ncols = len(fields)
+    else:
+        fields = None
+        ncols = len(rows[0].split())
+        if maxevs is not None:
+            ncols = min(ncols, maxevs)
+    buf = numpy.empty((len(rows), ncols))
+    datastr = "".join(rows)
+    try:
+        if cio is not None:
+            if fields is None:
+                cio.parse_evrows(datastr, buf)
+            else:
+                cio.parse_evrows(datastr, buf, fields)
         else:
-            ev_handler(line)
+            # numpy ignores the row boundaries, so a row of another length
+            # would shift all following values. Like in the C extension,
+            # every row has to have the same number of values.
+            rowlens = set([len(row.split()) for row in rows])
+            if len(rowlens) != 1:
+                raise ValueError("Rows have different lengths.")
+            rowlen = rowlens.pop()
+            evs = numpy.fromstring(datastr, sep=" ")
+            if evs.size != len(rows)*rowlen:
+                raise ValueError("Rows contain invalid numbers.")
+            evs = evs.reshape((len(rows), rowlen))
+            buf[...] = evs[:,:ncols] if fields is None else evs[:,fields]
+    except (ValueError, IndexError):
+        evs = [_parse_evrow(row, maxevs) for row in rows]
+        if fields is None:
+            return numpy.array(evs).swapaxes(0,1)
         try:
-            line = f.next()
-        except StopIteration:
-            break
-    f.close()
+            buf[...] = [[ev[i] for i in fields] for ev in evs]
+        except IndexError:
+            raise ValueError("Rows have less than %i numbers."
+                             % (fields[-1]+1))
+    if fields is not None and \
+            (len(fields) != len(columns) or (fields != columns).any()):
+        buf = buf[:,numpy.searchsorted(fields, columns)]
+    return buf.swapaxes(0,1)
+
+def _parse_basis(header, svstr, basis):
+    """
+    Return the basis which results from the given basis block.
+
+    *Arguments*
+        * *header*
+            The "# BASIS" line preceding the Blitz array.
 
-def _open_possibly_bz2(filename):
+        * *svstr*
+            String representation of the Blitz array holding the basis states.
+
+        * *basis*
+            The basis that was valid before this block.
+    """
+    pos1 = header.find("SYS<")+4
+    pos2 = header.find(">", pos1)
+    sysnumber = int(header[pos1:pos2])
+    pos1 = header.find("TYPE<", pos2)+5
+    pos2 = header.find(">", pos1)
+    basistype = header[pos1:pos2]
+    states = _blitz2numpy(svstr)
+    BASES = pycppqed.BASES
+    if sysnumber != -1:
+        if basis is None:
+            basis = (None, None)
+        l = list(basis)
+        if basistype in BASES:
+            l[sysnumber] = BASES[basistype](states)
+        return tuple(l)
+    elif basistype in BASES:
+        return BASES[basistype](states)
+    return basis
+
+def _evcollection(rows, maxevs=None, columns=None):
+    """
+    Create an ExpectationValueCollection from a list of expectation value rows.
+
+    If *columns* is given, the collection only holds these columns.
+    """
+    if columns is None:
+        evs = _parse_evrows(rows, maxevs)
+        return expvalues.ExpectationValueCollection(evs, time=evs[0,:],
+                                                    copy=False)
+    # The time is always needed.
+    evs = _parse_evrows(rows, columns=[0] + list(columns))
+    return expvalues.ExpectationValueCollection(evs[1:], time=evs[0,:],
+                                                copy=False)
+
+class _StateVectorBuffer(object):
+    """
+    Parse state vectors directly into one (ntimes, *dims) array.
+
+    *Arguments*
+        * *size* (optional)
+            Expected number of state vectors, e.g. taken from the index. If
+            it is not known, the array grows by doubling its length.
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.array = None
+        self.times = []
+        self.bases = []
+
+    def append(self, svstr, t, basis=None):
+        n = len(self.times)
+        if self.array is None:
+            dims = _blitz_dims(svstr[:svstr.find("\n")])
+            self.array = numpy.empty((self.size or 16,) + dims,
+                                     dtype="complex")
+        elif n == len(self.array):
+            # No views of the array exist, so it can be resized in place.
+            self.array.resize((2*n,) + self.array.shape[1:], refcheck=False)
+        _blitz2numpy(svstr, out=self.array[n])
+        self.times.append(t)
+        self.bases.append(basis)
+
+    def trajectory(self):
+        """
+        Return a StateVectorTrajectory sharing the memory of the buffer.
+        """
+        n = len(self.times)
+        if self.array is None:
+            return statevector.StateVectorTrajectory([])
+        if n < len(self.array):
+            self.array.resize((n,) + self.array.shape[1:], refcheck=False)
+        array, self.array = self.array, None
+        return statevector.StateVectorTrajectory(array,
+                        time=numpy.array(self.times), bases=self.bases,
+                        copy=False)
+
+def iter_cppqed(filename, chunk_rows=1000, maxevs=None, columns=None,
+                statevectors=True, threshold=None):
     """
-    Return a bz2 file object if filename ends with bz2, else return regular file object
+    Iterate over a C++QED output file in blocks of bounded size.
+
+    *Usage*
+        >>> for evs, svs in iter_cppqed("ring.dat", chunk_rows=100):
+        ...     print evs.shape, len(svs)
+
+    *Arguments*
+        * *filename*
+            Path to the C++QED output file that should be loaded.
+
+        * *chunk_rows* (optional)
+            Maximal number of expectation value rows per block. (Default is
+            1000)
+
+        * *maxevs* (optional)
+            Maximal number of expectation values read from each row.
+
+        * *columns* (optional)
+            Only read these columns (starting with 0 for the time) of the
+            expectation value rows, in the given order. Other fields are
+            skipped without converting them. The time is available as the
+            attribute *time* in any case.
+
+        * *statevectors* (optional)
+            If False, state vectors and bases are skipped without reading
+            them into strings and *svs* is always empty. (Default is True)
+
+        * *threshold* (optional)
+            If given, the state vectors are returned as
+            :class:`pycppqed.sparsestatevector.SparseStateVector` instances
+            which only keep amplitudes with an absolute value larger than
+            this.
+
+    *Yields*
+        * *(evs, svs)*
+            *evs* is a :class:`pycppqed.expvalues.ExpectationValueCollection`
+            holding the expectation values of at most *chunk_rows* points of
+            time and *svs* is a list of
+            :class:`pycppqed.statevector.StateVector` instances that were
+            written at these points of time.
+
+    Only one block is held in memory at a time, so arbitrarily long
+    trajectories can be processed.
     """
-    if filename.endswith("bz2"):
-        return bz2.BZ2File(filename)
+    if statevectors:
+        svhandler = lambda svstr, t, basis: _statevector(
+                                    _blitz2numpy(svstr), t, basis, threshold)
     else:
-        return open(filename)
+        svhandler = None
+    return _iter_cppqed(filename, chunk_rows, maxevs, columns, svhandler)
 
-def load_cppqed(filename, maxevs=None):
+def _iter_cppqed(filename, chunk_rows, maxevs, columns, svhandler):
+    """
+    Implementation of :func:`iter_cppqed`.
+
+    Every state vector is passed as string to ``svhandler(svstr, t, basis)``
+    and the return values which are not None are yielded with the block. If
+    *svhandler* is None, state vectors are skipped.
+    """
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows has to be positive.")
+    rows = []
+    svs = []
+    basis = None
+    t = None
+    skip = () if svhandler is not None else ("sv", "basis")
+    f = _open_possibly_bz2(filename)
+    try:
+        for kind, data in _scan_cppqed(f, skip):
+            if kind == "ev":
+                if len(rows) == chunk_rows:
+                    yield _evcollection(rows, maxevs, columns), svs
+                    rows = []
+                    svs = []
+                rows.append(data)
+                t = None
+            elif kind == "sv":
+                if not rows:
+                    raise ValueError("Can't find timestamps in given file.")
+                if t is None:
+                    t = float(rows[-1].split(None, 1)[0])
+                sv = svhandler(data, t, basis)
+                if sv is not None:
+                    svs.append(sv)
+            elif kind == "basis":
+                basis = _parse_basis(data[0], data[1], basis)
+    finally:
+        f.close()
+    if rows:
+        yield _evcollection(rows, maxevs, columns), svs
+
+def load_cppqed(filename, maxevs=None, times=None, tmin=None, tmax=None,
+                columns=None, statevectors=True):
     """
     Load a C++QED output file from the given location.
 
     *Usage*
         >>> evs, svs = load_cppqed("ring.dat")
+        >>> evs, svs = load_cppqed("ring.dat", tmin=0.5, tmax=1)
+        >>> evs, svs = load_cppqed("ring.dat", times=(0.2, 0.4))
 
     *Arguments*
         * *filename*
             Path to the C++QED output file that should be loaded.
 
+        * *maxevs* (optional)
+            Maximal number of expectation values read from each row.
+
+        * *times* (optional)
+            Only load the expectation values and state vectors closest to
+            these points of time.
+
+        * *tmin*, *tmax* (optional)
+            Only load the expectation values and state vectors in this time
+            range.
+
+        * *columns* (optional)
+            Only load these columns (starting with 0 for the time) of the
+            expectation values, see :func:`iter_cppqed`.
+
+        * *statevectors* (optional)
+            If False, no state vectors are loaded. (Default is True)
+
     *Returns*
         * *evs*
             A :class:`pycppqed.expvalues.ExpectationValueCollection` holding
@@ -186,55 +599,69 @@ def load_cppqed(filename, maxevs=None):
         * *svs*
             A :class:`pycppqed.statevector.StateVectorTrajectory` holding all
             state vectors and information about the calculated system.
+
+    Files ending with .trajbin are binary trajectory files as written by
+    :func:`convert_cppqed`. They are memory mapped and the returned arrays
+    are read-only views into the file.
+
+    If a selection is given, the sidecar index of the file (see
+    :func:`build_index`) is used to read only the selected parts. It is
+    built first if it doesn't exist.
+
+    See :func:`iter_cppqed` for reading files that don't fit into memory.
     """
-    # Define handlers for state vector strings and expectation values strings.
-    head = []
-    evs = [] # Expectation values
-    svs = [] # State vectors
-    basis = [None] # Holds last basis vector
-    def ev_handler(evstr):
-        parts = evstr.split("\t")
-        ev = []
-        for part in parts:
-            ev.extend(map(float, part.split()))
-        if not maxevs is None: ev = ev[:maxevs]
-        evs.append(ev)
-    def sv_handler(svstr):
-        t = evs[-1][0]
-        data = _blitz2numpy(svstr)
-        svs.append(statevector.StateVector(data, t, basis=basis[0]))
-    def basis_handler(header, svstr):
-        pos1 = header.find("SYS<")+4
-        pos2 = header.find(">", pos1)
-        sysnumber = int(header[pos1:pos2])
-        pos1 = header.find("TYPE<", pos2)+5
-        pos2 = header.find(">", pos1)
-        basistype = header[pos1:pos2]
-        states = _blitz2numpy(svstr)
-        BASES = pycppqed.BASES
-        if sysnumber != -1:
-            if basis[0] is None:
-                basis[0] = (None, None)
-            l = list(basis[0])
-            if basistype in BASES:
-                l[sysnumber] = BASES[basistype](states)
-            else:
-                states
-            basis[0] = tuple(l)
+    selection = times is not None or tmin is not None or tmax is not None
+    if filename.endswith(".trajbin"):
+        evs, svs = _load_trajbin(filename)
+        if columns is not None:
+            evs = expvalues.ExpectationValueCollection(
+                            numpy.asarray(evs)[list(columns)], time=evs.time,
+                            copy=False)
+        elif maxevs is not None:
+            evs = expvalues.ExpectationValueCollection(
+                            numpy.asarray(evs)[:maxevs], time=evs.time,
+                            copy=False)
+        if not statevectors:
+            svs = statevector.StateVectorTrajectory([])
+        if selection:
+            evi = _select(evs.time, times, tmin, tmax)
+            evs = expvalues.ExpectationValueCollection(
+                            numpy.asarray(evs)[:,evi], time=evs.time[evi],
+                            copy=False)
+            svi = _select(svs.time, times, tmin, tmax)
+            svs = statevector.StateVectorTrajectory(numpy.asarray(svs)[svi],
+                                    time=svs.time[svi], copy=False)
+        return evs, svs
+    if selection:
+        return _load_selection(filename, maxevs, times, tmin, tmax, columns,
+                               statevectors)
+    evblocks = []
+    times = []
+    svhandler = None
+    if statevectors:
+        # The index tells how many state vectors there are, if it exists.
+        index = load_index(filename)
+        if index is not None and "svtimes" in index:
+            svbuffer = _StateVectorBuffer(len(index["svtimes"]) or None)
         else:
-            if basistype in BASES:
-                basis[0] = BASES[basistype](states)
-            else:
-                states
-    _parse_cppqed(filename, head.append, ev_handler, sv_handler, basis_handler)
-    evs = numpy.array(evs).swapaxes(0,1)
-    svstraj = statevector.StateVectorTrajectory(svs)
-    time = evs[0,:]
-    titles = []
-    evstraj = expvalues.ExpectationValueCollection(evs, time=time, copy=False)
+            svbuffer = _StateVectorBuffer()
+        svhandler = svbuffer.append
+    for evs, _ in _iter_cppqed(filename, 10000, maxevs, columns, svhandler):
+        evblocks.append(numpy.asarray(evs))
+        times.append(evs.time)
+    if not evblocks:
+        raise ValueError("Can't find expectation values in given file.")
+    evs = numpy.concatenate(evblocks, axis=1)
+    del evblocks
+    if statevectors:
+        svstraj = svbuffer.trajectory()
+    else:
+        svstraj = statevector.StateVectorTrajectory([])
+    evstraj = expvalues.ExpectationValueCollection(evs,
+                    time=numpy.concatenate(times), copy=False)
     return evstraj, svstraj
 
-def load_statevector(filename):
+def load_statevector(filename, threshold=None):
     """
     Load a C++QED state vector file from the given location.
 
@@ -248,6 +675,12 @@ def load_statevector(filename):
             a binary file and a :class:`IOError` is raised if the required `ciobin` module is not
             available.
 
+        * *threshold* (optional)
+            If given, only amplitudes with an absolute value larger than
+            this are kept and a
+            :class:`pycppqed.sparsestatevector.SparseStateVector` is
+            returned.
+
     *Returns*
         * *sv*
             A :class:`pycppqed.statevector.StateVector` instance.
@@ -255,7 +688,7 @@ def load_statevector(filename):
     if filename.endswith(".svbin"):
         if ciobin:
             (ba,t,_) = ciobin.parse(open(filename,'rb').read())
-            return statevector.StateVector(ba,t)
+            return _statevector(ba, t, threshold=threshold)
         else:
             raise IOError("C++ extension to support binary statevector files not available...")
     f = _open_possibly_bz2(filename)
@@ -270,7 +703,18 @@ def load_statevector(filename):
             raise ValueError("Not a valid statevector file.")
     time = commentstr[2:commentstr.find(" ", 3)]
     ba = _blitz2numpy(datastr)
-    return statevector.StateVector(ba, float(time))
+    return _statevector(ba, float(time), threshold=threshold)
+
+def _statevector(array, time, basis=None, threshold=None):
+    """
+    Return a StateVector, or a SparseStateVector if a threshold is given.
+    """
+    if threshold is None:
+        return statevector.StateVector(array, time, basis=basis)
+    sv = sparsestatevector.fromdense(array, threshold)
+    sv.time = time
+    sv.basis = basis
+    return sv
 
 def save_statevector(filename, sv):
     """
@@ -285,6 +729,8 @@ def save_statevector(filename, sv):
             Path to the location where the StateVector should be saved to.
             If the filename ends with .svbin, a binary state vector file is written
             and a :class:`IOError` is raised if the required `ciobin` module is not available.
+            If it ends with the suffix of a compression codec, e.g. .bz2,
+            the file is compressed (see :mod:`pycppqed.compression`).
 
         *sv*
             A :class:`pycppqed.statevector.StateVector` instance.
@@ -295,10 +741,12 @@ def save_statevector(filename, sv):
             return
         else:
             raise IOError("C++ extension to support binary statevector files not available...")
-    f = open(filename, "w")
-    f.write(_numpy2blitz(sv))
-    f.write("\n# %s 1\n" % sv.time)
-    f.close()
+    f = _open_possibly_bz2(filename, "w")
+    try:
+        _write_blitz(f, sv)
+        f.write("\n# %s 1\n" % sv.time)
+    finally:
+        f.close()
 
 def split_cppqed(readpath, writepath, header=True):
     """
@@ -322,32 +770,645 @@ def split_cppqed(readpath, writepath, header=True):
     while the state vectors are saved to the same directory with the
     naming convention ``{path}_{time}.sv``.
     """
-    head = []
-    evs = [] # Expectation values
-    def sv_handler(svstr):
-        if not evs:
-            raise ValueError("Can't find timestamps in given file.")
-        ev = evs[-1]
-        t = float(ev[:ev.find(" ")])
-        f = open("%s_%06f.sv" % (writepath, t), "w")
-        if header:
-            f.write("# %s 1\n" % t)
-        f.write(svstr)
-        f.close()
-
-    def basis_handler(name, svstr):
-        if not evs:
-            raise ValueError("Can't find timestamps in given file.")
-        ev = evs[-1]
-        t = float(ev[:ev.find(" ")])
-        f = open("%s_%06f_basis.sv" % (writepath, t), "w")
+    def write_sv(path, t, svstr):
+        f = open(path, "w")
         if header:
             f.write("# %s 1\n" % t)
         f.write(svstr)
         f.close()
-    _parse_cppqed(readpath, head.append, evs.append, sv_handler, basis_handler)
+    t = None
+    r = _open_possibly_bz2(readpath)
     f = open(writepath, "w")
-    f.write("".join(head))
-    f.write("\n\n%s\n" % "\n".join(evs) )
+    try:
+        for kind, data in _scan_cppqed(r):
+            if kind == "head":
+                f.write(data)
+                f.write("\n\n")
+            elif kind == "ev":
+                t = float(data[:data.find(" ")])
+                f.write(data)
+                f.write("\n")
+            elif t is None:
+                raise ValueError("Can't find timestamps in given file.")
+            elif kind == "sv":
+                write_sv("%s_%06f.sv" % (writepath, t), t, data)
+            elif kind == "basis":
+                write_sv("%s_%06f_basis.sv" % (writepath, t), t, data[1])
+    finally:
+        f.close()
+        r.close()
+
+_TRAJBIN_MAGIC = "PYCPPQED TRAJ\n\0\0"
+_TRAJBIN_ALIGN = 64
+
+def _trajbin_layout(evshape, svshape, head):
+    """
+    Return the header dictionary of a binary trajectory file.
+
+    The file starts with a 16 byte magic string, followed by the length of
+    the header as little endian uint64 and the header itself, which is the
+    repr of a dictionary. Then the expectation values (float64, shape
+    *evshape*), the times of the state vectors (float64) and the state
+    vectors (complex128, shape *svshape*) follow, each aligned to 64 bytes.
+    """
+    def align(n):
+        return -(-n//_TRAJBIN_ALIGN)*_TRAJBIN_ALIGN
+    header = {
+        "version": 1,
+        "head": head,
+        "evshape": tuple(evshape),
+        "svshape": tuple(svshape),
+        "evoffset": 0,
+        "svtimeoffset": 0,
+        "svoffset": 0,
+        }
+    # Use upper bounds for the offsets to determine the space needed by the
+    # header.
+    for key in ("evoffset", "svtimeoffset", "svoffset"):
+        header[key] = 10**15
+    offset = align(len(_TRAJBIN_MAGIC) + 8 + len(repr(header)))
+    header["evoffset"] = offset
+    offset = align(offset + 8*numpy.prod(evshape))
+    header["svtimeoffset"] = offset
+    offset = align(offset + 8*svshape[0])
+    header["svoffset"] = offset
+    return header
+
+def _create_trajbin(filename, evshape, svshape, head=""):
+    """
+    Create a binary trajectory file and return memory maps of its contents.
+
+    *Returns*
+        * *(evs, svtimes, svs)*
+            Writeable :class:`numpy.memmap` instances.
+    """
+    header = _trajbin_layout(evshape, svshape, head)
+    headerstr = repr(header)
+    f = open(filename, "wb")
+    f.write(_TRAJBIN_MAGIC)
+    f.write(numpy.array(len(headerstr), dtype="<u8").tostring())
+    f.write(headerstr)
+    f.write("\0"*(header["evoffset"] - f.tell()))
     f.close()
+    return _map_trajbin(filename, header, "r+")
+
+def _map_trajbin(filename, header, mode):
+    """
+    Return memory maps of the data sections of a binary trajectory file.
+    """
+    def memmap(dtype, offset, shape):
+        if not numpy.prod(shape):
+            return numpy.zeros(shape, dtype=dtype)
+        return numpy.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                            shape=shape)
+    svshape = header["svshape"]
+    if mode == "r+":
+        # Extend the file to its full size.
+        size = int(header["svoffset"] + 16*numpy.prod(svshape))
+        f = open(filename, "r+b")
+        f.truncate(size)
+        f.close()
+    evs = memmap("<f8", header["evoffset"], header["evshape"])
+    svtimes = memmap("<f8", header["svtimeoffset"], svshape[:1])
+    svs = memmap("<c16", header["svoffset"], svshape)
+    return evs, svtimes, svs
+
+def _read_trajbin_header(filename):
+    """
+    Read the header dictionary of a binary trajectory file.
+    """
+    f = open(filename, "rb")
+    try:
+        if f.read(len(_TRAJBIN_MAGIC)) != _TRAJBIN_MAGIC:
+            raise ValueError("Not a valid binary trajectory file.")
+        length = int(numpy.fromstring(f.read(8), dtype="<u8")[0])
+        header = ast.literal_eval(f.read(length))
+    finally:
+        f.close()
+    if header.get("version") != 1:
+        raise ValueError("Unsupported binary trajectory file version.")
+    return header
+
+def _load_trajbin(filename):
+    """
+    Load a binary trajectory file without copying its contents.
+    """
+    header = _read_trajbin_header(filename)
+    evs, svtimes, svs = _map_trajbin(filename, header, "r")
+    evstraj = expvalues.ExpectationValueCollection(evs, time=evs[0,:],
+                                                   copy=False)
+    svstraj = statevector.StateVectorTrajectory(svs, time=svtimes,
+                                                copy=False)
+    return evstraj, svstraj
+
+def save_trajbin(filename, evs, svs, head=""):
+    """
+    Save expectation values and state vectors to a binary trajectory file.
+
+    *Usage*
+        >>> evs, svs = load_cppqed("ring.dat")
+        >>> save_trajbin("ring.trajbin", evs, svs)
+
+    *Arguments*
+        * *filename*
+            Path where the binary trajectory file should be saved to. It
+            should end with .trajbin, so that :func:`load_cppqed` recognizes
+            it.
+
+        * *evs*
+            A :class:`pycppqed.expvalues.ExpectationValueCollection`.
+
+        * *svs*
+            A :class:`pycppqed.statevector.StateVectorTrajectory`.
+
+        * *head* (optional)
+            The comment section of the C++QED output file.
+    """
+    svshape = (len(svs),) + tuple(numpy.shape(svs)[1:])
+    bevs, bsvtimes, bsvs = _create_trajbin(filename, numpy.shape(evs),
+                                           svshape, head)
+    bevs[...] = evs
+    if len(svs):
+        bsvtimes[...] = svs.time
+        bsvs[...] = svs
+    del bevs, bsvtimes, bsvs
+
+def convert_cppqed(readpath, writepath=None):
+    """
+    Convert a C++QED output file into a binary trajectory file.
+
+    *Usage*
+        >>> convert_cppqed("ring.dat.bz2")
+        >>> evs, svs = load_cppqed("ring.dat.trajbin")
+
+    *Arguments*
+        * *readpath*
+            Path to the C++QED output file that should be converted. It can be
+            compressed with any codec of :mod:`pycppqed.compression`.
+
+        * *writepath* (optional)
+            Path where the binary trajectory file should be saved to. (Default
+            is *readpath* with the compression suffix replaced by .trajbin)
+
+    *Returns*
+        * *writepath*
+            Path of the binary trajectory file.
+
+    The file is read twice: once to determine the size of the expectation
+    values and state vectors and once to write them directly into the
+    memory mapped binary file. Basis information is not kept.
+    """
+    if writepath is None:
+        writepath = compression.strip_suffix(readpath) + ".trajbin"
+    nrows = 0
+    ncols = None
+    nsv = 0
+    dims = None
+    f = _open_possibly_bz2(readpath)
+    try:
+        for kind, data in _scan_cppqed(f):
+            if kind == "head":
+                head = data
+            elif kind == "ev":
+                n = len(data.split())
+                if ncols is None:
+                    ncols = n
+                elif n != ncols:
+                    raise ValueError("Expectation value rows have different"
+                                     " lengths.")
+                nrows += 1
+            elif kind == "sv":
+                d = _blitz_dims(data[:data.find("\n")])
+                if dims is None:
+                    dims = d
+                elif d != dims:
+                    raise ValueError("State vectors have different"
+                                     " dimensions.")
+                nsv += 1
+    finally:
+        f.close()
+    if ncols is None:
+        raise ValueError("Can't find expectation values in given file.")
+    svshape = (nsv,) + (dims or ())
+    evs, svtimes, svs = _create_trajbin(writepath, (ncols, nrows), svshape,
+                                        head)
+    row = 0
+    i = 0
+    for block, blocksvs in iter_cppqed(readpath):
+        evs[:,row:row+block.shape[1]] = block
+        row += block.shape[1]
+        for sv in blocksvs:
+            svtimes[i] = sv.time
+            svs[i] = sv
+            i += 1
+    del evs, svtimes, svs
+    return writepath
+
+def index_path(filename):
+    """
+    Return the path of the sidecar index file belonging to filename.
+    """
+    return filename + ".index.npz"
+
+def _file_key(filename):
+    """
+    Return size and modification time of the given file.
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+def load_index(filename):
+    """
+    Load the sidecar index of a C++QED output file.
+
+    *Arguments*
+        * *filename*
+            Path to the C++QED output file (not to the index itself).
+
+    *Returns*
+        * *index*
+            A dictionary with the entries of the index, or None if there is
+            no index or the file was changed after the index was written.
+
+    The index is stored next to the file as ``{filename}.index.npz`` and
+    remembers the size and modification time of the file it describes.
+    """
+    path = index_path(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        npz = numpy.load(path)
+        index = dict((key, npz[key]) for key in npz.files)
+        npz.close()
+    except (IOError, ValueError, KeyError):
+        return None
+    size, mtime = _file_key(filename)
+    # Copying the file with its modification time may lose some precision.
+    if int(index.get("size", -1)) != size or \
+            abs(float(index.get("mtime", -1)) - mtime) > 1e-3:
+        return None
+    return index
+
+def save_index(filename, **entries):
+    """
+    Write entries into the sidecar index of a C++QED output file.
+
+    *Arguments*
+        * *filename*
+            Path to the C++QED output file (not to the index itself).
 
+        * *entries*
+            Arrays or scalars that should be saved. Entries of a still valid
+            existing index are kept.
+
+    Nothing is written if the directory is not writable.
+    """
+    index = load_index(filename) or {}
+    index.update(entries)
+    index["size"], index["mtime"] = _file_key(filename)
+    path = index_path(filename)
+    # The temporary file is hidden and can't be mistaken for a trajectory.
+    try:
+        fd, tmppath = tempfile.mkstemp(prefix="." + os.path.basename(path),
+                                       suffix=".tmp",
+                                       dir=os.path.dirname(path) or ".")
+    except (IOError, OSError):
+        return
+    f = os.fdopen(fd, "wb")
+    try:
+        numpy.savez(f, **index)
+    finally:
+        f.close()
+    os.chmod(tmppath, os.stat(filename).st_mode & 0777)
+    os.rename(tmppath, path)
+
+def _is_evrow(line):
+    """
+    Return True if the given line is an expectation value row.
+    """
+    s = line.lstrip()
+    return bool(s) and s[0] not in "#([\n"
+
+def _last_evrow(chunks):
+    """
+    Return the last complete expectation value row of a file.
+
+    *Arguments*
+        * *chunks*
+            An iterable returning consecutive pieces of the file in reversed
+            order, i.e. starting at the end of the file.
+    """
+    rest = None
+    for chunk in chunks:
+        if rest is None:
+            # A line without newline at the end is not written completely.
+            cut = chunk.rfind("\n")
+            if cut == -1:
+                continue
+            lines = chunk[:cut].split("\n")
+            lines.append("")
+        else:
+            lines = (chunk + rest).split("\n")
+        rest = lines[0]
+        for line in reversed(lines[1:]):
+            if _is_evrow(line):
+                return line
+    if rest is not None and _is_evrow(rest):
+        return rest
+    return None
+
+def _reversed_chunks(filename, blocksize=2**16):
+    """
+    Read an uncompressed file backwards in pieces.
+    """
+    f = open(filename, "rb")
+    try:
+        f.seek(0, 2)
+        pos = f.tell()
+        while pos > 0:
+            start = max(0, pos - blocksize)
+            f.seek(start)
+            yield f.read(pos - start)
+            pos = start
+    finally:
+        f.close()
+
+def _reversed_bz2_chunks(filename):
+    """
+    Decompress a multi-stream bzip2 file backwards, one stream at a time.
+    """
+    f = open(filename, "rb")
+    try:
+        f.seek(0, 2)
+        stop = f.tell()
+        for offset in parallelbz2.find_streams_reversed(filename):
+            f.seek(offset)
+            yield parallelbz2._decompress(f.read(stop - offset))[0]
+            stop = offset
+    finally:
+        f.close()
+
+def last_time(filename):
+    """
+    Return the time of the last expectation value row of a C++QED file.
+
+    *Usage*
+        >>> t = last_time("ring.dat.bz2")
+
+    *Arguments*
+        * *filename*
+            Path to the C++QED output file.
+
+    *Returns*
+        * *t*
+            The time of the last complete expectation value row, or None if
+            the file doesn't contain any.
+
+    Uncompressed files are read backwards from the end. For compressed files
+    the time is taken from the sidecar index (see :func:`load_index`). If
+    there is none, bzip2 files written as several streams are decompressed
+    backwards stream by stream and other files are read completely; the
+    result is then stored in the index.
+    """
+    codec = compression.codec_for_filename(filename)
+    if codec is None:
+        row = _last_evrow(_reversed_chunks(filename))
+        return None if row is None else float(row.split(None, 1)[0])
+    index = load_index(filename)
+    if index is not None and "last_time" in index:
+        t = float(index["last_time"])
+        return None if numpy.isnan(t) else t
+    row = None
+    if codec.name == "bz2" and \
+            next(parallelbz2.find_streams_reversed(filename), 0) > 0:
+        row = _last_evrow(_reversed_bz2_chunks(filename))
+    else:
+        f = compression.open(filename)
+        try:
+            for kind, data in _scan_cppqed(f, ("sv", "basis")):
+                if kind == "ev" and data.endswith("\n"):
+                    row = data
+        finally:
+            f.close()
+    t = None if row is None else float(row.split(None, 1)[0])
+    save_index(filename, last_time=numpy.nan if t is None else t)
+    return t
+
+def build_index(filename):
+    """
+    Build the sidecar index of a C++QED output file.
+
+    *Usage*
+        >>> index = build_index("ring.dat.bz2")
+        >>> index["svtimes"]
+
+    *Arguments*
+        * *filename*
+            Path to the C++QED output file.
+
+    *Returns*
+        * *index*
+            A dictionary with the following arrays:
+
+            * *evtimes*, *evoffsets*: Times and positions of the expectation
+              value rows.
+            * *svtimes*, *svoffsets*: Times and positions of the state
+              vectors.
+            * *basisoffsets*: Positions of the basis blocks.
+            * *streamoffsets*, *streamstarts*: Positions of the bzip2 streams
+              in the compressed file and in the decompressed data.
+            * *last_time*: See :func:`last_time`.
+
+            Positions are byte offsets in the decompressed data.
+
+    The file is read once and the index is saved next to it (see
+    :func:`load_index`). :func:`load_cppqed` uses it to read only the
+    requested points of time.
+    """
+    codec = compression.codec_for_filename(filename)
+    if codec is not None and codec.name == "bz2":
+        # Decompress stream by stream to find out where they start.
+        streamoffsets = parallelbz2.find_streams(filename) or [0]
+        f = parallelbz2.ParallelBZ2File(filename, segmentsize=0,
+                                        streams=streamoffsets)
+    else:
+        streamoffsets = [0]
+        f = _open_possibly_bz2(filename)
+    evtimes = []
+    evoffsets = []
+    svtimes = []
+    svoffsets = []
+    basisoffsets = []
+    t = numpy.nan
+    reader = _BlockReader(f)
+    try:
+        while True:
+            pos = reader.tell()
+            line = reader.readline()
+            if not line:
+                break
+            if line.startswith("# BASIS") or line.startswith("("):
+                # Blocks are only indexed if they are complete.
+                if reader.readblock(keep=False) is None:
+                    break
+                if line.startswith("("):
+                    svtimes.append(t)
+                    svoffsets.append(pos)
+                else:
+                    basisoffsets.append(pos)
+            elif _is_evrow(line) and line.endswith("\n"):
+                t = float(line.split(None, 1)[0])
+                evtimes.append(t)
+                evoffsets.append(pos)
+        streamstarts = getattr(f, "segment_starts", [0])
+    finally:
+        f.close()
+    index = {
+        "evtimes": numpy.array(evtimes, dtype=float),
+        "evoffsets": numpy.array(evoffsets, dtype=numpy.int64),
+        "svtimes": numpy.array(svtimes, dtype=float),
+        "svoffsets": numpy.array(svoffsets, dtype=numpy.int64),
+        "basisoffsets": numpy.array(basisoffsets, dtype=numpy.int64),
+        "streamoffsets": numpy.array(streamoffsets, dtype=numpy.int64),
+        "streamstarts": numpy.array(streamstarts, dtype=numpy.int64),
+        "last_time": evtimes[-1] if evtimes else numpy.nan,
+        }
+    save_index(filename, **index)
+    return index
+
+def _nearest(a, values):
+    """
+    Return the indices of the entries of the sorted array a that are closest
+    to the given values.
+    """
+    if len(a) < 2:
+        return numpy.zeros(len(values) if len(a) else 0, dtype=int)
+    i = numpy.clip(numpy.searchsorted(a, values), 1, len(a)-1)
+    return i - (numpy.abs(values - a[i-1]) <= numpy.abs(values - a[i]))
+
+def _select(timeline, times=None, tmin=None, tmax=None):
+    """
+    Return the sorted indices of the entries of timeline that are selected by
+    the given times or the time range [tmin, tmax].
+    """
+    mask = numpy.ones(len(timeline), dtype=bool)
+    if tmin is not None:
+        mask &= timeline >= tmin
+    if tmax is not None:
+        mask &= timeline <= tmax
+    if times is not None:
+        nearest = numpy.zeros(len(timeline), dtype=bool)
+        nearest[_nearest(timeline, numpy.atleast_1d(times))] = True
+        mask &= nearest
+    return numpy.flatnonzero(mask)
+
+
+class _IndexedReader(object):
+    """
+    Read a possibly compressed C++QED file at given positions.
+
+    The positions are byte offsets in the decompressed data and have to be
+    visited in increasing order. Compressed files are skipped forward by
+    decompressing, or by starting at a later bzip2 stream.
+    """
+    def __init__(self, filename, index):
+        self.filename = filename
+        self.codec = compression.codec_for_filename(filename)
+        self.streamoffsets = index.get("streamoffsets", [0])
+        self.streamstarts = index.get("streamstarts", [0])
+        self.f = None
+        self.pos = 0
+
+    def seek(self, offset):
+        if self.codec is None:
+            if self.f is None:
+                self.f = open(self.filename, "rb")
+            self.f.seek(offset)
+            self.pos = offset
+            return
+        k = numpy.searchsorted(self.streamstarts, offset, "right") - 1
+        if self.f is None or offset < self.pos or \
+                self.streamstarts[k] > self.pos:
+            self.close()
+            if self.codec.name == "bz2":
+                self.f = parallelbz2.ParallelBZ2File(self.filename,
+                                streams=self.streamoffsets[k:])
+                self.pos = self.streamstarts[k]
+            else:
+                self.f = _open_possibly_bz2(self.filename)
+                self.pos = 0
+        while self.pos < offset:
+            data = self.f.read(min(2**20, offset - self.pos))
+            if not data:
+                raise IOError("Index of %s doesn't fit to the file."
+                              % self.filename)
+            self.pos += len(data)
+
+    def readline(self):
+        line = self.f.readline()
+        self.pos += len(line)
+        return line
+
+    def readblock(self):
+        """
+        Read a Blitz array starting at the current position.
+        """
+        buf = []
+        while True:
+            line = self.readline()
+            if not line:
+                raise IOError("Index of %s doesn't fit to the file."
+                              % self.filename)
+            buf.append(line)
+            if line.endswith(" ]\n"):
+                return "".join(buf)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def _load_selection(filename, maxevs=None, times=None, tmin=None, tmax=None,
+                    columns=None, statevectors=True):
+    """
+    Load the selected points of time of a C++QED file using its index.
+    """
+    index = load_index(filename)
+    if index is None or "evoffsets" not in index:
+        index = build_index(filename)
+    evi = _select(index["evtimes"], times, tmin, tmax)
+    if statevectors:
+        svi = _select(index["svtimes"], times, tmin, tmax)
+    else:
+        svi = numpy.zeros(0, dtype=int)
+    if not len(evi):
+        raise ValueError("Can't find expectation values in given time range.")
+    # Visit everything in the order of the file.
+    svoffsets = index["svoffsets"][svi]
+    events = [(offset, "ev", None) for offset in index["evoffsets"][evi]]
+    events.extend([(offset, "sv", t) for offset, t
+                   in zip(svoffsets, index["svtimes"][svi])])
+    if len(svoffsets):
+        events.extend([(offset, "basis", None)
+                       for offset in index["basisoffsets"]
+                       if offset < svoffsets[-1]])
+    events.sort()
+    rows = []
+    svbuffer = _StateVectorBuffer(len(svi) or None)
+    basis = None
+    reader = _IndexedReader(filename, index)
+    try:
+        for offset, kind, t in events:
+            reader.seek(offset)
+            if kind == "ev":
+                rows.append(reader.readline())
+            elif kind == "sv":
+                svbuffer.append(reader.readblock(), t, basis)
+            else:
+                header = reader.readline()
+                basis = _parse_basis(header, reader.readblock(), basis)
+    finally:
+        reader.close()
+    evstraj = _evcollection(rows, maxevs, columns)
+    return evstraj, svbuffer.trajectory()
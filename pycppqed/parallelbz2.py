@@ -0,0 +1,272 @@
+"""
+This module provides a reader for bzip2 files that decompresses in parallel.
+
+Parallel compressors like pbzip2 write files that consist of many independent
+bzip2 streams. :class:`ParallelBZ2File` splits such files at the stream
+boundaries and decompresses the pieces in a pool of processes, while the
+reading process only has to split the result into lines. Files with only one
+stream (e.g. written by bzip2) are decompressed incrementally in the reading
+process.
+
+Note that :class:`bz2.BZ2File` of Python 2 only reads the first stream of a
+file, so multi-stream files can only be read completely with this module.
+"""
+
+import atexit
+import bz2
+import multiprocessing
+from compression import ChunkedFile
+
+# A bzip2 stream starts with "BZh", the block size and the magic number of
+# the first block.
+_STREAM_MAGIC = "1AY&SY"
+_HEADER_LENGTH = 4 + len(_STREAM_MAGIC)
+
+# The process pools shared between all readers, by number of processes.
+_pools = {}
+
+
+def _find_headers(buf):
+    """
+    Return the offsets of all complete bzip2 stream headers in buf.
+    """
+    offsets = []
+    i = buf.find("BZh")
+    while i != -1 and i + _HEADER_LENGTH <= len(buf):
+        if buf[i+3] in "123456789" and \
+                buf[i+4:i+_HEADER_LENGTH] == _STREAM_MAGIC:
+            offsets.append(i)
+        i = buf.find("BZh", i+1)
+    return offsets
+
+def find_streams(filename, blocksize=2**22):
+    """
+    Return the offsets of all bzip2 streams in the given file.
+
+    *Arguments*
+        * *filename*
+            Path to a bzip2 compressed file.
+
+        * *blocksize* (optional)
+            The file is searched in pieces of this size.
+    """
+    offsets = []
+    f = open(filename, "rb")
+    try:
+        pos = 0
+        tail = ""
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            buf = tail + data
+            start = pos - len(tail)
+            offsets.extend([start + i for i in _find_headers(buf)])
+            tail = buf[-_HEADER_LENGTH+1:]
+            pos += len(data)
+    finally:
+        f.close()
+    return offsets
+
+def find_streams_reversed(filename, blocksize=2**20):
+    """
+    Iterate over the offsets of the bzip2 streams in the given file, starting
+    at the end of the file.
+
+    Only as much of the file is read as is needed to find the next offset.
+    """
+    f = open(filename, "rb")
+    try:
+        f.seek(0, 2)
+        pos = f.tell()
+        tail = ""
+        while pos > 0:
+            start = max(0, pos - blocksize)
+            f.seek(start)
+            buf = f.read(pos - start) + tail
+            for i in reversed(_find_headers(buf)):
+                yield start + i
+            tail = buf[:_HEADER_LENGTH-1]
+            pos = start
+    finally:
+        f.close()
+
+def _decompress(data, decompressor=None):
+    """
+    Decompress data which may contain several bzip2 streams.
+
+    *Returns*
+        * *(result, decompressor)*
+            The decompressed data and the decompressor which has to be used
+            for the data following.
+    """
+    if decompressor is None:
+        decompressor = bz2.BZ2Decompressor()
+    result = []
+    while data:
+        try:
+            result.append(decompressor.decompress(data))
+        except EOFError:
+            # The last stream ended exactly at the end of the previous data.
+            decompressor = bz2.BZ2Decompressor()
+            continue
+        data = decompressor.unused_data
+        if data:
+            decompressor = bz2.BZ2Decompressor()
+    return "".join(result), decompressor
+
+def _decompress_segment(args):
+    """
+    Read and decompress the bytes start:stop of the given file.
+    """
+    filename, start, stop = args
+    f = open(filename, "rb")
+    try:
+        f.seek(start)
+        data = f.read(stop - start)
+    finally:
+        f.close()
+    return _decompress(data)[0]
+
+def _get_pool(processes):
+    """
+    Return a process pool with the given number of processes, which is
+    shared between all readers asking for this number.
+    """
+    pool = _pools.get(processes)
+    if pool is None:
+        pool = _pools[processes] = multiprocessing.Pool(processes)
+    return pool
+
+def _close_pools():
+    """
+    Close the shared process pools and wait for their workers.
+    """
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
+
+atexit.register(_close_pools)
+
+
+class ParallelBZ2File(ChunkedFile):
+    """
+    A read-only file object for bzip2 files with parallel decompression.
+
+    *Usage*
+        >>> f = ParallelBZ2File("ring.dat.bz2")
+        >>> for line in f:
+        ...     pass
+        >>> f.close()
+
+    *Arguments*
+        * *filename*
+            Path to the bzip2 compressed file.
+
+        * *processes* (optional)
+            Number of worker processes. (Default is the number of CPUs)
+
+        * *segmentsize* (optional)
+            Consecutive streams are combined into segments of at least this
+            many compressed bytes, which are the units of work for the worker
+            processes. (Default is 8 MB)
+
+        * *streams* (optional)
+            Offsets of the streams that should be decompressed, e.g. to start
+            in the middle of the file. (Default are all streams of the file)
+
+        * *lookahead* (optional)
+            Maximal number of segments which are decompressed ahead of the
+            reading position. (Default is *processes* + 1)
+
+    At most *lookahead* decompressed segments are held in memory at once,
+    i.e. about *lookahead* times *segmentsize* times the compression ratio
+    (often 5 to 10 for C++QED output). If the file has
+    only one segment, if only one process is available or if it is read
+    inside of a daemonic process (e.g. a worker of another pool), everything
+    is decompressed in the reading process.
+
+    The attribute *segment_starts* lists the positions in the decompressed
+    data (relative to the first stream) at which the segments begin, as far
+    as they have been read.
+    """
+    def __init__(self, filename, processes=None, segmentsize=2**23,
+                 streams=None, lookahead=None):
+        if streams is None:
+            offsets = find_streams(filename)
+            if not offsets or offsets[0] != 0:
+                offsets.insert(0, 0)
+        else:
+            offsets = list(streams)
+        f = open(filename, "rb")
+        f.seek(0, 2)
+        size = f.tell()
+        f.close()
+        bounds = offsets[:1]
+        for offset in offsets[1:]:
+            if offset - bounds[-1] >= segmentsize:
+                bounds.append(offset)
+        bounds.append(size)
+        self.segments = zip(bounds[:-1], bounds[1:])
+        self.segment_starts = []
+        self._decompressed = 0
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        parallel = len(self.segments) > 1 and processes > 1 and \
+                   not multiprocessing.current_process().daemon
+        if lookahead is None:
+            lookahead = processes + 1
+        if parallel:
+            chunks = self._parallel_chunks(filename, processes,
+                                           max(lookahead, 1))
+        else:
+            chunks = self._serial_chunks(filename)
+        ChunkedFile.__init__(self, filename, chunks)
+
+    def _serial_chunks(self, filename, chunksize=2**20):
+        """
+        Decompress the file incrementally in the reading process.
+        """
+        f = open(filename, "rb")
+        try:
+            for start, stop in self.segments:
+                self.segment_starts.append(self._decompressed)
+                f.seek(start)
+                decompressor = None
+                remaining = stop - start
+                while remaining > 0:
+                    data = f.read(min(chunksize, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    result, decompressor = _decompress(data, decompressor)
+                    if result:
+                        self._decompressed += len(result)
+                        yield result
+        finally:
+            f.close()
+
+    def _parallel_chunks(self, filename, processes, lookahead):
+        """
+        Decompress the segments of the file in a process pool, with at most
+        *lookahead* segments submitted but not yet read.
+        """
+        pool = _get_pool(processes)
+        window = lookahead
+        tasks = [(filename, start, stop) for start, stop in self.segments]
+        pending = []
+        for task in tasks:
+            pending.append(pool.apply_async(_decompress_segment, (task,)))
+            if len(pending) >= window:
+                yield self._segment(pending.pop(0).get())
+        while pending:
+            yield self._segment(pending.pop(0).get())
+
+    def _segment(self, data):
+        """
+        Remember where the given decompressed segment starts.
+        """
+        self.segment_starts.append(self._decompressed)
+        self._decompressed += len(data)
+        return data
@@ -0,0 +1,265 @@
+"""
+This module provides a compact representation for state vectors with few
+significant amplitudes.
+
+States like coherent states or Fock states in a large Fock space have most
+of their amplitudes below the numerical precision. A
+:class:`SparseStateVector` only stores the significant amplitudes as flat
+indices and values and calculates norms and expectation values from these.
+
+Most important are:
+    * :class:`SparseStateVector`
+    * :func:`fromdense`
+"""
+
+import numpy
+import expvalues
+import statevector
+
+
+class SparseStateVector(object):
+    r"""
+    A state vector which only stores its significant amplitudes.
+
+    *Usage*
+        >>> sv = SparseStateVector((100,), (3, 4), (0.6, 0.8))
+        >>> print sv
+        SparseStateVector(100, 2 amplitudes)
+        >>> sv = fromdense(initialconditions.coherent(2, 200))
+
+    *Arguments*
+        * *shape*
+            The dimensions of the full state vector.
+
+        * *indices*
+            The indices of the stored amplitudes into the flattened state
+            vector, in increasing order.
+
+        * *values*
+            The stored amplitudes.
+
+        * *time* (optional)
+            A number defining the point of time when this state vector was
+            reached. (Default is 0)
+
+        * *basis* (optional)
+            The basis of the state vector like for
+            :class:`pycppqed.statevector.StateVector`.
+
+    All amplitudes which are not stored are zero. The tensor product with
+    another SparseStateVector (written as ``sv1 ^ sv2``) only stores the
+    products of the stored amplitudes.
+    """
+    def __init__(self, shape, indices, values, time=0, basis=None):
+        self.shape = tuple(shape)
+        self.dimensions = self.shape
+        self.indices = numpy.asarray(indices, dtype=numpy.intp)
+        self.values = numpy.asarray(values)
+        self.time = time
+        self.basis = basis
+
+    def __str__(self):
+        clsname = self.__class__.__name__
+        return "%s(%s, %s amplitudes)" % (clsname,
+                                          " x ".join(map(str, self.shape)),
+                                          len(self.indices))
+
+    def todense(self):
+        """
+        Return the full :class:`pycppqed.statevector.StateVector`.
+        """
+        array = numpy.zeros(int(numpy.prod(self.shape)),
+                            dtype=self.values.dtype)
+        array[self.indices] = self.values
+        return statevector.StateVector(array.reshape(self.shape),
+                                       time=self.time, basis=self.basis,
+                                       copy=False)
+
+    def norm(self):
+        r"""
+        Calculate the norm of the SparseStateVector.
+        """
+        return statevector.norm(self.values)
+
+    def normalize(self):
+        r"""
+        Return a normalized SparseStateVector.
+        """
+        return SparseStateVector(self.shape, self.indices,
+                                 statevector.normalize(self.values),
+                                 self.time, self.basis)
+
+    def expvalue(self, operator, indices=None, title=None, multi=False):
+        r"""
+        Calculate the expectation value of the given operator.
+
+        *Usage*
+            >>> a = numpy.diag(numpy.sqrt(numpy.arange(1, 200)), 1)
+            >>> sv = fromdense(initialconditions.coherent(2, 200))
+            >>> print sv.expvalue(a)
+            2.0
+
+        *Arguments*
+            * *operator*
+                The operator in one of the forms
+                :meth:`pycppqed.statevector.StateVector.expvalue` accepts.
+
+            * *indices* (optional)
+                Specifies which subsystems should be taken. If None is given
+                the whole system is used.
+
+            * *multi* (optional)
+                If multi is True it is assumed that a list of operators is
+                given. (Default is False)
+
+        Only the matrix elements between states of the given subsystems
+        that occur in the stored amplitudes are used, so the work depends
+        on the number of stored amplitudes and not on the dimensions.
+        """
+        if not multi:
+            operator = [operator]
+        psi, coords, dims = self._support(indices)
+        ops = [_submatrix(op, coords, dims) for op in operator]
+        evs = statevector._expvalues(psi, ops, indices=0)
+        if multi:
+            return expvalues.ExpectationValueCollection(evs, self.time, title)
+        return evs[0]
+
+    def diagexpvalue(self, operator, indices=None, title=None, multi=False):
+        r"""
+        Calculate the expectation value for the given diagonal operator.
+
+        *Arguments*
+            * *operator*
+                The diagonal elements of a tensor representing an arbitrary
+                diagonal operator in the basis of the state vector.
+
+            * *indices* (optional)
+                Specifies which subsystems should be taken. If None is given
+                the whole system is used.
+
+            * *multi* (optional)
+                If multi is True it is assumed that a list of operators is
+                given. (Default is False)
+
+        The diagonal elements are only looked up at the stored amplitudes.
+        """
+        if not multi:
+            operator = [operator]
+        kept = self._kept(indices)
+        dims = tuple([self.shape[i] for i in kept])
+        coords = numpy.unravel_index(self.indices, self.shape)
+        k = numpy.ravel_multi_index([coords[i] for i in kept], dims)
+        P = self.values.real**2 + self.values.imag**2
+        ops = numpy.array([numpy.broadcast_to(op, dims).ravel()[k]
+                           for op in operator])
+        evs = numpy.dot(ops, P)
+        if multi:
+            return expvalues.ExpectationValueCollection(evs, self.time, title)
+        return evs[0]
+
+    def outer(self, other):
+        r"""
+        Return the tensor product between this and the given state vector.
+
+        *Arguments*
+            * *other*
+                A SparseStateVector or some kind of array, of which only
+                the non-zero entries are used.
+        """
+        if not isinstance(other, SparseStateVector):
+            other = fromdense(other, 0)
+        size = int(numpy.prod(other.shape))
+        indices = numpy.add.outer(self.indices*size, other.indices)
+        values = numpy.multiply.outer(self.values, other.values)
+        return SparseStateVector(self.shape + other.shape, indices.ravel(),
+                                 values.ravel(), self.time)
+
+    __xor__ = outer
+
+    def _kept(self, indices):
+        """
+        Return the sorted list of the given subsystems.
+        """
+        if indices is None:
+            return range(len(self.shape))
+        elif isinstance(indices, int):
+            indices = (indices,)
+        return statevector._sorted_list(indices)
+
+    def _support(self, indices):
+        """
+        Return the stored amplitudes as matrix psi_km.
+
+        *k* runs over the states of the given subsystems and *m* over the
+        states of the other subsystems which occur in the stored amplitudes.
+        Also returns the coordinates of the states *k* and the dimensions of
+        the given subsystems.
+        """
+        kept = self._kept(indices)
+        traced = [i for i in range(len(self.shape)) if i not in kept]
+        coords = numpy.unravel_index(self.indices, self.shape)
+        dims = tuple([self.shape[i] for i in kept])
+        k = numpy.ravel_multi_index([coords[i] for i in kept], dims)
+        if traced:
+            m = numpy.ravel_multi_index([coords[i] for i in traced],
+                                        [self.shape[i] for i in traced])
+        else:
+            m = numpy.zeros_like(k)
+        ks, kinv = numpy.unique(k, return_inverse=True)
+        ms, minv = numpy.unique(m, return_inverse=True)
+        psi = numpy.zeros((len(ks), len(ms)), dtype=complex)
+        psi[kinv, minv] = self.values
+        return psi, numpy.unravel_index(ks, dims), dims
+
+
+def fromdense(array, threshold=1e-12):
+    """
+    Return a SparseStateVector with the significant amplitudes of the array.
+
+    *Usage*
+        >>> sv = fromdense(initialconditions.coherent(2, 200))
+
+    *Arguments*
+        * *array*
+            A :class:`pycppqed.statevector.StateVector` or some kind of array.
+
+        * *threshold* (optional)
+            Amplitudes with an absolute value not larger than this are
+            dropped. (Default is 1e-12)
+    """
+    a = numpy.asarray(array)
+    flat = a.ravel()
+    indices = numpy.flatnonzero(numpy.abs(flat) > threshold)
+    return SparseStateVector(a.shape, indices, flat[indices],
+                             getattr(array, "time", 0),
+                             getattr(array, "basis", None))
+
+def _submatrix(operator, coords, dims):
+    """
+    Return the dense matrix elements of the operator between the given states.
+
+    *coords* holds one coordinate array per subsystem, the operator can be
+    given in all forms :func:`pycppqed.statevector._expvalues` accepts.
+    """
+    if isinstance(operator, statevector.ProductOperator):
+        factors = list(operator.factors) + [None]*(len(dims)
+                                                  - len(operator.factors))
+        O = numpy.ones((len(coords[0]),)*2, dtype=complex)
+        for c, d, factor in zip(coords, dims, factors):
+            if factor is None:
+                O *= numpy.equal.outer(c, c)
+            else:
+                O *= _submatrix(factor, (c,), (d,))
+        return O
+    if statevector._issparse(operator):
+        k = numpy.ravel_multi_index(coords, dims)
+        return operator.tocsr()[k][:,k].toarray()
+    operator = numpy.asarray(operator)
+    if operator.ndim == 2*len(dims):
+        index = []
+        for c in coords:
+            index += [c[:,numpy.newaxis], c[numpy.newaxis,:]]
+        return operator[tuple(index)]
+    k = numpy.ravel_multi_index(coords, dims)
+    return operator[numpy.ix_(k, k)]
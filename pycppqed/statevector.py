@@ -3,6 +3,7 @@ This module provides an implementation for state vectors.
 
 The relevant classes are:
     * :class:`StateVector`
+    * :class:`ProductStateVector`
     * :class:`StateVectorTrajectory`
 
 The :class:`StateVector` represents a state vector at a specific point of time
@@ -12,6 +13,7 @@ points of time.
 
 import numpy
 import expvalues
+import fftplan
 try:
     set()
 except NameError:
@@ -152,18 +154,15 @@ class StateVector(numpy.ndarray):
         Reducing is an easy way to find out how subspaces of a high rank
         state vectors behave. Don't use reduced StateVectors for calculating
         expectation values - this will most likely give wrong answers!
+
+        All indices are summed up in one pass and the result is normalized
+        once at the end.
         """
         if isinstance(indices, int):
-            a = (indices,)
-        else:
-            a = _sorted_list(indices, True)
-        array = self
+            indices = (indices,)
+        array = self.sum(axis=tuple(indices))
         if norm:
-            for i in a:
-                array = array.sum(axis=i).normalize()
-        else:
-            for i in a:
-                array = array.sum(axis=i)
+            return array.normalize()
         return array
 
     def reducesquare(self, indices):
@@ -200,7 +199,7 @@ class StateVector(numpy.ndarray):
             a = _sorted_list(indices, True)
         return numpy.tensordot(self, self.conjugate(), (a,a))
 
-    def fft(self, axes=None):
+    def fft(self, axes=None, inplace=False):
         r"""
         Return a StateVector where the given axes are Fourier transformed.
         This is the transformation position space -> momentum space.
@@ -213,31 +212,36 @@ class StateVector(numpy.ndarray):
         *Arguments*
             * *axis* (optional)
                 Sequence of ints, axes over which the fft is done. (Default is all)
+
+            * *inplace* (optional)
+                If True, the result is written back into the (complex) data
+                of this StateVector and no new StateVector is created. The
+                transform itself still needs a temporary array of the same
+                size. (Default is False)
+
+        The transform is done with a cached :class:`pycppqed.fftplan.FFTPlan`.
         """
-        return self._fft_helper(axes=axes,inverse=False)
+        return self._fft_helper(axes=axes,inverse=False,inplace=inplace)
     
-    def ifft(self, axes=None):
+    def ifft(self, axes=None, inplace=False):
         r"""
         Return a StateVector where the given axes are inversely Fourier transformed.
         This is the transformation momentum space -> position space.
         
         See :func:`StateVector.fft` for details.
         """
-        return self._fft_helper(axes=axes,inverse=True)
+        return self._fft_helper(axes=axes,inverse=True,inplace=inplace)
     
-    def _fft_helper(self, axes=None, inverse=False):
+    def _fft_helper(self, axes=None, inverse=False, inplace=False):
         r"""
         Helper function for fft and ifft which performs the actual transformation.
         """
-        f = numpy.fft
-        norm = numpy.sqrt(numpy.prod(numpy.array(self.shape)[axes]))
-        if inverse:
-            transform=f.ifftn
-        else:
-            transform=f.fftn
-            norm=1/norm
-        array = f.fftshift(transform(f.ifftshift(self, axes=axes), axes=axes), axes=axes)*norm
-        return StateVector(array, time=self.time)
+        plan = fftplan.get_plan(self.shape, axes, inverse)
+        if inplace:
+            plan(numpy.asarray(self), inplace=True)
+            return self
+        return StateVector(plan(numpy.asarray(self)), time=self.time,
+                           copy=False)
 
     def expvalue(self, operator, indices=None, title=None, multi=False):
         r"""
@@ -257,7 +261,9 @@ class StateVector(numpy.ndarray):
         *Arguments*
             * *operator*
                 A tensor representing an arbitrary operator in the
-                basis of the StateVector.
+                basis of the StateVector. It can also be given as matrix
+                (a 2d numpy array or a :mod:`scipy.sparse` matrix) acting on
+                the flattened subsystems, or as :class:`ProductOperator`.
 
             * *indices* (optional)
                 Specifies which subsystems should be taken. If None is given
@@ -276,21 +282,92 @@ class StateVector(numpy.ndarray):
                     \sum_{k_1 k_2} \langle k_1 | \hat A (k) | k_2 \rangle
                     \sum_m \Psi_{k_1 m}^* \Psi_{k_2 m}
 
-        The second sum is exactly what :meth:`reducesquare` does while the
-        first expression is the matrix representation of the given operator
-        in the same basis as the StateVector.
+        Let :math:`K` be the dimension of the given subsystems, :math:`M`
+        the dimension of the other ones and :math:`n` the number of
+        operators. Operators given as numpy arrays are stacked and evaluated
+        together in one of two ways, depending on which intermediate result
+        is smaller:
+
+            * If :math:`K \le nM`, the reduced tensor
+              :math:`W_{k_1 k_2} = \sum_m \Psi_{k_1 m} \Psi_{k_2 m}^*` (like
+              the one :meth:`reducesquare` returns) is formed once and
+              contracted with all operators. This needs memory for
+              :math:`K^2` numbers.
+
+            * Otherwise all operators are applied to the state vector with
+              one matrix product before the sum over :math:`m` is done. This
+              needs memory for :math:`n` state vectors.
+
+        If any of the operators is a sparse matrix or a
+        :class:`ProductOperator`, they are applied to the given subsystems
+        one after the other instead (see :meth:`apply`). Then the reduced
+        tensor is never formed and only memory of the size of the state
+        vector is needed.
         """
-        if indices is not None:
-            A = self.reducesquare(_conjugate_indices(indices, self.ndim))
-        else:
-            A = self^self.conjugate()
-        length = A.ndim
-        index = range(0, length, 2) + range(1, length, 2)
         if multi:
-            evs = [(A*op.transpose(index)).sum() for op in operator]
+            evs = _expvalues(numpy.asarray(self), operator, indices)
             return expvalues.ExpectationValueCollection(evs, self.time, title)
         else:
-            return (A*operator.transpose(index)).sum()
+            return _expvalues(numpy.asarray(self), [operator], indices)[0]
+
+    def apply(self, operator, indices=None):
+        r"""
+        Apply the operator to the given subsystems.
+
+        *Usage*
+            >>> a = numpy.diag(numpy.sqrt(numpy.arange(1, 4)), 1)
+            >>> sv = StateVector((1,2,3,4), norm=True) ^ StateVector((1,1))
+            >>> print sv.apply(a, 0)
+            StateVector(4 x 2)
+
+        *Arguments*
+            * *operator*
+                The operator in one of the forms :meth:`expvalue` accepts.
+
+            * *indices* (optional)
+                The subsystems the operator acts on. If None is given the
+                whole system is used.
+
+        *Returns*
+            * *sv*
+                The StateVector :math:`\hat A |\Psi\rangle` with the same
+                shape as this one.
+
+        The operator is contracted with the axes of the given subsystems by
+        :func:`numpy.tensordot`, so its size only depends on these
+        subsystems.
+        """
+        return StateVector(_apply_local(numpy.asarray(self), operator,
+                                        indices),
+                           time=self.time, basis=self.basis)
+
+    def variance(self, operator, indices=None):
+        r"""
+        Calculate the variance of the given operator.
+
+        *Usage*
+            >>> a = numpy.diag(numpy.sqrt(numpy.arange(1, 4)), 1)
+            >>> sv = StateVector((1,2,3,4), norm=True)
+            >>> var = sv.variance(a + a.T)
+
+        *Arguments*
+            * *operator*
+                The operator in one of the forms :meth:`expvalue` accepts.
+
+            * *indices* (optional)
+                The subsystems the operator acts on. If None is given the
+                whole system is used.
+
+        The variance :math:`\langle \hat A^2 \rangle - \langle \hat A
+        \rangle^2` is calculated by applying the operator twice to the
+        given subsystems.
+        """
+        psi = numpy.asarray(self)
+        x = _apply_local(psi.conj(), operator, indices)
+        ev = numpy.dot(psi.ravel(), x.ravel())
+        ev2 = numpy.dot(psi.ravel(),
+                        _apply_local(x, operator, indices).ravel())
+        return ev2 - ev**2
 
     def diagexpvalue(self, operator, indices=None, title=None, multi=False):
         r"""
@@ -330,21 +407,13 @@ class StateVector(numpy.ndarray):
         only works for diagonal operators and only needs the diagonal elements
         of the matrix representation.
         """
-        if isinstance(indices, int):
-            indices = (indices,)
-        A = self*self.conjugate()
-        if indices is not None:
-            indices = _sorted_list(_conjugate_indices(indices, self.ndim),
-                                   True)
-            for index in indices:
-                A = A.sum(index)
         if multi:
-            evs = [(A*op).sum() for op in operator]
+            evs = _diagexpvalues(numpy.asarray(self), operator, indices)
             return expvalues.ExpectationValueCollection(evs, self.time, title)
         else:
-            return (A*operator).sum()
+            return _diagexpvalues(numpy.asarray(self), [operator], indices)[0]
 
-    def outer(self, array):
+    def outer(self, array, lazy=False):
         r"""
         Return the outer product between this and the given StateVector.
 
@@ -363,15 +432,256 @@ class StateVector(numpy.ndarray):
             * *array*
                 Some kind of array (E.g. StateVector, numpy.array, list, ...).
 
+            * *lazy* (optional)
+                If True, a :class:`ProductStateVector` is returned which
+                keeps both factors instead of forming the product. (Default
+                is False)
+
         As abbreviation ``sv1^sv2`` can be written instead of
         ``sv1.outer(sv2)``. But be aware that the operator precedence of ``^``
         follows the python rules - that means ``sv1 ^ sv2 + sv3`` is the same
         as ``sv1 ^ (sv2 + sv3)``.
+
+        The product with a :class:`ProductStateVector` is always lazy.
         """
+        if isinstance(array, ProductStateVector):
+            return ProductStateVector([self] + array.factors, self.time)
+        if lazy:
+            return ProductStateVector([self, array], self.time)
         return StateVector(numpy.multiply.outer(self, array))
 
     __xor__ = outer
 
+    def sparse(self, threshold=1e-12):
+        r"""
+        Return a compact copy which only stores the significant amplitudes.
+
+        *Usage*
+            >>> sv = StateVector((0.6, 0, 0, 0.8, 1e-14))
+            >>> print sv.sparse()
+            SparseStateVector(5, 2 amplitudes)
+
+        *Arguments*
+            * *threshold* (optional)
+                Amplitudes with an absolute value not larger than this are
+                dropped. (Default is 1e-12)
+
+        *Returns*
+            * *sv*
+                A :class:`pycppqed.sparsestatevector.SparseStateVector`.
+        """
+        import sparsestatevector
+        return sparsestatevector.fromdense(self, threshold)
+
+
+class ProductOperator(object):
+    """
+    An operator which is the tensor product of operators on single subsystems.
+
+    *Usage*
+        >>> a = numpy.diag(numpy.sqrt(numpy.arange(1, 10)), 1)
+        >>> op = ProductOperator(a, a.T)
+        >>> ev = sv.expvalue(op, indices=(0, 2))
+
+    *Arguments*
+        * *factors*
+            One matrix (a 2d numpy array or a :mod:`scipy.sparse` matrix) for
+            every subsystem the operator acts on, in the order of the
+            subsystems. None stands for the identity.
+
+    The factors are applied one after the other, so the full operator is
+    never formed.
+    """
+    def __init__(self, *factors):
+        self.factors = factors
+
+
+class ProductStateVector(object):
+    r"""
+    A product state which keeps its factors instead of their tensor product.
+
+    *Usage*
+        >>> sv1 = StateVector((1,2,3), norm=True)
+        >>> sv = sv1.outer(sv1, lazy=True) ^ sv1 ^ sv1
+        >>> print sv
+        ProductStateVector(3 x 3 x 3 x 3)
+        >>> a = numpy.diag(numpy.sqrt(numpy.arange(1, 3)), 1)
+        >>> ev = sv.expvalue(a, 2)
+
+    *Arguments*
+        * *factors*
+            A list of StateVectors (or anything a StateVector can be created
+            from), one for every group of subsystems.
+
+        * *time* (optional)
+            A number defining the point of time when this state vector was
+            reached. (Default is the time of the first factor)
+
+    The subsystems are numbered through all factors like for the full
+    StateVector. :meth:`norm`, :meth:`diagexpvalue` and :meth:`expvalue` of
+    operators acting on the subsystems of one factor (or of
+    :class:`ProductOperator` instances) are calculated factor by factor.
+    Everything else uses the product of the factors that are involved, and
+    :meth:`todense` (or any numpy function) forms the full StateVector.
+    """
+    def __init__(self, factors, time=None):
+        self.factors = [StateVector(f, copy=False) for f in factors]
+        if time is None:
+            time = self.factors[0].time
+        self.time = time
+        self.dimensions = sum([f.shape for f in self.factors], ())
+        self.shape = self.dimensions
+
+    def __str__(self):
+        clsname = self.__class__.__name__
+        return "%s(%s)" % (clsname, " x ".join(map(str, self.dimensions)))
+
+    def __array__(self, dtype=None):
+        return numpy.asarray(self.todense(), dtype)
+
+    def todense(self):
+        """
+        Return the full StateVector.
+        """
+        return StateVector(reduce(numpy.multiply.outer, self.factors),
+                           time=self.time, copy=False)
+
+    def norm(self):
+        r"""
+        Calculate the norm as product of the norms of the factors.
+        """
+        return numpy.prod([f.norm() for f in self.factors])
+
+    def normalize(self):
+        r"""
+        Return a ProductStateVector with normalized factors.
+        """
+        return ProductStateVector([f.normalize() for f in self.factors],
+                                  self.time)
+
+    def outer(self, array):
+        r"""
+        Return the lazy tensor product with the given state vector.
+        """
+        if isinstance(array, ProductStateVector):
+            return ProductStateVector(self.factors + array.factors,
+                                      self.time)
+        return ProductStateVector(self.factors + [array], self.time)
+
+    __xor__ = outer
+
+    def expvalue(self, operator, indices=None, title=None, multi=False):
+        r"""
+        Calculate the expectation value of the given operator.
+
+        *Arguments*
+            * *operator*
+                The operator in one of the forms
+                :meth:`StateVector.expvalue` accepts.
+
+            * *indices* (optional)
+                Specifies which subsystems should be taken. If None is given
+                the whole system is used.
+
+            * *multi* (optional)
+                If multi is True it is assumed that a list of operators is
+                given. (Default is False)
+
+        The expectation value of a product state is the product of the
+        expectation values of the factors, where factors the operator
+        doesn't act on contribute their squared norm.
+        """
+        if multi:
+            evs = [self._expvalue(op, indices) for op in operator]
+            return expvalues.ExpectationValueCollection(evs, self.time, title)
+        return self._expvalue(operator, indices)
+
+    def diagexpvalue(self, operator, indices=None, title=None, multi=False):
+        r"""
+        Calculate the expectation value for the given diagonal operator.
+
+        *Arguments*
+            * *operator*
+                The diagonal elements of a tensor representing an arbitrary
+                diagonal operator in the basis of the state vector.
+
+            * *indices* (optional)
+                Specifies which subsystems should be taken. If None is given
+                the whole system is used.
+
+            * *multi* (optional)
+                If multi is True it is assumed that a list of operators is
+                given. (Default is False)
+
+        Only the probabilities of the given subsystems are formed as the
+        product of the reduced probabilities of the factors.
+        """
+        groups, rest = self._groups(indices)
+        P = None
+        for f, local in groups:
+            p = f.real**2 + f.imag**2
+            traced = _conjugate_indices(local, f.ndim)
+            if traced:
+                p = p.sum(axis=tuple(traced))
+            P = p if P is None else numpy.multiply.outer(P, p)
+        if not multi:
+            operator = [operator]
+        ops = numpy.array([numpy.broadcast_to(op, P.shape).ravel()
+                           for op in operator])
+        evs = numpy.dot(ops, P.ravel())*rest
+        if multi:
+            return expvalues.ExpectationValueCollection(evs, self.time, title)
+        return evs[0]
+
+    def _groups(self, indices):
+        """
+        Split the given subsystems into the factors they belong to.
+
+        *Returns*
+            * *(groups, rest)*
+                *groups* is a list of *(factor, local indices)* for all
+                factors with some of the given subsystems, *rest* the
+                product of the squared norms of all other factors.
+        """
+        if indices is None:
+            indices = range(len(self.dimensions))
+        elif isinstance(indices, int):
+            indices = (indices,)
+        indices = _sorted_list(indices)
+        groups = []
+        rest = 1.
+        offset = 0
+        for f in self.factors:
+            local = [i - offset for i in indices if 0 <= i - offset < f.ndim]
+            if local:
+                groups.append((f, local))
+            else:
+                rest *= numpy.vdot(f, f).real
+            offset += f.ndim
+        return groups, rest
+
+    def _expvalue(self, operator, indices):
+        """
+        Calculate the expectation value of one operator.
+        """
+        groups, rest = self._groups(indices)
+        if isinstance(operator, ProductOperator):
+            factors = list(operator.factors)
+            ev = rest
+            for f, local in groups:
+                op = ProductOperator(*factors[:len(local)])
+                factors = factors[len(local):]
+                ev = ev*f.expvalue(op, local)
+            return ev
+        if len(groups) == 1:
+            f, local = groups[0]
+            return f.expvalue(operator, local)*rest
+        # The operator couples several factors: only these are combined.
+        sv = reduce(numpy.multiply.outer, [f for f, local in groups])
+        offsets = numpy.cumsum([0] + [f.ndim for f, local in groups])
+        local = [i + o for (f, l), o in zip(groups, offsets) for i in l]
+        return StateVector(sv, copy=False).expvalue(operator, local)*rest
+
 
 class StateVectorTrajectory(numpy.ndarray):
     """
@@ -395,34 +705,44 @@ class StateVectorTrajectory(numpy.ndarray):
             vector. This array must have as many entries as there are state
             vectors.
 
+        * *bases* (optional)
+            A list with the basis of every state vector. (Default is the
+            *basis* attribute of the given state vectors)
+
         * Any other argument that a numpy array takes. E.g. ``copy=False`` can
           be used so that the StateVectorTrajectory shares the data storage
           with the given numpy array.
 
+    The single StateVectors are available as *statevectors*. They are created
+    on access as views into the data of the trajectory, so no memory is
+    needed for them.
+
     Most methods are simple mapped to all single StateVectors. For more
     documentation regarding these methods look into the docstrings of the
     corresponding :class:`StateVector` methods.
     """
-    def __new__(cls, data, time=None, **kwargs):
+    def __new__(cls, data, time=None, bases=None, **kwargs):
         array = numpy.array(data, **kwargs)
         array = numpy.asarray(array).view(cls)
         if time is None:
             array.time = numpy.array([sv.time for sv in data])
         else:
             array.time = time
-        svs = [None]*array.shape[0]
-        for i, entry in enumerate(array):
-            if hasattr(data[i], "basis"):
-                basis = data[i].basis
-            else:
-                basis = None
-            svs[i] = StateVector(entry, time=array.time[i], basis=basis, copy=True)
-        array.statevectors = svs
+        if bases is None and not isinstance(data, numpy.ndarray):
+            bases = [getattr(sv, "basis", None) for sv in data]
+        array.bases = bases
         return array
 
     def __array_finalize__(self, obj):
         self.dimensions = obj.shape[1:]
 
+    @property
+    def statevectors(self):
+        """
+        A sequence of StateVectors sharing the data of this trajectory.
+        """
+        return _StateVectorViews(self)
+
     def __str__(self):
         clsname = self.__class__.__name__
         dims = " x ".join(map(str, self.dimensions))
@@ -451,13 +771,32 @@ class StateVectorTrajectory(numpy.ndarray):
         else:
             return svs
 
+    def _trajectory(self, array, bases=True):
+        """
+        Return a StateVectorTrajectory with the given data and the times (and
+        bases) of this trajectory.
+        """
+        if bases:
+            bases = getattr(self, "bases", None)
+        else:
+            bases = None
+        return StateVectorTrajectory(array, time=self.time, bases=bases,
+                                     copy=False)
+
+    def _flat(self):
+        """
+        Return the data as plain (ntimes, size) array.
+        """
+        return numpy.asarray(self).reshape(self.shape[0], -1)
+
     def norm(self):
         """
-        Return a list of norms for every single StateVector.
+        Return an array with the norms of all StateVectors.
 
         See also: :meth:`StateVector.norm`
         """
-        return self.map(lambda sv:sv.norm(), False)
+        flat = self._flat()
+        return numpy.sqrt(numpy.einsum("ij,ij->i", flat, flat.conj()))
 
     def normalize(self):
         """
@@ -465,7 +804,8 @@ class StateVectorTrajectory(numpy.ndarray):
 
         See also: :meth:`StateVector.normalize`
         """
-        return self.map(lambda sv:sv.normalize())
+        norms = self.norm().reshape((-1,) + (1,)*len(self.dimensions))
+        return self._trajectory(numpy.asarray(self)/norms)
 
     def reduce(self, indices, norm=True):
         """
@@ -473,15 +813,61 @@ class StateVectorTrajectory(numpy.ndarray):
 
         See also: :meth:`StateVector.reduce`
         """
-        return self.map(lambda sv:sv.reduce(indices, norm=norm))
+        indices = _normalized_indices(indices, len(self.dimensions))
+        axes = tuple([i + 1 for i in indices])
+        svt = self._trajectory(numpy.asarray(self).sum(axis=axes))
+        if norm:
+            return svt.normalize()
+        return svt
 
-    def fft(self, axis=0):
+    def reducesquare(self, indices):
+        """
+        Return the reduced Psi-square tensors of all StateVectors as array
+        with the time as first axis.
+
+        See also: :meth:`StateVector.reducesquare`
+        """
+        ndim = len(self.dimensions)
+        traced = _sorted_list(_normalized_indices(indices, ndim))
+        kept = [i for i in range(ndim) if i not in traced]
+        psi = numpy.asarray(self).transpose([0] + [i + 1 for i in kept]
+                                            + [i + 1 for i in traced])
+        dims = psi.shape[1:len(kept)+1]
+        psi = psi.reshape(len(self), int(numpy.prod(dims)), -1)
+        W = numpy.matmul(psi, psi.conj().transpose(0, 2, 1))
+        return W.reshape((len(self),) + dims + dims)
+
+    def fft(self, axes=None, inplace=False):
         """
         Return a StateVectorTrajectory whith Fourier transformed StateVectors.
 
+        With *inplace* the result is written back into this trajectory, like
+        in :meth:`StateVector.fft`.
+
         See also: :meth:`StateVector.fft`
         """
-        return self.map(lambda sv:sv.fft(axis))
+        return self._fft_helper(axes, inverse=False, inplace=inplace)
+
+    def ifft(self, axes=None, inplace=False):
+        """
+        Return a StateVectorTrajectory with inversely Fourier transformed
+        StateVectors.
+
+        See also: :meth:`StateVector.ifft`
+        """
+        return self._fft_helper(axes, inverse=True, inplace=inplace)
+
+    def _fft_helper(self, axes=None, inverse=False, inplace=False):
+        """
+        Transform all StateVectors at once along the given axes.
+        """
+        axes = _normalized_indices(axes, len(self.dimensions))
+        axes = tuple([i + 1 for i in axes])
+        plan = fftplan.get_plan(self.shape, axes, inverse)
+        if inplace:
+            plan(numpy.asarray(self), inplace=True)
+            return self
+        return self._trajectory(plan(numpy.asarray(self)), bases=False)
 
     def expvalue(self, operator, indices=None, multi=False, titles=None):
         """
@@ -492,16 +878,39 @@ class StateVectorTrajectory(numpy.ndarray):
                 An :class:`pycppqed.expvalues.ExpectationValuesTrajectory`
                 instance.
 
+        All StateVectors are handled at once: the operator is applied to the
+        whole trajectory with one matrix product.
+
         See also: :meth:`StateVector.expvalue`
         """
-        evs = self.map(lambda sv:sv.expvalue(operator, indices, multi=multi),
-                       False)
+        ops = operator if multi else [operator]
+        evs = _expvalues(numpy.asarray(self), ops, indices, 1)
         if not multi:
-            return expvalues.ExpectationValueTrajectory(evs, self.time, titles)
-        evs = numpy.array(evs).swapaxes(0,1)
+            return expvalues.ExpectationValueTrajectory(evs[0], self.time,
+                                                        titles)
         return expvalues.ExpectationValueCollection(
                             evs, self.time, titles, copy=False)
 
+    def variance(self, operator, indices=None, title=None):
+        """
+        Calculate the variance of the operator for all StateVectors.
+
+        *Returns*
+            *evtraj*
+                An :class:`pycppqed.expvalues.ExpectationValuesTrajectory`
+                instance.
+
+        See also: :meth:`StateVector.variance`
+        """
+        psi = numpy.asarray(self)
+        flat = self._flat()
+        x = _apply_local(psi.conj(), operator, indices, 1)
+        ev = numpy.einsum("ij,ij->i", flat, x.reshape(flat.shape))
+        x = _apply_local(x, operator, indices, 1)
+        ev2 = numpy.einsum("ij,ij->i", flat, x.reshape(flat.shape))
+        return expvalues.ExpectationValueTrajectory(ev2 - ev**2, self.time,
+                                                    title)
+
     def diagexpvalue(self, operator, indices=None, multi=False, titles=None):
         """
         Calculate the expectation value of the diagonal operator for all SVs.
@@ -511,13 +920,15 @@ class StateVectorTrajectory(numpy.ndarray):
                 An :class:`pycppqed.expvalues.ExpectationValuesTrajectory`
                 instance.
 
+        All StateVectors are handled at once with one matrix product.
+
         See also: :meth:`StateVector.diagexpvalue`
         """
-        evs = self.map(lambda sv:sv.diagexpvalue(operator, indices,
-                            multi=multi), False)
+        ops = operator if multi else [operator]
+        evs = _diagexpvalues(numpy.asarray(self), ops, indices, 1)
         if not multi:
-            return expvalues.ExpectationValueTrajectory(evs, self.time, titles)
-        evs = numpy.array(evs).swapaxes(0,1)
+            return expvalues.ExpectationValueTrajectory(evs[0], self.time,
+                                                        titles)
         return expvalues.ExpectationValueCollection(
                             evs, self.time, titles, copy=False)
 
@@ -532,6 +943,34 @@ class StateVectorTrajectory(numpy.ndarray):
         return animate_statevector(self, x, y, re, im, abs)
 
 
+class _StateVectorViews(object):
+    """
+    A read-only sequence of StateVector views into a StateVectorTrajectory.
+    """
+    def __init__(self, svtraj):
+        self.svtraj = svtraj
+
+    def __len__(self):
+        return self.svtraj.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("StateVector index out of range.")
+        svtraj = self.svtraj
+        bases = getattr(svtraj, "bases", None)
+        return StateVector(numpy.ndarray.__getitem__(svtraj, i),
+                           time=svtraj.time[i],
+                           basis=bases[i] if bases else None, copy=False)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
 def norm(array):
     """
     Return the norm of the array.
@@ -554,6 +993,119 @@ def adjust(array, length):
     X_new = numpy.linspace(0,1,length)
     return StateVector(f(X_new))
 
+def _issparse(operator):
+    """
+    Return True if the operator is a scipy.sparse matrix.
+    """
+    try:
+        import scipy.sparse
+    except ImportError:
+        return False
+    return scipy.sparse.issparse(operator)
+
+def _apply_local(array, operator, indices=None, first=0):
+    """
+    Apply the operator to the given subsystems of the array.
+
+    The leading *first* axes of the array (e.g. the time axis) don't belong
+    to the state vectors. Only the axes of the given subsystems are
+    contracted with the operator, all other axes are carried along.
+    """
+    indices = _normalized_indices(indices, array.ndim - first)
+    axes = [i + first for i in _sorted_list(indices)]
+    if isinstance(operator, ProductOperator):
+        for axis, factor in zip(axes, operator.factors):
+            if factor is not None:
+                array = _apply_local(array, factor, axis)
+        return array
+    n = len(axes)
+    dims = tuple([array.shape[i] for i in axes])
+    others = [i for i in range(array.ndim) if i not in axes]
+    inverse = numpy.argsort(axes + others)
+    if _issparse(operator):
+        x = array.transpose(axes + others)
+        shape = x.shape
+        x = operator.dot(x.reshape(numpy.prod(dims), -1))
+        return numpy.asarray(x).reshape(shape).transpose(inverse)
+    operator = numpy.asarray(operator)
+    if operator.ndim == 2*n:
+        # (k1, l1, k2, l2, ...) -> (k1, k2, ..., l1, l2, ...)
+        operator = operator.transpose(range(0, 2*n, 2) + range(1, 2*n, 2))
+    else:
+        # A matrix acting on the flattened subsystems.
+        operator = operator.reshape(dims + dims)
+    x = numpy.tensordot(operator, array, (range(n, 2*n), axes))
+    return x.transpose(inverse)
+
+def _grouped_matrix(operator, dims):
+    """
+    Return the dense operator as matrix acting on the flattened subsystems.
+    """
+    operator = numpy.asarray(operator)
+    n = len(dims)
+    if operator.ndim == 2*n:
+        operator = operator.transpose(range(0, 2*n, 2) + range(1, 2*n, 2))
+    size = numpy.prod(dims)
+    return operator.reshape(size, size)
+
+def _expvalues(array, operators, indices=None, first=0):
+    """
+    Calculate the expectation values of several operators.
+
+    The leading *first* axes of the array (e.g. the time axis) don't belong
+    to the state vectors. Returns an array of the shape
+    ``(len(operators),) + array.shape[:first]``.
+    """
+    lead = array.shape[:first]
+    L = int(numpy.prod(lead))
+    ndim = array.ndim - first
+    indices = _normalized_indices(indices, ndim)
+    if [op for op in operators
+        if isinstance(op, ProductOperator) or _issparse(op)]:
+        flat = array.reshape(L, -1)
+        conj = array.conj()
+        evs = numpy.array([numpy.einsum("ij,ij->i", flat,
+                    _apply_local(conj, op, indices, first).reshape(flat.shape))
+                           for op in operators])
+        return evs.reshape((len(operators),) + lead)
+    kept = _sorted_list(indices)
+    traced = [i for i in range(ndim) if i not in kept]
+    psi = array.transpose(range(first) + [i + first for i in kept]
+                          + [i + first for i in traced])
+    dims = psi.shape[first:first+len(kept)]
+    K = int(numpy.prod(dims))
+    psi = psi.reshape(L, K, -1)
+    M = psi.shape[2]
+    ops = numpy.array([_grouped_matrix(op, dims) for op in operators])
+    if K <= len(ops)*M:
+        # The reduced tensor W_kl = sum_m psi_km psi*_lm is shared by all
+        # operators: sum_kl O_kl W_kl
+        W = numpy.matmul(psi, psi.conj().transpose(0, 2, 1))
+        evs = numpy.dot(ops.reshape(len(ops), -1), W.reshape(L, -1).T)
+    else:
+        # All operators are applied at once: sum_klm psi_km O_kl psi*_lm
+        x = psi.conj().transpose(1, 0, 2).reshape(K, -1)
+        y = numpy.dot(ops.reshape(-1, K), x).reshape(len(ops), K, L, M)
+        evs = numpy.einsum("tkm,oktm->ot", psi, y)
+    return evs.reshape((len(ops),) + lead)
+
+def _diagexpvalues(array, operators, indices=None, first=0):
+    """
+    Calculate the expectation values of several diagonal operators.
+
+    See :func:`_expvalues` for the arguments.
+    """
+    lead = array.shape[:first]
+    P = array.real**2 + array.imag**2
+    if indices is not None:
+        ndim = array.ndim - first
+        traced = _conjugate_indices(_normalized_indices(indices, ndim), ndim)
+        P = P.sum(axis=tuple([i + first for i in traced]))
+    ops = numpy.array([numpy.broadcast_to(op, P.shape[first:]).ravel()
+                       for op in operators])
+    evs = numpy.dot(ops, P.reshape(int(numpy.prod(lead)), -1).T)
+    return evs.reshape((len(ops),) + lead)
+
 def _dim2str(dimensions):
     """
     Return the corresponding dimension string for the given nested tuple.
@@ -571,6 +1123,24 @@ def _conjugate_indices(indices, ndim):
         indices = (indices,)
     return set(range(ndim)).difference(indices)
 
+def _normalized_indices(indices, ndim):
+    """
+    Return the subsystem indices as list of numbers from 0 to ndim.
+
+    None means all subsystems, a single int one subsystem and negative
+    indices count from the last subsystem, like for numpy axes. This keeps
+    negative indices off the leading (e.g. time) axes of an array.
+    """
+    if indices is None:
+        return range(ndim)
+    if isinstance(indices, int):
+        indices = (indices,)
+    for i in indices:
+        if not -ndim <= i < ndim:
+            raise IndexError("Subsystem index %s out of range for %s "
+                             "subsystems." % (i, ndim))
+    return [i % ndim for i in indices]
+
 def _sorted_list(iterable, reverse=False):
     """
     Transform an iterable to a sorted list.
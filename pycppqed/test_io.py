@@ -40,6 +40,64 @@ class BlitzTestCase(unittest.TestCase):
             self.assert_((a==na1).all())
             self.assert_((a==na2).all())
 
+    def test_cparse(self):
+        if io.cio is None:
+            raise Exception("Can't test c extension!")
+        a = numpy.arange(12).reshape((3,4)) + 1j
+        datastr = io._numpy2blitz(a).split("\n", 1)[1]
+        self.assert_((io.cio.parse(datastr, 12) == a.ravel()).all())
+        self.assertRaises(ValueError, io.cio.parse, datastr, 13)
+        self.assertRaises(ValueError, io.cio.parse, datastr, 11)
+        self.assertRaises(ValueError, io.cio.parse, "[ (1,2) (3 ]", 2)
+        out = numpy.empty((3,4), dtype="complex")
+        self.assert_(io._blitz2numpy(io._numpy2blitz(a), out=out) is out)
+        self.assert_((out == a).all())
+        self.assertRaises(ValueError, io._blitz2numpy, io._numpy2blitz(a),
+                          out=numpy.empty((4,3), dtype="complex"))
+
+    def test_cparse_threads(self):
+        import threading
+        arrays = [numpy.arange(i, i+5000)*(1-0.5j) for i in range(8)]
+        strings = [io._numpy2blitz(a) for a in arrays]
+        results = [numpy.empty(5000, dtype="complex") for a in arrays]
+        threads = [threading.Thread(target=io._blitz2numpy, args=(s,),
+                                    kwargs={"out": r})
+                   for s, r in zip(strings, results)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for a, r in zip(arrays, results):
+            self.assert_((a == r).all())
+
+    def test_writeblitz(self):
+        import cStringIO
+        a = numpy.random.rand(3,4,5) + 1j*numpy.random.rand(3,4,5)
+        cio = io.cio
+        for c in (cio, None):
+            io.cio = c
+            for chunksize in (1, 3, 5, 7, 2**16):
+                f = cStringIO.StringIO()
+                io._write_blitz(f, a, chunksize)
+                self.assert_((io._blitz2numpy(f.getvalue()) == a).all())
+                if c is not None:
+                    io.cio = None
+                    self.assert_((io._blitz2numpy(f.getvalue()) == a).all())
+                    io.cio = c
+        io.cio = cio
+
+    def test_writeblitz_empty(self):
+        cio = io.cio
+        for c in (cio, None):
+            io.cio = c
+            self.assertEqual(io._numpy2blitz(numpy.zeros(0)),
+                             "(0,-1) \n[  ]\n\n")
+            self.assertEqual(io._numpy2blitz(numpy.zeros((3,0))),
+                             "(0,2) x (0,-1) \n[  ]\n\n")
+            self.assertEqual(io._numpy2blitz(numpy.array(1.5+2.5j)),
+                             " \n[ (1.5,2.5) ]\n\n")
+        io.cio = cio
+
     def test_loadblitz(self):
         basedir = os.path.dirname(os.path.abspath(__file__))
         testdir = os.path.join(basedir, "test/blitzarray")
@@ -67,6 +125,391 @@ class CppqedTestCase(unittest.TestCase):
             path = os.path.join(testdir, name)
             evs, qs = io.load_cppqed(path)
 
+    def test_svbuffer(self):
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                svs = [sv for block, blocksvs in io.iter_cppqed(readpath)
+                       for sv in blocksvs]
+                path = os.path.join(tempdirpath, name)
+                shutil.copy(readpath, path)
+                # Without the index the buffer grows, with it it fits.
+                for i in range(2):
+                    evs, qs = io.load_cppqed(path)
+                    self.assertEqual(len(qs), len(svs))
+                    if svs:
+                        self.assertEqual(qs.shape[1:], svs[0].shape)
+                    for sv, sv2 in zip(qs.statevectors, svs):
+                        self.assert_((sv == sv2).all())
+                        self.assertEqual(sv.time, sv2.time)
+                        self.assert_(sv.base is not None)
+                    io.build_index(path)
+        finally:
+            shutil.rmtree(tempdirpath)
+
+    def test_itercppqed(self):
+        testdir = self.cppqeddir
+        for name in os.listdir(testdir):
+            path = os.path.join(testdir, name)
+            evs, qs = io.load_cppqed(path)
+            blocks = []
+            svs = []
+            for block, blocksvs in io.iter_cppqed(path, chunk_rows=7):
+                self.assert_(block.shape[1] <= 7)
+                self.assert_((block.time == block[0]).all())
+                blocks.append(block)
+                svs.extend(blocksvs)
+            self.assert_((numpy.concatenate(blocks, axis=1) == evs).all())
+            self.assertEqual(len(svs), len(qs))
+            for sv, q in zip(svs, qs):
+                self.assert_((sv == q).all())
+            ssvs = []
+            for block, blocksvs in io.iter_cppqed(path, threshold=0):
+                ssvs.extend(blocksvs)
+            for ssv, sv in zip(ssvs, svs):
+                self.assert_((ssv.todense() == sv).all())
+                self.assertEqual(ssv.time, sv.time)
+
+    def test_skipblocks(self):
+        import cStringIO
+        testdir = self.cppqeddir
+        for name in os.listdir(testdir):
+            path = os.path.join(testdir, name)
+            f = open(path)
+            data = f.read()
+            f.close()
+            blocks = list(io._scan_cppqed(cStringIO.StringIO(data)))
+            for skip in ((), ("sv",), ("sv", "basis")):
+                for chunksize in (7, 2**20):
+                    f = cStringIO.StringIO(data)
+                    blocks2 = list(io._scan_cppqed(f, skip, chunksize))
+                    self.assertEqual(blocks2, [b for b in blocks
+                                               if b[0] not in skip])
+            # A block cut off at the end of the file is dropped.
+            nsv = len([b for b in blocks if b[0] == "sv"])
+            if nsv:
+                f = cStringIO.StringIO(data[:data.rfind(" ]\n")])
+                blocks2 = list(io._scan_cppqed(f, ("basis",), 7))
+                self.assertEqual(len([b for b in blocks2 if b[0] == "sv"]),
+                                 nsv - 1)
+            for block, svs in io.iter_cppqed(path, statevectors=False):
+                self.assertEqual(svs, [])
+
+    def test_trajbin(self):
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                evs, qs = io.load_cppqed(readpath)
+                writepath = io.convert_cppqed(readpath,
+                                os.path.join(tempdirpath, name + ".trajbin"))
+                evs2, qs2 = io.load_cppqed(writepath)
+                self.assert_((evs2 == evs).all())
+                self.assert_((evs2.time == evs.time).all())
+                self.assert_((qs2 == qs).all())
+                self.assert_((qs2.time == qs.time).all())
+                self.assert_(not evs2.flags.owndata)
+                self.assert_(not evs2.evtrajectories[1].flags.owndata)
+                if len(qs2):
+                    self.assert_(not qs2.statevectors[0].flags.owndata)
+                evs4 = io.load_cppqed(readpath, maxevs=3)[0]
+                evs5 = io.load_cppqed(writepath, maxevs=3)[0]
+                self.assertEqual(evs5.shape, evs4.shape)
+                self.assert_((evs5 == evs4).all())
+                path = os.path.join(tempdirpath, "saved.trajbin")
+                io.save_trajbin(path, evs, qs)
+                evs3, qs3 = io.load_cppqed(path)
+                self.assert_((evs3 == evs).all())
+                self.assert_((qs3 == qs).all())
+        finally:
+            shutil.rmtree(tempdirpath)
+
+    def test_parallelbz2(self):
+        import bz2
+        import parallelbz2
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                f = open(readpath)
+                data = f.read()
+                f.close()
+                # Write several streams like pbzip2 does.
+                path = os.path.join(tempdirpath, name + ".bz2")
+                f = open(path, "wb")
+                for i in range(0, len(data), 1000):
+                    f.write(bz2.compress(data[i:i+1000]))
+                f.close()
+                nstreams = (len(data) + 999)//1000
+                self.assertEqual(len(parallelbz2.find_streams(path)), nstreams)
+                for segmentsize in (1, 5000, 2**23):
+                    f = parallelbz2.ParallelBZ2File(path, processes=2,
+                                                    segmentsize=segmentsize)
+                    self.assertEqual("".join(f), data)
+                    f.close()
+                for lookahead in (1, 2):
+                    f = parallelbz2.ParallelBZ2File(path, processes=2,
+                                    segmentsize=1, lookahead=lookahead)
+                    self.assertEqual("".join(f), data)
+                    f.close()
+                # Readers with different numbers of processes don't
+                # disturb each other.
+                f = parallelbz2.ParallelBZ2File(path, processes=2,
+                                                segmentsize=1)
+                start = f.read(10)
+                g = parallelbz2.ParallelBZ2File(path, processes=3,
+                                                segmentsize=1)
+                self.assertEqual(g.read(), data)
+                self.assertEqual(start + f.read(), data)
+                f.close()
+                g.close()
+                f = parallelbz2.ParallelBZ2File(path, segmentsize=1)
+                self.assertEqual(f.read(10) + f.readline() + f.read(), data)
+                f.close()
+                evs, qs = io.load_cppqed(readpath)
+                evs2, qs2 = io.load_cppqed(path)
+                self.assert_((evs2 == evs).all())
+                self.assert_((qs2 == qs).all())
+        finally:
+            shutil.rmtree(tempdirpath)
+
+    def test_compression(self):
+        import compression
+        import parallelbz2
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                f = open(readpath)
+                data = f.read()
+                f.close()
+                evs, qs = io.load_cppqed(readpath)
+                for codec in compression.codecs.values():
+                    if not codec.available:
+                        continue
+                    path = os.path.join(tempdirpath, name)
+                    shutil.copy(readpath, path)
+                    path = codec.compress_file(path)
+                    self.assertEqual(path, os.path.join(tempdirpath, name)
+                                           + codec.suffix)
+                    self.assert_(compression.codec_for_filename(path) is codec)
+                    evs2, qs2 = io.load_cppqed(path)
+                    self.assert_((evs2 == evs).all())
+                    self.assert_((qs2 == qs).all())
+                    f = compression.open(path)
+                    self.assertEqual(f.read(), data)
+                    f.close()
+                    target = codec.decompress_file(path)
+                    f = open(target)
+                    self.assertEqual(f.read(), data)
+                    f.close()
+                    os.remove(path)
+                    os.remove(target)
+            # bzip2 files are written as several streams.
+            path = os.path.join(tempdirpath, "big.bz2")
+            f = compression.open(path, "w")
+            f.write("x"*2000000)
+            f.close()
+            self.assertEqual(len(parallelbz2.find_streams(path)), 3)
+        finally:
+            shutil.rmtree(tempdirpath)
+        for name, codec in compression.codecs.items():
+            if codec.available:
+                self.assert_(compression.get_codec(name) is codec)
+            else:
+                self.assert_(compression.get_codec(name) is
+                             compression.codecs[compression.DEFAULT])
+        self.assertRaises(ValueError, compression.get_codec, "rar")
+        self.assertEqual(compression.strip_suffix("a.out.1.gz"), "a.out.1")
+        self.assertEqual(compression.strip_suffix("a.out.1.npz"), "a.out.1.npz")
+
+    def test_lasttime(self):
+        import bz2
+        import compression
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                evs, qs = io.load_cppqed(readpath)
+                self.assertEqual(io.last_time(readpath), evs[0,-1])
+                f = open(readpath)
+                data = f.read()
+                f.close()
+                # Cut off in the middle of the last line.
+                path = os.path.join(tempdirpath, name)
+                f = open(path, "w")
+                f.write(data[:-5])
+                f.close()
+                self.assertEqual(io.last_time(path), evs[0,-2])
+                # Only the header.
+                f = open(path, "w")
+                lines = data.splitlines(True)
+                nhead = map(io._is_evrow, lines).index(True)
+                f.write("".join(lines[:nhead]))
+                f.close()
+                self.assertEqual(io.last_time(path), None)
+                # Multi-stream bzip2 files are read backwards.
+                path = os.path.join(tempdirpath, name + ".bz2")
+                f = open(path, "wb")
+                for i in range(0, len(data), 1000):
+                    f.write(bz2.compress(data[i:i+1000]))
+                f.close()
+                self.assertEqual(io.last_time(path), evs[0,-1])
+                # Other files are read once and the result is kept in the index.
+                path = os.path.join(tempdirpath, name + ".gz")
+                f = compression.open(path, "w")
+                f.write(data)
+                f.close()
+                self.assertEqual(io.load_index(path), None)
+                self.assertEqual(io.last_time(path), evs[0,-1])
+                self.assertEqual(float(io.load_index(path)["last_time"]),
+                                 evs[0,-1])
+                os.chmod(path, 0644)
+                io.save_index(path, last_time=42.)
+                self.assertEqual(io.last_time(path), 42.)
+                self.assertEqual(os.stat(io.index_path(path)).st_mode & 0777,
+                                 0644)
+                self.assertEqual([n for n in os.listdir(tempdirpath)
+                                  if n.startswith(".")], [])
+                # A changed file invalidates the index.
+                f = compression.open(path, "w")
+                f.write(data[:-5])
+                f.close()
+                os.utime(path, (0, 0))
+                self.assertEqual(io.last_time(path), evs[0,-2])
+        finally:
+            shutil.rmtree(tempdirpath)
+
+    def test_index(self):
+        import bz2
+        import compression
+        testdir = self.cppqeddir
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(testdir):
+                readpath = os.path.join(testdir, name)
+                evs, qs = io.load_cppqed(readpath)
+                f = open(readpath)
+                data = f.read()
+                f.close()
+                paths = [os.path.join(tempdirpath, name)]
+                shutil.copy(readpath, paths[0])
+                paths.append(paths[0] + ".bz2")
+                f = open(paths[-1], "wb")
+                for i in range(0, len(data), 5000):
+                    f.write(bz2.compress(data[i:i+5000]))
+                f.close()
+                paths.append(paths[0] + ".gz")
+                f = compression.open(paths[-1], "w")
+                f.write(data)
+                f.close()
+                paths.append(io.convert_cppqed(readpath,
+                                    os.path.join(tempdirpath, "c.trajbin")))
+                t = evs.time
+                selections = (
+                    ({"tmin": t[3], "tmax": t[-3]}, (t >= t[3]) & (t <= t[-3])),
+                    ({"tmin": t[-2]}, t >= t[-2]),
+                    ({"times": (t[5] + 1e-9, t[0], t[-1])},
+                     numpy.in1d(t, (t[0], t[5], t[-1]))),
+                    )
+                for path in paths:
+                    for kwargs, mask in selections:
+                        evs2, qs2 = io.load_cppqed(path, **kwargs)
+                        self.assert_((evs2 == evs[:,mask]).all())
+                        self.assert_((evs2.time == t[mask]).all())
+                        svmask = io._select(qs.time, **kwargs)
+                        self.assertEqual(len(qs2), len(svmask))
+                        for sv, i in zip(qs2.statevectors, svmask):
+                            self.assert_((sv == qs[i]).all())
+                            self.assertEqual(sv.time, qs.time[i])
+                    if not path.endswith(".trajbin"):
+                        index = io.load_index(path)
+                        self.assert_((index["evtimes"] == t).all())
+                        self.assert_((index["svtimes"] == qs.time).all())
+                        self.assertEqual(float(index["last_time"]), t[-1])
+                index = io.load_index(paths[1])
+                self.assertEqual(len(index["streamoffsets"]),
+                                 (len(data) + 4999)//5000)
+                self.assert_((index["streamstarts"] ==
+                              numpy.arange(0, len(data), 5000)).all())
+        finally:
+            shutil.rmtree(tempdirpath)
+
+    def test_parseevrows(self):
+        rows = ["0            0            \t1.5    -2e-3 \t7\n",
+                "0.1          0.01         \t2.5    3e-3  \t8\n",
+                "0.2          0.01         \t3.5    4e-3  \t9"]
+        expected = numpy.array(map(io._parse_evrow, rows)).swapaxes(0,1)
+        cio = io.cio
+        for c in (cio, None):
+            io.cio = c
+            evs = io._parse_evrows(rows)
+            self.assertEqual(evs.shape, (5,3))
+            self.assert_((evs == expected).all())
+            evs = io._parse_evrows(rows, maxevs=3)
+            self.assert_((evs == expected[:3]).all())
+            evs = io._parse_evrows(rows[:2] + ["0.3 0.01 \t4.5\n"], maxevs=3)
+            self.assert_((evs[:,:2] == expected[:3,:2]).all())
+            self.assert_((evs[:,2] == (0.3, 0.01, 4.5)).all())
+            # A short row in the middle must not shift the following values.
+            short = [rows[0], "0.1 0.01 2.5 3e-3\n", rows[1], rows[2]]
+            self.assertRaises(ValueError, io._parse_evrows, short,
+                              columns=(0, 4))
+            # Extra and missing values in different rows must not cancel.
+            ragged = ["1 2 3\n", "4 5 6 7\n", "8 9\n", "10 11 12\n"]
+            self.assertRaises(ValueError, io._parse_evrows, ragged,
+                              columns=(0, 2))
+            evs = io._parse_evrows(ragged, maxevs=2)
+            self.assert_((evs == [[1, 4, 8, 10], [2, 5, 9, 11]]).all())
+        io.cio = cio
+        if cio is not None:
+            # A short row must not be completed from the next one.
+            short = rows[0] + "0.1 0.01 2.5\n" + rows[2]
+            buf = numpy.empty((3,5))
+            try:
+                cio.parse_evrows(short, buf)
+            except ValueError, e:
+                self.assertEqual(str(e), "Row 1 has less than 5 numbers.")
+            else:
+                self.fail("Short row was not detected.")
+
+    def test_columns(self):
+        rows = ["0            0            \t1.5    -2e-3 \t7\n",
+                "0.1          0.01         \t2.5    3e-3  \t8\n",
+                "0.2          0.01         \t3.5    4e-3  \t9"]
+        expected = numpy.array(map(io._parse_evrow, rows)).swapaxes(0,1)
+        cio = io.cio
+        for c in (cio, None):
+            io.cio = c
+            for columns in ([0], [2, 4], [4, 0, 2], [3, 3]):
+                evs = io._parse_evrows(rows, columns=columns)
+                self.assert_((evs == expected[columns]).all())
+            self.assertRaises(ValueError, io._parse_evrows, rows, columns=[5])
+        io.cio = cio
+        tempdirpath = tempfile.mkdtemp(prefix="pycppqed_test_")
+        try:
+            for name in os.listdir(self.cppqeddir):
+                path = os.path.join(tempdirpath, name)
+                shutil.copy(os.path.join(self.cppqeddir, name), path)
+                evs, qs = io.load_cppqed(path)
+                evs2, qs2 = io.load_cppqed(path, columns=[3, 1],
+                                           statevectors=False)
+                self.assert_((evs2 == evs[[3, 1]]).all())
+                self.assert_((evs2.time == evs.time).all())
+                self.assertEqual(len(qs2), 0)
+                evs2, qs2 = io.load_cppqed(path, columns=[2],
+                                           tmin=evs.time[4])
+                self.assert_((evs2 == evs[[2],4:]).all())
+                self.assert_((evs2.time == evs.time[4:]).all())
+        finally:
+            shutil.rmtree(tempdirpath)
+
     def test_saveloadstatevector(self):
         SV = statevector.StateVector
         a = SV((1,2,3), time=1)
@@ -84,6 +527,17 @@ class CppqedTestCase(unittest.TestCase):
             sv2 = io.load_statevector(path)
             os.remove(path)
             self.assert_((sv==sv2).all())
+            io.save_statevector(path + ".bz2", sv)
+            sv2 = io.load_statevector(path + ".bz2")
+            os.remove(path + ".bz2")
+            self.assert_((sv==sv2).all())
+            self.assertEqual(sv2.time, sv.time)
+            io.save_statevector(path, sv)
+            ssv = io.load_statevector(path, threshold=0)
+            os.remove(path)
+            self.assert_((ssv.todense() == sv).all())
+            self.assertEqual(len(ssv.indices), (sv != 0).sum())
+            self.assertEqual(ssv.time, sv.time)
 
     def test_splitstatevector(self):
         testdir = self.cppqeddir
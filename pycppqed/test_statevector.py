@@ -30,6 +30,9 @@ class StateVectorTestCase(unittest.TestCase):
         self.assert_(((sv.reduce((0,2))-sv2)<eps).all())
         self.assert_(((sv.reduce((0,1))-sv3)<eps).all())
         self.assert_(((sv.reduce(2)-(sv1^sv2))<eps).all())
+        rsv = sv.reduce([2,0], norm=False)
+        self.assertEqual(rsv.shape, (4,))
+        self.assert_(numpy.allclose(rsv, sv.sum(axis=2).sum(axis=0)))
 
     def test_reducesquare(self):
         sv1 = statevector.StateVector((2,1,1), norm=True)
@@ -48,6 +51,34 @@ class StateVectorTestCase(unittest.TestCase):
         ev_x = sv_x.diagexpvalue(X)*2*numpy.pi/64
         self.assert_(numpy.abs(ev_x-0.5)<eps)
 
+    def test_fftplan(self):
+        import fftplan
+        f = numpy.fft
+        x = numpy.random.rand(6,7,4) + 1j*numpy.random.rand(6,7,4)
+        for axes in (None, (0,), (1,2)):
+            a = range(3) if axes is None else axes
+            norm = numpy.sqrt(numpy.prod([x.shape[i] for i in a]))
+            expected = f.fftshift(f.fftn(f.ifftshift(x, axes=a), axes=a),
+                                  axes=a)/norm
+            plan = fftplan.get_plan(x.shape, axes)
+            self.assert_(fftplan.get_plan(x.shape, axes) is plan)
+            self.assert_(numpy.allclose(plan(x), expected))
+            out = numpy.empty(x.shape, dtype=complex)
+            self.assert_(plan(x, out=out) is out)
+            self.assert_(numpy.allclose(out, expected))
+            sv = statevector.StateVector(x)
+            self.assert_(numpy.allclose(sv.fft(axes), expected))
+            self.assert_(numpy.allclose(sv.fft(axes).ifft(axes), x))
+            self.assert_(sv.fft(axes, inplace=True) is sv)
+            self.assert_(numpy.allclose(sv, expected))
+        self.assertRaises(TypeError, statevector.StateVector((1.,2.)).fft,
+                          inplace=True)
+        for n in range(1, fftplan.maxplans + 3):
+            fftplan.get_plan((n,))
+        self.assertEqual(len(fftplan._plans), fftplan.maxplans)
+        self.assert_((1,) not in [k[0] for k in fftplan._plans])
+        self.assertRaises(ValueError, plan, x[1:])
+
     def test_expvalue(self):
         sv1 = statevector.StateVector((1,1,1), norm=True)
         sv2 = statevector.StateVector((1,2,3,4), norm=True)
@@ -64,6 +95,60 @@ class StateVectorTestCase(unittest.TestCase):
         self.assert_(isinstance(ev, expvalues.ExpectationValueCollection))
         self.assertEqual(ev.shape, (2,))
 
+    def test_apply(self):
+        import scipy.sparse
+        sv = statevector.StateVector(numpy.random.rand(3,4,5)
+                                     + 1j*numpy.random.rand(3,4,5), time=2)
+        a = numpy.random.rand(3,3)
+        b = numpy.random.rand(5,5)
+        expected = numpy.einsum("ij,kl,jml->imk", a, b, sv)
+        for op in (numpy.kron(a, b), scipy.sparse.csr_matrix(numpy.kron(a, b)),
+                   numpy.kron(a, b).reshape(3,5,3,5).transpose(0,2,1,3),
+                   statevector.ProductOperator(a, b)):
+            result = sv.apply(op, (0,2))
+            self.assert_(isinstance(result, statevector.StateVector))
+            self.assertEqual(result.time, 2)
+            self.assert_(numpy.allclose(result, expected))
+        h = numpy.random.rand(4,4)
+        h = h + h.T
+        sv = sv.normalize()
+        full = numpy.kron(numpy.kron(numpy.eye(3), h), numpy.eye(5))
+        psi = numpy.asarray(sv).ravel()
+        ev = numpy.dot(psi.conj(), numpy.dot(full, psi))
+        ev2 = numpy.dot(psi.conj(), numpy.dot(full, numpy.dot(full, psi)))
+        self.assert_(numpy.allclose(sv.expvalue(h, 1), ev))
+        self.assert_(numpy.allclose(sv.variance(h, 1), ev2 - ev**2))
+        svt = statevector.StateVectorTrajectory([sv, sv], time=(0, 1))
+        self.assert_(numpy.allclose(svt.variance(h, 1), ev2 - ev**2))
+        # Stacked operators, with and without a sparse one.
+        ops = [h, 2*h, scipy.sparse.csr_matrix(h)]
+        self.assert_(numpy.allclose(sv.expvalue(ops, 1, multi=True),
+                                    (ev, 2*ev, ev)))
+        self.assert_(numpy.allclose(sv.expvalue(ops[:2], 1, multi=True),
+                                    (ev, 2*ev)))
+        evs = svt.expvalue(ops, 1, multi=True)
+        self.assertEqual(evs.shape, (3, 2))
+        self.assert_(numpy.allclose(evs[1], 2*ev))
+
+    def test_operatorforms(self):
+        import scipy.sparse
+        sv = statevector.StateVector(numpy.random.rand(3,4,5)
+                                     + 1j*numpy.random.rand(3,4,5))
+        a = numpy.random.rand(3,3)
+        b = numpy.random.rand(5,5)
+        op = numpy.kron(a, b)
+        tensor = op.reshape(3,5,3,5).transpose(0,2,1,3)
+        ev = sv.expvalue(tensor, (0,2))
+        self.assert_(numpy.allclose(ev,
+                        (sv.reducesquare(1)*op.reshape(3,5,3,5)).sum()))
+        for form in (op, scipy.sparse.csr_matrix(op),
+                     statevector.ProductOperator(a, b),
+                     statevector.ProductOperator(scipy.sparse.csr_matrix(a),
+                                                 b)):
+            self.assert_(numpy.allclose(sv.expvalue(form, (0,2)), ev))
+        ev = sv.expvalue(statevector.ProductOperator(None, b), (0,2))
+        self.assert_(numpy.allclose(sv.expvalue(b, 2), ev))
+
     def test_diagexpvalue(self):
         sv1 = statevector.StateVector((1,1,1), norm=True)
         sv2 = statevector.StateVector((1,2,3,4), norm=True)
@@ -93,6 +178,92 @@ class StateVectorTestCase(unittest.TestCase):
         self.assertEqual(len(sv_new), 10)
 
 
+class SparseStateVectorTestCase(unittest.TestCase):
+    def test_conversion(self):
+        sv = initialconditions.coherent(2, 200)
+        ssv = sv.sparse()
+        self.assert_(len(ssv.indices) < 100)
+        self.assert_(numpy.abs(ssv.todense() - sv).max() <= 1e-12)
+        self.assert_(abs(ssv.norm() - sv.norm()) < eps)
+        ssv = initialconditions.coherent(2, 200, threshold=1e-12)
+        self.assert_((ssv.indices == sv.sparse().indices).all())
+        fock = initialconditions.fock(50, 3, sparse=True)
+        self.assert_((fock.todense() == initialconditions.fock(50, 3)).all())
+
+    def test_expvalue(self):
+        import scipy.sparse
+        data = numpy.random.rand(6,5,4) + 1j*numpy.random.rand(6,5,4)
+        data[numpy.random.rand(6,5,4) < 0.7] = 0
+        sv = statevector.StateVector(data)
+        ssv = sv.sparse()
+        a = numpy.random.rand(6,6) + 1j*numpy.random.rand(6,6)
+        b = numpy.random.rand(4,4)
+        op = numpy.kron(a, b)
+        tensor = op.reshape(6,4,6,4).transpose(0,2,1,3)
+        ev = sv.expvalue(op, (0,2))
+        for form in (op, tensor, scipy.sparse.csr_matrix(op),
+                     statevector.ProductOperator(a, b),
+                     statevector.ProductOperator(None, b)):
+            self.assert_(numpy.allclose(ssv.expvalue(form, (0,2)),
+                                        sv.expvalue(form, (0,2))))
+        full = numpy.random.rand(120, 120)
+        self.assert_(numpy.allclose(ssv.expvalue(full), sv.expvalue(full)))
+        self.assert_(numpy.allclose(ssv.expvalue((a, 2*a), 0, multi=True),
+                                    sv.expvalue((a, 2*a), 0, multi=True)))
+        d = numpy.random.rand(5)
+        self.assert_(numpy.allclose(ssv.diagexpvalue(d, 1),
+                                    sv.diagexpvalue(d, 1)))
+        d = numpy.random.rand(6,5,4)
+        self.assert_(numpy.allclose(ssv.diagexpvalue((d, d+1), multi=True),
+                                    sv.diagexpvalue((d, d+1), multi=True)))
+
+    def test_outer(self):
+        sv1 = statevector.StateVector((0,1,2,0))
+        sv2 = statevector.StateVector((3,0,4))
+        ssv = sv1.sparse() ^ sv2.sparse()
+        self.assertEqual(ssv.shape, (4,3))
+        self.assertEqual(len(ssv.indices), 4)
+        self.assert_((ssv.todense() == sv1^sv2).all())
+        self.assert_((sv1.sparse().outer(sv2).todense() == sv1^sv2).all())
+
+
+class ProductStateVectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.svs = [statevector.StateVector(numpy.random.rand(*dims)
+                                            + 1j*numpy.random.rand(*dims))
+                    for dims in ((3,), (4,2), (5,))]
+        self.psv = self.svs[0].outer(self.svs[1], lazy=True) ^ self.svs[2]
+        self.sv = self.svs[0] ^ self.svs[1] ^ self.svs[2]
+
+    def test_creation(self):
+        self.assert_(isinstance(self.psv, statevector.ProductStateVector))
+        self.assertEqual(self.psv.dimensions, (3,4,2,5))
+        self.assertEqual(len(self.psv.factors), 3)
+        self.assert_((self.psv.todense() == self.sv).all())
+        self.assert_((numpy.asarray(self.psv) == self.sv).all())
+        self.assert_(numpy.allclose(self.psv.norm(), self.sv.norm()))
+        self.assert_(numpy.allclose(self.psv.normalize().norm(), 1))
+
+    def test_expvalue(self):
+        psv, sv = self.psv, self.sv
+        a = numpy.random.rand(4,4) + 1j*numpy.random.rand(4,4)
+        b = numpy.random.rand(5,5)
+        for op, indices in ((a, 1), (numpy.kron(a, b), (1,3)),
+                            (statevector.ProductOperator(a, None, b),
+                             (1,2,3)),
+                            (numpy.random.rand(8,8), (1,2))):
+            self.assert_(numpy.allclose(psv.expvalue(op, indices),
+                                        sv.expvalue(op, indices)))
+        self.assert_(numpy.allclose(psv.expvalue((a, 2*a), 1, multi=True),
+                                    sv.expvalue((a, 2*a), 1, multi=True)))
+        d = numpy.random.rand(4,5)
+        self.assert_(numpy.allclose(psv.diagexpvalue(d, (1,3)),
+                                    sv.diagexpvalue(d, (1,3))))
+        d = numpy.random.rand(3,4,2,5)
+        self.assert_(numpy.allclose(psv.diagexpvalue((d, d+1), multi=True),
+                                    sv.diagexpvalue((d, d+1), multi=True)))
+
+
 class StateVectorTrajectoryTestCase(unittest.TestCase):
     def sv(self, t, points=16):
         X = numpy.linspace(-numpy.pi, numpy.pi, points)
@@ -103,6 +274,62 @@ class StateVectorTrajectoryTestCase(unittest.TestCase):
         sv = statevector.StateVectorTrajectory(map(self.sv, t))
         self.assertEqual(sv.shape, (20,16))
 
+    def test_statevectors(self):
+        t = numpy.linspace(0,5,20)
+        svs = map(self.sv, t)
+        svs[3].basis = "basis"
+        svt = statevector.StateVectorTrajectory(svs)
+        self.assertEqual(len(svt.statevectors), 20)
+        for sv, sv2 in zip(svt.statevectors, svs):
+            self.assert_(isinstance(sv, statevector.StateVector))
+            self.assert_((sv == sv2).all())
+            self.assertEqual(sv.time, sv2.time)
+            self.assert_(not sv.flags.owndata)
+        self.assertEqual(svt.statevectors[3].basis, "basis")
+        self.assertEqual(svt.statevectors[-1].time, t[-1])
+        self.assertEqual(len(svt.statevectors[2:5]), 3)
+        self.assertRaises(IndexError, lambda: svt.statevectors[20])
+        # The StateVectors are views into the trajectory.
+        svt.statevectors[0][0] = 42
+        self.assertEqual(svt[0,0], 42)
+
+    def test_batched(self):
+        data = numpy.random.rand(5,3,4) + 1j*numpy.random.rand(5,3,4)
+        svt = statevector.StateVectorTrajectory(data, time=numpy.arange(5))
+        svs = list(svt.statevectors)
+        def check(a, b):
+            self.assert_(numpy.allclose(numpy.asarray(a), numpy.asarray(b)))
+        check(svt.norm(), [sv.norm() for sv in svs])
+        check(svt.normalize(), [sv.normalize() for sv in svs])
+        check(svt.reduce(1), [sv.reduce(1) for sv in svs])
+        check(svt.reduce(0, norm=False), [sv.reduce(0, False) for sv in svs])
+        check(svt.reducesquare(1), [sv.reducesquare(1) for sv in svs])
+        check(svt.fft(), [sv.fft() for sv in svs])
+        check(svt.ifft(1), [sv.ifft([1]) for sv in svs])
+        op = numpy.random.rand(3,3,4,4) + 1j
+        check(svt.expvalue(op), [sv.expvalue(op) for sv in svs])
+        op = numpy.random.rand(4,4)
+        check(svt.expvalue((op,2*op), 1, multi=True),
+              numpy.array([sv.expvalue((op,2*op), 1, multi=True)
+                           for sv in svs]).T)
+        op = numpy.random.rand(3,4)
+        check(svt.diagexpvalue(op), [sv.diagexpvalue(op) for sv in svs])
+        op = numpy.random.rand(3)
+        check(svt.diagexpvalue((op,op+1), 0, multi=True),
+              numpy.array([sv.diagexpvalue((op,op+1), 0, multi=True)
+                           for sv in svs]).T)
+        self.assert_((svt.normalize().time == svt.time).all())
+        # Negative indices count subsystems, never the time axis.
+        self.assertEqual(svt.reduce(-1).shape, (5,3))
+        check(svt.reduce(-1), [sv.reduce(-1) for sv in svs])
+        check(svt.reducesquare(-1), [sv.reducesquare(-1) for sv in svs])
+        check(svt.fft(-1), [sv.fft(-1) for sv in svs])
+        op = numpy.random.rand(4,4)
+        check(svt.expvalue(op, -1), [sv.expvalue(op, 1) for sv in svs])
+        op = numpy.random.rand(4)
+        check(svt.diagexpvalue(op, -1), [sv.diagexpvalue(op, 1) for sv in svs])
+        self.assertRaises(IndexError, svt.reduce, 2)
+
     def test_diagexpvalue(self):
         t = numpy.linspace(0,5,20)
         sv = statevector.StateVectorTrajectory(map(self.sv, t))
@@ -120,6 +347,8 @@ def suite():
     load = unittest.defaultTestLoader.loadTestsFromTestCase
     suite = unittest.TestSuite([
             load(StateVectorTestCase),
+            load(SparseStateVectorTestCase),
+            load(ProductStateVectorTestCase),
             load(StateVectorTrajectoryTestCase)
             ])
     return suite
@@ -4,6 +4,7 @@
 import os
 import errno
 import pycppqed as qed
+from pycppqed import compression
 import warnings
 import numpy as np
 import itertools
@@ -51,16 +52,31 @@ def rm_f(path):
 def replace_dirpart(path,newdir):
     return os.path.join(newdir,os.path.basename(path))
      
-def check_if_file_exists(basename,extension):
+def check_if_file_exists(basename,extension=None):
+    """ Look for a file, either uncompressed or compressed.
+
+    :param basename: The name of the uncompressed file.
+    :type basename: str
+    :param extension: The suffix of the compressed file. If `None`, the suffixes of all codecs in
+        :mod:`pycppqed.compression` are tried.
+    :type extension: str
+    :returns: A tuple `(filename,compressed)`, where `filename` is `None` if no file was found.
+    :retval: tuple
+
+    If there are several compressed files (e.g. after the codec was changed), the most recently modified one
+    is returned.
+    """
     if os.path.exists(basename):
         return (basename,False)
-    elif os.path.exists(basename+extension):
-        return (basename+extension,True)
-    else:
+    extensions = compression.suffixes() if extension is None else [extension]
+    found = [basename+ext for ext in extensions if os.path.exists(basename+ext)]
+    if not found:
         return (None,False)
+    return (max(found, key=lambda f: os.stat(f).st_mtime),True)
 
-def generate_filelist(basename,dirname,bz2only=False):
-    """ This function generates a list of files which start with `basename` and either end with a digit (possibly with an `.bz2` extension)
+def generate_filelist(basename,dirname,bz2only=False,compressedonly=False):
+    """ This function generates a list of files which start with `basename` and either end with a digit (possibly with
+    the suffix of a compression codec, e.g. `.bz2`, see :mod:`pycppqed.compression`)
     
     :param basename: The files have to begin with this string.
     :type basename: str
@@ -69,12 +85,15 @@ def generate_filelist(basename,dirname,bz2only=False):
     :returns: A list of matching filenames.
     :param bz2only: Only consider files ending in bz2
     :type bz2only: bool
+    :param compressedonly: Only consider compressed files
+    :type compressedonly: bool
     :retval: list
     """
-    filelist = [ os.path.join(dirname,x) for x in os.listdir(dirname) if x.startswith(basename) and 
-                        ((not x.endswith('.bz2') and x[-1].isdigit()) or (x.endswith('.bz2') and x[-5].isdigit() ))]
+    filelist = [ os.path.join(dirname,x) for x in os.listdir(dirname) if x.startswith(basename) and
+                        compression.strip_suffix(x)[-1].isdigit()]
     assert filelist != []
     if bz2only: filelist = [f for f in filelist if f.endswith('.bz2')]
+    if compressedonly: filelist = [f for f in filelist if compression.codec_for_filename(f)]
     return filelist
 
 
@@ -121,17 +140,19 @@ def string_range_to_string(s,sep=";"):
 def cppqed_t(filename):
     r"""This helper function returns the last timestep t of a C++QED file.
     
+    Only the end of uncompressed files is read, compressed files use the sidecar index written by
+    :meth:`JobArray._compress <teazertools.submitter.JobArray._compress>` (see :func:`pycppqed.io.last_time`).
+    
     :param filename: The name of the file to load.
     :type filename: str
     :returns: The last timestep `T` of the trajectory or `None` if the file could
         not be loaded.
-    :retval: :class:`numpy.float64`
+    :retval: float
     """
     try:
-        evs, svs = qed.load_cppqed(filename)
+        return qed.io.last_time(filename)
     except:
         return None
-    return evs[0,-1]
 
   
 def _int_if_int(i):
@@ -5,9 +5,16 @@ function is :func:`calculateMeans`.
 from __future__ import division
 
 import os
-from pycppqed.io import load_cppqed
+import itertools
+import multiprocessing
+from pycppqed.io import load_cppqed, iter_cppqed
+from pycppqed import compression
 import numpy as np
 import scipy.io
+try:
+    from scipy.linalg.blas import zherk
+except ImportError:
+    zherk = None
 import helpers
 import logging
 
@@ -27,33 +34,365 @@ def _genuine_timesteps(evs):
 def _shift_indices(l, s):
     return [i+s for i in l]
 
-def calculateRho(basename,dirname='.'):
-    """ This function averages the density matrices in a C++QED MCWF trajectory ensemble. Note that the
-    equivalent matlab code is found to be orders of magnitude faster because of multi-threading.
-    
+def _evblocks(evs, maxevs=None, columns=None):
+    """ Iterate over the expectation values of one trajectory in blocks of time steps. `evs` is either
+    an array of expectation values or the name of a C++QED output file, which is then read block by block
+    with :func:`pycppqed.io.iter_cppqed`. Yields tuples `(offset, block)`, where `offset` is the index of the
+    first time step in `block`. If `columns` is given, `block` only contains these rows of the expectation
+    values (in this order), and only these columns are parsed from the files.
+    """
+    if type(evs) is str:
+        logging.debug(evs)
+        offset = 0
+        for block,_ in iter_cppqed(evs, chunk_rows=10000, maxevs=maxevs, columns=columns, statevectors=False):
+            yield offset, block
+            offset += block.shape[1]
+    elif columns is not None:
+        yield 0, np.asarray(evs)[list(columns)]
+    else:
+        yield 0, evs
+
+def _load_statevectors(filename):
+    """ Load the state vectors of a C++QED output file as complex array of shape `(tdim, N)`, where `N` is the
+    dimension of the flattened state vectors. Only the time column of the expectation values is parsed.
+    """
+    _,qs = load_cppqed(filename, columns=(0,))
+    return np.asarray(qs.time), np.asarray(qs, dtype=complex).reshape(qs.shape[0],-1)
+
+def _imap(func, iterable, processes=None):
+    """ Map `func` over `iterable` in a process pool, yielding the results in order as soon as they are
+    available. At most two tasks per process are submitted ahead of the consumer, so results which are not
+    consumed yet don't pile up in memory. Falls back to a plain map for a single process or inside of a
+    daemonic process (e.g. a worker of another pool).
+    """
+    iterable = list(iterable)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(iterable))
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        for result in itertools.imap(func, iterable):
+            yield result
+        return
+    pool = multiprocessing.Pool(processes)
+    window = 2*processes
+    pending = []
+    try:
+        for args in iterable:
+            pending.append(pool.apply_async(func, (args,)))
+            if len(pending) >= window:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+    finally:
+        pool.terminate()
+
+def _rank_update(rho, X):
+    """ Add `X X^H` for all time steps to `rho` in place, where `X` has the shape `(tdim, N, K)`. With BLAS
+    (`zherk`) only the lower triangle of each `rho[t]` is updated, see :func:`_hermitian_fill`.
+    """
+    if zherk is None:
+        rho += np.matmul(X, np.conj(np.swapaxes(X, 1, 2)))
+        return
+    for t in range(X.shape[0]):
+        # rho[t].T is Fortran ordered, and its upper triangle is the lower triangle of rho[t].
+        c = rho[t].T
+        r = zherk(1., np.conj(X[t]), 1., c, lower=0, overwrite_c=1)
+        if not np.may_share_memory(r, c):
+            c[...] = r
+
+def _hermitian_fill(rho):
+    """ Complete each `rho[t]` from its lower triangle after :func:`_rank_update`.
+    """
+    if zherk is None:
+        return
+    upper = np.triu_indices(rho.shape[1], 1)
+    for t in range(rho.shape[0]):
+        m = rho[t]
+        m[upper] = np.conj(m.T[upper])
+
+def calculateRho(basename,dirname='.',rhofile=None,batch=16,processes=None):
+    """ This function averages the density matrices in a C++QED MCWF trajectory ensemble.
+
+    The files are loaded in a process pool. The state vectors of `batch` trajectories are stacked, so that for
+    each time step the accumulated density matrix gets one BLAS rank-k update (`zherk`) instead of forming the
+    outer product of every single state vector.
+
     :param basename: String with the basename of the files to import.
     :type basename: str
     :param dirname: Directory name from which files are imported.
     :type dirname: str
+    :param rhofile: If given, the density matrices are accumulated in a memory mapped file with this name
+        instead of in memory, and the returned `rho` is a :class:`np.memmap`.
+    :type rhofile: str
+    :param batch: Number of trajectories which are added to `rho` at once.
+    :type batch: int
+    :param processes: Number of processes loading the files (Default is the number of CPUs).
+    :type processes: int
     :returns: A tuple `(timevec,rho)`, first entry is the a vector of times at which statevector were printed,
-        the second entry is a :class:`np.ndarray` where each row `i` corresponds to a averaged density matrix at
-        time `timevec[i]`.
-    :retval: tuple 
+        the second entry is a complex :class:`np.ndarray` where each row `i` corresponds to a averaged density
+        matrix at time `timevec[i]`.
+    :retval: tuple
     """
     filelist = helpers.generate_filelist(basename,dirname)
-    (_,qs) = load_cppqed(filelist[0])
-    timevec = qs.time
-    tdim = qs.shape[0]
-    totaldim = np.prod(qs.shape[1:])
-    rho = np.zeros((tdim,totaldim,totaldim))
-    for f in filelist:
-        (_,qs) = load_cppqed(f)
-        qs = qs.reshape(tdim,-1)
-        rho += qs[:,:,np.newaxis]*np.conj(qs[:,np.newaxis,:])
-    return (timevec,rho/len(filelist))
-    
+    rho = None
+    X = None
+    k = 0
+    for f,(timevec,qs) in itertools.izip(filelist, _imap(_load_statevectors, filelist, processes)):
+        if rho is None:
+            tdim,totaldim = qs.shape
+            shape = (tdim,totaldim,totaldim)
+            if rhofile:
+                rho = np.memmap(rhofile, dtype=complex, mode='w+', shape=shape)
+            else:
+                rho = np.zeros(shape, dtype=complex)
+            X = np.empty((tdim,totaldim,min(batch,len(filelist))), dtype=complex)
+            result_time = timevec
+        elif qs.shape != (tdim,totaldim):
+            raise ValueError("%s has state vectors of shape %s, expected %s." % (f,qs.shape,(tdim,totaldim)))
+        X[:,:,k] = qs
+        k += 1
+        if k == X.shape[2]:
+            _rank_update(rho, X)
+            k = 0
+    if k:
+        _rank_update(rho, X[:,:,:k])
+    _hermitian_fill(rho)
+    rho /= len(filelist)
+    if rhofile:
+        rho.flush()
+    return (result_time,rho)
+
+
+class EnsembleAccumulator(object):
+    """ Online statistics of an ensemble of trajectories. For every column and time step the number of
+    trajectories, their mean and the sum of squared deviations from the mean (`M2`) are updated with
+    Welford's algorithm, so no file count is needed in advance and the ensemble variance is computed
+    without cancellation. Accumulators of different parts of the ensemble can be combined with
+    :meth:`merge`.
+
+    The statistics are kept on a canonical time grid. Times of a trajectory which differ from a grid point
+    by at most `timetol` times the output interval are identified with it, other times are added to the
+    grid. The output interval is the median time step of the added trajectory, or of the grid if the
+    trajectory has less than two rows. So trajectories may be truncated, still running or written with
+    slightly different time steps; the number of trajectories is counted for every time step.
+
+    :param ncolumns: Number of columns (quantities) per time step.
+    :type ncolumns: int
+    :param timetol: Maximal difference of times which are identified, relative to the output interval.
+    :type timetol: float
+    :param time: The time grid, to continue a previous accumulation.
+    :param count: Number of trajectories per time step.
+    :param mean: Array of shape `(ncolumns, len(time))` with the means.
+    :param M2: Array of shape `(ncolumns, len(time))` with the sums of squared deviations.
+    """
+    def __init__(self, ncolumns, timetol=0., time=None, count=None, mean=None, M2=None):
+        self.ncolumns = ncolumns
+        self.timetol = timetol
+        self.time = np.zeros(0) if time is None else np.asarray(time, dtype=float)
+        self.count = np.zeros(0, dtype=int) if count is None else np.asarray(count)
+        self.mean = np.zeros((ncolumns,0)) if mean is None else np.asarray(mean, dtype=float)
+        self.M2 = np.zeros((ncolumns,0)) if M2 is None else np.asarray(M2, dtype=float)
+
+    def align(self, time):
+        """ Return the indices of the grid points for the given times, extending the grid by the times
+        which don't match any grid point.
+
+        :param time: Sorted array of times.
+        :returns: Array of indices into :attr:`time`.
+        """
+        time = np.asarray(time, dtype=float)
+        return self._align(time, self.timetol*self._interval(time))
+
+    def _interval(self, time):
+        """ Return the output interval of the given times, or of the grid if there are less than two.
+        """
+        for t in (time, self.time):
+            if len(t) > 1:
+                return np.median(np.diff(t))
+        return 0.
+
+    def _align(self, time, tolerance):
+        grid = self.time
+        if len(grid):
+            index = np.searchsorted(grid, time)
+            left = np.maximum(index-1, 0)
+            right = np.minimum(index, len(grid)-1)
+            index = np.where(np.abs(grid[left]-time) <= np.abs(grid[right]-time), left, right)
+            matched = np.abs(grid[index]-time) <= tolerance
+            if matched.all():
+                return index
+            new = np.unique(time[~matched])
+        else:
+            new = np.unique(time)
+        # New times closer than the tolerance to each other become one grid point.
+        new = new[np.concatenate(([True], np.diff(new) > tolerance))]
+        self._insert(new)
+        return self._align(time, tolerance)
+
+    def _insert(self, new):
+        """ Insert the given times into the grid.
+        """
+        grid = np.concatenate((self.time, new))
+        order = np.argsort(grid, kind='mergesort')
+        old = np.empty(len(grid), dtype=int)
+        old[order] = np.arange(len(grid))
+        old = old[:len(self.time)]
+        count = np.zeros(len(grid), dtype=int)
+        mean = np.zeros((self.ncolumns,len(grid)))
+        M2 = np.zeros((self.ncolumns,len(grid)))
+        count[old] = self.count
+        mean[:,old] = self.mean
+        M2[:,old] = self.M2
+        self.time, self.count, self.mean, self.M2 = grid[order], count, mean, M2
 
-def calculateMeans(basename,evslist=None,expvals=[],variances=[],varmeans=[],stdevs=[],stdevmeans=[], datadir='.', outputdir='.', matlab=True, bz2only=False, maxevs=None):
+    def add(self, block, time):
+        """ Add the values of one trajectory.
+
+        :param block: Array of shape `(ncolumns, n)`.
+        :param time: Sorted array with the `n` times of the columns of `block`. If several times belong to
+            the same grid point, only the last one is used.
+        """
+        self._add(np.asarray(block, dtype=float), self.align(time))
+
+    def _add(self, block, index):
+        """ Add the values of one trajectory at the given sorted grid indices, see :meth:`align`.
+        """
+        last = len(index) - 1 - np.unique(index[::-1], return_index=True)[1]
+        index = index[last]
+        block = block[:,last]
+        count = self.count[index] + 1
+        delta = block - self.mean[:,index]
+        mean = self.mean[:,index] + delta/count
+        self.M2[:,index] += delta*(block - mean)
+        self.mean[:,index] = mean
+        self.count[index] = count
+
+    def merge(self, other):
+        """ Add the statistics of another accumulator (Chan et al.'s parallel algorithm).
+
+        :param other: Accumulator of a disjoint part of the ensemble.
+        :type other: :class:`EnsembleAccumulator`
+        """
+        index = self.align(other.time)
+        # Several time steps of the other grid can match the same grid point. Fancy-index updates would
+        # keep only one of them, so they are merged in rounds with distinct grid points.
+        remaining = np.arange(len(index))
+        while len(remaining):
+            first = np.unique(index[remaining], return_index=True)[1]
+            part = remaining[first]
+            self._merge(index[part], other.count[part], other.mean[:,part], other.M2[:,part])
+            remaining = np.delete(remaining, first)
+
+    def _merge(self, index, nb, meanb, M2b):
+        """ Merge statistics into the given distinct grid points.
+        """
+        na = self.count[index]
+        n = na + nb
+        w = np.where(n > 0, nb/np.maximum(n,1.), 0.)
+        delta = meanb - self.mean[:,index]
+        self.mean[:,index] += delta*w
+        self.M2[:,index] += M2b + delta**2*na*w
+        self.count[index] = n
+
+    def variance(self):
+        """ Return the (population) variance of the ensemble for every column and time step.
+        """
+        return self.M2/np.maximum(self.count,1)
+
+    def save(self, filename, **kwargs):
+        """ Save the state of the accumulator (and any further arrays given as keyword arguments) to a
+        `.npz` file, see :func:`load_accumulator`. The file is written under a temporary name and then
+        renamed, so an interrupted run never leaves a partially written file.
+        """
+        tmpfile = os.path.join(os.path.dirname(filename), '.'+os.path.basename(filename)+'.tmp')
+        f = open(tmpfile, 'wb')
+        try:
+            np.savez(f, time=self.time, timetol=self.timetol, count=self.count, mean=self.mean,
+                     M2=self.M2, **kwargs)
+        finally:
+            f.close()
+        os.rename(tmpfile, filename)
+
+def load_accumulator(filename):
+    """ Load an :class:`EnsembleAccumulator` saved by :meth:`EnsembleAccumulator.save` (e.g. a `.mean.npz`
+    file written by :func:`calculateMeans`).
+
+    :param filename: Name of the `.npz` file.
+    :type filename: str
+    :returns: The accumulator.
+    :rtype: :class:`EnsembleAccumulator`
+    """
+    f = np.load(filename)
+    try:
+        return EnsembleAccumulator(f['mean'].shape[0], float(f['timetol']), f['time'], f['count'],
+                                   f['mean'], f['M2'])
+    finally:
+        f.close()
+
+def _partial_statistics(args):
+    """ Accumulate the statistics of a block of trajectories, in the order of the block. `args` is a tuple
+    `(evslist, maxevs, columns, squared, timetol)`, where `evslist` holds tuples `(evs, after)` of file
+    names or arrays of expectation values and the time after which their rows are used (`None` for all
+    rows). `squared` are the positions in `columns` whose squares are averaged. Returns the
+    :class:`EnsembleAccumulator` and the list of the last times of the trajectories.
+    """
+    evslist, maxevs, columns, squared, timetol = args
+    acc = EnsembleAccumulator(len(columns), timetol)
+    lastts = []
+    for evs, after in evslist:
+        # The chunks are added one by one. The rows at the last grid point of a chunk are carried over to
+        # the next one, because rows of the next chunk may belong to the same grid point.
+        carry = np.zeros((len(columns),0))
+        carrytime = np.zeros(0)
+        for offset, block in _evblocks(evs, maxevs, columns):
+            time = np.asarray(block.time if hasattr(block,'time') else evs[0,offset:offset+block.shape[1]])
+            start = 0 if after is None else np.searchsorted(time, after, 'right')
+            if start == len(time):
+                continue
+            block = np.array(block[:,start:], dtype=float)
+            block[squared] **= 2
+            block = np.concatenate((carry, block), axis=1)
+            time = np.concatenate((carrytime, time[start:]))
+            index = acc.align(time)
+            k = np.searchsorted(index, index[-1])
+            acc._add(block[:,:k], index[:k])
+            carry, carrytime, carryindex = block[:,k:], time[k:], index[k:]
+        if len(carrytime):
+            # The grid didn't change since the carried rows were aligned.
+            acc._add(carry, carryindex)
+            lastts.append(carrytime[-1])
+        else:
+            lastts.append(after)
+    return acc, lastts
+
+def _read_manifest(f):
+    """ Read the manifest of the trajectory files included in a `.mean.npz` file, given as loaded with
+    :func:`np.load`. Returns a dictionary mapping the file names (relative to the data directory, without
+    compression suffix) to tuples `(size, mtime, lastT)`.
+    """
+    return dict((str(name), (int(size), float(mtime), float(lastt))) for name, size, mtime, lastt in
+                zip(f['manifest_name'], f['manifest_size'], f['manifest_mtime'], f['manifest_lastt']))
+
+def _manifest_arrays(manifest):
+    """ Return a manifest as returned by :func:`_read_manifest` as dictionary of arrays to be saved in a
+    `.mean.npz` file.
+    """
+    names = sorted(manifest)
+    return {'manifest_name': np.array(names, dtype=str),
+            'manifest_size': np.array([manifest[n][0] for n in names], dtype=int),
+            'manifest_mtime': np.array([manifest[n][1] for n in names], dtype=float),
+            'manifest_lastt': np.array([manifest[n][2] for n in names], dtype=float)}
+
+def _count_columns(evslist, maxevs):
+    """ Return the number of columns of the first trajectory in `evslist` which has any rows.
+    """
+    for evs in evslist:
+        for _, block in _evblocks(evs, maxevs):
+            if block.shape[1]:
+                return block.shape[0]
+    raise ValueError("None of the %i trajectories has any rows." % len(evslist))
+
+def calculateMeans(basename,evslist=None,expvals=[],variances=[],varmeans=[],stdevs=[],stdevmeans=[], datadir='.', outputdir='.', matlab=True, bz2only=False, maxevs=None, processes=1, blocksize=64, update=False, timetol=1e-3):
     '''
     Calculate the mean expectation values, mean variances and mean standard deviations from an
     ensemble of C++QED MCWF trajectories. The results are saved to a file.
@@ -78,8 +417,34 @@ def calculateMeans(basename,evslist=None,expvals=[],variances=[],varmeans=[],std
     :type outputdir: str
     :param matlab: Also convert results to matlab format and save a .mat file.
     :param maxevs: maximum expectation values to read from each line
+    :param processes: Number of processes which load and sum up the trajectories. `None` means the
+            number of CPUs.
+    :type processes: int
+    :param blocksize: Number of trajectories which are accumulated by one process at a time. The partial
+            statistics of the blocks are merged in a fixed order, so the result only depends on `blocksize`
+            and is the same for any number of processes.
+    :type blocksize: int
+    :param update: If the `.mean.npz` file of a previous run exists in `outputdir`, continue its
+            accumulation with the trajectory files that are new or changed since then.
+    :type update: bool
+    :param timetol: Times of different trajectories which differ by less than this fraction of the output
+            interval are treated as the same time step.
+    :type timetol: float
     :returns: An array containing the averaged expectation values, standard deviations and variances.
     :rtype: :class:`np.ndarray`
+
+    The statistics are accumulated with :class:`EnsembleAccumulator`: the ensemble variance of the means
+    of the single trajectories is added to the mean of their variances (or squared standard deviations),
+    instead of subtracting squared means. The rows of all trajectories are aligned to a common time grid,
+    so trajectories may be truncated or still running; the number of trajectories which contributed to
+    each time step is saved as `count`.
+
+    The state of the accumulator and a manifest of the included files (name, size, modification time
+    and last time step) are saved together in the `.mean.npz` file.
+    Trajectory files are expected to only grow (e.g. a resumed trajectory, or the same trajectory
+    compressed): of a changed file only the rows after its last time step in the manifest are added.
+    If a file of the manifest was removed, or its last time step is earlier than in the manifest, all
+    files are averaged again.
     '''
 
     for l in (expvals,variances,varmeans,stdevs,stdevmeans):
@@ -94,36 +459,101 @@ def calculateMeans(basename,evslist=None,expvals=[],variances=[],varmeans=[],std
         datafile = os.path.join(outputdir,basename+".mean.npz")
         matlabfile = os.path.join(outputdir,basename+".mean.mat")
 
-    # initialize result with the zero and the correct shape, the times in the first row
     if evslist is None:
         filelist = helpers.generate_filelist(basename,datadir,bz2only)
         logging.info("Found %i files."%len(filelist))
-        (evs,_)= load_cppqed(filelist[0],maxevs)
     else:
-        evs = evslist[0]
-    result = np.zeros(evs.shape)
-    result[0,:]=evs[0,:]
+        filelist = evslist
+    ncolumns = _count_columns(filelist, maxevs)
     means = expvals+varmeans+stdevmeans
     
-    iterator = filelist if evslist is None else evslist
-    numtraj = len(filelist) if evslist is None else len(evslist)
-    for evs in iterator:
-        if type(evs) is str:
-            logging.debug(evs)
-            evs,_ = load_cppqed(evs,maxevs)
-        result[means] += evs[means]/numtraj
-        result[variances] += (evs[variances]+evs[varmeans]**2)/numtraj
-        result[stdevs] += (evs[stdevs]**2+evs[stdevmeans]**2)/numtraj
-    result[variances] = result[variances]-result[varmeans]**2
-    result[stdevs] = np.sqrt(result[stdevs]-result[stdevmeans]**2)
+    # Only the columns which are averaged are read from the trajectories.
+    columns = sorted(set(means+variances+stdevs))
+    pos = dict((c,i) for i,c in enumerate(columns))
+    sel = lambda l: [pos[c] for c in l]
+    
+    squared = sel(stdevs)
+    acc = EnsembleAccumulator(len(columns), timetol)
+    manifest = {}
+    if evslist is None:
+        if update and outputdir and os.path.exists(datafile):
+            f = np.load(datafile)
+            try:
+                if 'manifest_name' in f.files and list(f['columns']) == columns and list(f['squared']) == squared:
+                    acc = EnsembleAccumulator(len(columns), timetol, f['time'], f['count'],
+                                              f['mean'], f['M2'])
+                    manifest = _read_manifest(f)
+                else:
+                    logging.warning("%s was calculated for other columns, averaging all files." % datafile)
+            finally:
+                f.close()
+        paths = {}
+        stats = {}
+        for path in filelist:
+            name = compression.strip_suffix(os.path.basename(path))
+            if name not in stats:
+                paths[name] = path
+                stats[name] = os.stat(path)
+        changed = [name for name in sorted(manifest) if name in stats and
+                   manifest[name][:2] != (stats[name].st_size, stats[name].st_mtime)]
+        missing = [name for name in sorted(manifest) if name not in stats]
+        # The contribution of a file can't be removed from the accumulator, so if a file was deleted or
+        # lost time steps everything is averaged again.
+        truncated = []
+        for name in changed:
+            lastt = helpers.cppqed_t(paths[name])
+            if lastt is None or lastt < manifest[name][2]:
+                truncated.append(name)
+        if missing or truncated:
+            logging.warning("Files were removed (%s) or truncated (%s) since the last run, averaging all files."
+                            % (", ".join(missing), ", ".join(truncated)))
+            acc = EnsembleAccumulator(len(columns), timetol)
+            manifest = {}
+        iterator = []
+        names = []
+        for path in filelist:
+            name = compression.strip_suffix(os.path.basename(path))
+            if paths[name] != path:
+                continue
+            old = manifest.get(name)
+            if old is None:
+                iterator.append((path, None))
+            elif old[:2] != (stats[name].st_size, stats[name].st_mtime):
+                iterator.append((path, old[2]))
+            else:
+                continue
+            names.append(name)
+        logging.info("Averaging %i new or changed files." % len(iterator))
+    else:
+        iterator = [(evs, None) for evs in evslist]
+    blocks = [(iterator[i:i+blocksize], maxevs, columns, squared, timetol) for i in range(0, len(iterator), blocksize)]
+    lastts = []
+    for partial, partial_lastts in _imap(_partial_statistics, blocks, processes):
+        acc.merge(partial)
+        lastts.extend(partial_lastts)
+    if evslist is None:
+        for name, lastt in zip(names, lastts):
+            # Files without any rows yet are tried again next time.
+            if lastt is not None:
+                manifest[name] = (stats[name].st_size, stats[name].st_mtime, lastt)
+    mean = acc.mean
+    ensvar = acc.variance()
+    numtraj = acc.count.max()
+    result = np.zeros((ncolumns,len(acc.time)))
+    result[0,:] = acc.time
+    result[means] = mean[sel(means)]
+    result[variances] = mean[sel(variances)]+ensvar[sel(varmeans)]
+    result[stdevs] = np.sqrt(mean[sel(stdevs)]+ensvar[sel(stdevmeans)])
     result = np.transpose(result)
     if outputdir:
         helpers.mkdir_p(outputdir)
-        np.savez(datafile,result=result,expvals=np.array(expvals),variances=np.array(variances),
+        acc.save(datafile,result=result,expvals=np.array(expvals),variances=np.array(variances),
                  varmeans=np.array(varmeans),stdevs=np.array(stdevs),stdevmeans=np.array(stdevmeans),
-                 numtraj=np.array(numtraj))
+                 numtraj=np.array(numtraj),columns=np.array(columns,dtype=int),squared=np.array(squared,dtype=int),
+                 **_manifest_arrays(manifest))
         if matlab:
             scipy.io.savemat(matlabfile,{"result":result,"means":np.array(means)+1,"expvals":np.array(expvals)+1,"variances":np.array(variances)+1,
-                                         "varmeans":np.array(varmeans)+1,"stdevs":np.array(stdevs)+1,"stdevmeans":np.array(stdevmeans)+1,"numtraj":numtraj})
+                                         "varmeans":np.array(varmeans)+1,"stdevs":np.array(stdevs)+1,"stdevmeans":np.array(stdevmeans)+1,"numtraj":numtraj,
+                                         "count":acc.count})
     return result
 
@@ -15,6 +15,7 @@ import subprocess
 import sys
 import base64
 import pycppqed as qed
+from pycppqed import compression
 import numpy as np
 import ast
 
@@ -59,6 +60,8 @@ class JobArray(object):
     :param average: If `True`, submit a job which calculates ensemble averages.
     :param usetemp: Write data to temporary directory first (default True).
     :param compress: Compress files (default True)
+    :param compression: The codec used to compress files, one of the codecs in :mod:`pycppqed.compression`
+        ('bz2', 'gz', 'xz', 'zstd' or 'lz4'). Codecs which are not installed fall back to 'bz2'. (default 'bz2')
     :param resume: Resume trajectories (default False)
     :param testrun_t: Final time to integrate in testruns (default 1)
     :param testrn_dt: -Dt for testruns (default None)
@@ -66,7 +69,7 @@ class JobArray(object):
     """
     def __init__(self,script,basename=None, parSet=dict(), varPars=None, parameters={},basedir='.',tempdir='/tmp',seeds=[1001], config={}):
         self.C = dict(averageids={},qsub={}, qsub_traj={}, qsub_average={}, qsub_test={}, diagnostics=True,
-                      matlab=True, average=True, compress=True, resume=False, testrun_t=1, testrun_dt = None,
+                      matlab=True, average=True, compress=True, compression='bz2', resume=False, testrun_t=1, testrun_dt = None,
                       usetemp=True, cluster=1)
         self.C.update(config)
         self.parSet = parSet
@@ -87,8 +90,10 @@ class JobArray(object):
             self.basename = basename
         self.targetoutputbase=os.path.join(self.datadir,self.basename+'.out')
         self.seeds = seeds
-        self.compsuffix='.bz2'
+        self.codec = compression.get_codec(self.C['compression'])
+        self.compsuffix=self.codec.suffix
         self.datafiles = []
+        self.stalefiles = []
         self.default_sub_pars = ['-b','y', '-v','PYTHONPATH','-v','PATH', '-m','n','-j','yes']
         self.loglevel = logging.getLogger().getEffectiveLevel()
         self.outputdir_is_temp = False
@@ -157,17 +162,30 @@ class JobArray(object):
         scipy.io.savemat(self.parameterfilebase+".mat", numeric)
     
     def _compress(self):
-        def _bzip2(f):
-            os.system('bzip2 -f %s'%f)
-        _bzip2(self.output)
-        self.output = self.output + self.compsuffix
+        logging.debug("Compressing with codec %s."%self.codec.name)
+        # Remember the last time step, so that resuming doesn't have to decompress the file.
+        lastT = qed.io.last_time(self.output)
+        self.output = self.codec.compress_file(self.output)
+        qed.io.save_index(self.output, last_time=np.nan if lastT is None else lastT)
+        if os.path.exists(qed.io.index_path(self.output)):
+            self.datafiles.append(qed.io.index_path(self.output))
         if not self.C['binary']:
-            _bzip2(self.sv)
-            self.sv = self.sv + self.compsuffix
+            self.sv = self.codec.compress_file(self.sv)
     
+    def _remove_stale(self):
+        """Remove the compressed files of resumed trajectories which were not overwritten by the new data files,
+        e.g. because the compression codec changed. Otherwise both would be found as trajectories.
+        """
+        kept = set(helpers.replace_dirpart(f, self.datadir) for f in self.datafiles)
+        for f in self.stalefiles:
+            if f not in kept:
+                logging.info("Deleting stale file %s."%f)
+                helpers.rm_f(f)
+        self.stalefiles = []
+
     def _move_data(self):
         for f in self.datafiles:
-            shutil.copy(f, self.datadir)
+            shutil.copy2(f, self.datadir)
             os.remove(f)
     
     def _cleanup(self):
@@ -199,8 +217,8 @@ class JobArray(object):
     
     def _find_target_files(self,seed=None,**kwargs):
         seed = str(seed)
-        (targetoutput, output_compressed) = helpers.check_if_file_exists(self._targetoutput(seed),'.bz2')
-        (targetsv, sv_compressed) = helpers.check_if_file_exists(self._targetsv(seed),'.bz2')
+        (targetoutput, output_compressed) = helpers.check_if_file_exists(self._targetoutput(seed))
+        (targetsv, sv_compressed) = helpers.check_if_file_exists(self._targetsv(seed))
         return (targetoutput,output_compressed,targetsv,sv_compressed)
     
     
@@ -263,6 +281,9 @@ class JobArray(object):
         if self.parameters.has_key('T') and np.less_equal(float(self.parameters['T']),float(lastT)):
             logging.info("Don't need to calculate anything, T=%f."%float(self.parameters['T']))
             return False
+        for (target,compressed) in ((targetoutput,output_compressed),(targetsv,sv_compressed)):
+            if compressed:
+                self.stalefiles.extend((target,qed.io.index_path(target)))
         if self.C['usetemp']:
             logging.info('Moving %s to %s.'%(targetoutput,self.outputdir))
             shutil.copy(targetoutput, self.outputdir)
@@ -272,10 +293,10 @@ class JobArray(object):
             targetsv = helpers.replace_dirpart(targetsv, self.outputdir)
         if output_compressed:
             logging.info('Uncompressing %s'%targetoutput)
-            os.system('bunzip2 -k %s'%targetoutput)
+            compression.codec_for_filename(targetoutput).decompress_file(targetoutput)
         if sv_compressed:
             logging.info('Uncompressing %s'%targetsv)
-            os.system('bunzip2 -k %s'%self.sv+self.compsuffix)
+            compression.codec_for_filename(targetsv).decompress_file(targetsv)
         return True
     
     def run(self, start=0, dryrun=False):
@@ -310,6 +331,7 @@ class JobArray(object):
                 self.datafiles.extend((self.output,self.sv))
             if self.C['usetemp']:
                 self._move_data()
+            self._remove_stale()
         finally:
             self._cleanup()
             
@@ -448,7 +470,7 @@ class JobArray(object):
         command.extend(self._dict_to_commandline('-', self.C['qsub_average']))
         if testrun:
             command.extend(self._dict_to_commandline('-', self.C['qsub_test']))
-        command.append('calculate_mean')
+        command.extend(('calculate_mean','--update'))
         command.extend(self._dict_to_commandline('--', self.C['averageids']))
         command.extend(('--datadir',self.datadir))
         command.extend(('--outputdir',self.averagedir))
@@ -495,6 +517,7 @@ class GenericSubmitter(OptionParser, ConfigParser.SafeConfigParser):
 
         self.JobArrayParams['testrun_t'] = self.getfloat('Config', 'testrun_t')
         self.JobArrayParams['compress'] = self.getboolean('Config', 'compress')
+        self.JobArrayParams['compression'] = self.get('Config', 'compression')
         self.JobArrayParams['resume'] = self.getboolean('Config','resume')
         self.JobArrayParams['require_resume'] = self.getboolean('Config','require_resume')
         if ConfigParser.SafeConfigParser.has_option(self,'Config','continue_from'):
@@ -6,10 +6,29 @@ from mock import *
 import subprocess
 import cPickle as pickle
 import pycppqed as qed
+import helpers
+from pycppqed import compression
+import os
+import shutil
+import tempfile
 
 
 class TestMean(unittest.TestCase):
 
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="teazertools_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def means(self, **kwargs):
+        """ Average the test2 trajectories in the temporary directory. The index lists are created for every
+        call, because calculateMeans shifts them in place.
+        """
+        args = dict(expvals=[3,5], variances=[4], stdevs=[6], datadir=self.tempdir, outputdir=self.tempdir, matlab=False)
+        args.update(kwargs)
+        return mean.calculateMeans("test2", **args)
+
     def test01_calculateMeans1(self):
         result = mean.calculateMeans("test1", expvals=[], variances=[4], stdevs=[6], datadir='test/',outputdir=None)
         self.assertTrue(np.allclose(result,np.load('test/test1expected.npy')))
@@ -18,6 +37,224 @@ class TestMean(unittest.TestCase):
         result = mean.calculateMeans("test2", expvals=[3,5], variances=[4], stdevs=[6], datadir='test/',outputdir=None)
         self.assertTrue(np.allclose(result,np.load('test/test2expected.npy')))
 
+    def test03_calculateRho(self):
+        from pycppqed import io
+        svs = np.random.rand(5,4,3,2) + 1j*np.random.rand(5,4,3,2)
+        for i in range(5):
+            f = open(os.path.join(self.tempdir,'rho.out.%i'%(i+1)),'w')
+            f.write("# Trajectory %i\n\n"%i)
+            for t in range(4):
+                f.write("%r 0.01 1.0\n"%(0.5*t))
+                io._write_blitz(f, svs[i,t])
+            f.close()
+        qs = svs.reshape(5,4,6)
+        expected = (qs[:,:,:,np.newaxis]*np.conj(qs[:,:,np.newaxis,:])).mean(axis=0)
+        for kwargs in ({}, {'batch':2,'processes':2}, {'rhofile':os.path.join(self.tempdir,'rho.dat')}):
+            timevec, rho = mean.calculateRho('rho.out', self.tempdir, **kwargs)
+            self.assertTrue(np.allclose(timevec, [0,0.5,1,1.5]))
+            self.assertEqual(rho.dtype, complex)
+            self.assertTrue(np.allclose(rho, expected))
+            del rho
+
+    def test04_calculateMeansParallel(self):
+        serial = self.means(datadir='test/', outputdir=None)
+        for blocksize in (1,2):
+            result = self.means(datadir='test/', outputdir=None, processes=2, blocksize=blocksize)
+            self.assertTrue(np.allclose(result,serial))
+            self.assertTrue((result==self.means(datadir='test/', outputdir=None, processes=1, blocksize=blocksize)).all())
+        self.assertEqual(list(mean._imap(abs, range(-20,0), 2)), range(20,0,-1))
+
+    def test05_accumulator(self):
+        x = 1e6 + np.random.rand(10,2,5)
+        t = np.arange(5.)
+        acc = mean.EnsembleAccumulator(2)
+        for i in (0,4,7):
+            partial = mean.EnsembleAccumulator(2)
+            for traj in x[i:{0:4,4:7,7:10}[i]]:
+                partial.add(traj, t)
+            acc.merge(partial)
+        self.assertTrue((acc.count == 10).all())
+        self.assertTrue(np.allclose(acc.mean, x.mean(axis=0)))
+        self.assertTrue(np.allclose(acc.variance(), x.var(axis=0)))
+        ragged = mean.EnsembleAccumulator(2, timetol=1e-3)
+        ragged.add(x[0,:,:2], t[:2])
+        # Fuzzy times, the last two rows belong to the same time step.
+        ragged.add(x[1], [0,0.9995,2.0001,2.9995,3])
+        ragged.add(x[2,:,1:3], [0.5,1])
+        self.assertTrue(np.allclose(ragged.time, [0,0.5,1,2,3], atol=1e-3))
+        self.assertEqual(list(ragged.count), [2,1,3,1,1])
+        self.assertTrue(np.allclose(ragged.mean[:,3], x[1,:,2]))
+        self.assertTrue(np.allclose(ragged.mean[:,4], x[1,:,4]))
+        self.assertTrue(np.allclose(ragged.mean[:,2], (x[0,:,1]+x[1,:,1]+x[2,:,2])/3))
+        # Two time steps of the merged accumulator match the same grid point.
+        fine = mean.EnsembleAccumulator(2)
+        fine.add(x[3,:,:4], [0,0.9995,1.0004,2])
+        coarse = mean.EnsembleAccumulator(2, timetol=1e-3)
+        coarse.add(x[4,:,:3], t[:3])
+        coarse.merge(fine)
+        self.assertEqual(list(coarse.count), [2,3,2])
+        self.assertTrue(np.allclose(coarse.mean[:,1], (x[4,:,1]+x[3,:,1]+x[3,:,2])/3))
+        self.assertTrue(np.allclose(coarse.variance()[:,1], np.var([x[4,:,1],x[3,:,1],x[3,:,2]], axis=0)))
+        # Trajectories are added chunk by chunk, rows of one grid point can be in different chunks.
+        evs = np.array([[0,1,1.0001,2,3,4], x[5,0,[0,1,2,3,4,0]]])
+        def chunked(evs, maxevs=None, columns=None):
+            evs = np.asarray(evs)[list(columns)]
+            for offset in range(0, evs.shape[1], 2):
+                yield offset, evs[:,offset:offset+2]
+        with patch.object(mean, '_evblocks', chunked):
+            acc, lastts = mean._partial_statistics(([(evs, None), (evs, 0.5)], None, [0,1], [], 1e-3))
+        whole = mean.EnsembleAccumulator(2, 1e-3)
+        whole.add(evs, evs[0])
+        whole.add(evs[:,1:], evs[0,1:])
+        self.assertEqual(lastts, [4,4])
+        self.assertEqual(list(acc.count), list(whole.count))
+        self.assertTrue(np.allclose(acc.mean, whole.mean))
+        self.assertTrue(np.allclose(acc.M2, whole.M2))
+
+    def test06_calculateMeansUpdate(self):
+        for i in (1,2):
+            shutil.copy('test/test2.out.%i'%i, self.tempdir)
+        self.means()
+        shutil.copy('test/test2.out.3', self.tempdir)
+        result = self.means(update=True)
+        expected = self.means(datadir='test/', outputdir=None)
+        self.assertTrue(np.allclose(result, expected))
+        f = np.load(os.path.join(self.tempdir,"test2.mean.npz"))
+        self.assertEqual(int(f['numtraj']), 3)
+        acc = mean.load_accumulator(os.path.join(self.tempdir,"test2.mean.npz"))
+        self.assertTrue((acc.count == 3).all())
+        manifest = mean._read_manifest(f)
+        self.assertEqual(sorted(manifest), ['test2.out.1','test2.out.2','test2.out.3'])
+        self.assertEqual(manifest['test2.out.3'][2], expected[-1,0])
+        f.close()
+        self.assertEqual([n for n in os.listdir(self.tempdir) if n.startswith('.')], [])
+        # Compressed files are recognized.
+        compression.codecs['gz'].compress_file(os.path.join(self.tempdir,'test2.out.2'))
+        result = self.means(update=True)
+        self.assertTrue(np.allclose(result, expected))
+        # Removed or truncated files are not averaged any more.
+        os.remove(os.path.join(self.tempdir,'test2.out.1'))
+        result = self.means(update=True)
+        self.assertTrue(np.allclose(result, self.means(outputdir=None)))
+        self.assertEqual(int(np.load(os.path.join(self.tempdir,"test2.mean.npz"))['numtraj']), 2)
+        path = os.path.join(self.tempdir,'test2.out.3')
+        lines = open(path).readlines()
+        f = open(path,'w')
+        f.writelines(lines[:-3])
+        f.close()
+        os.utime(path, (0, os.stat(path).st_mtime+10))
+        result = self.means(update=True)
+        self.assertTrue(np.allclose(result, self.means(outputdir=None)))
+
+    def test07_calculateMeansGrowing(self):
+        lines = {}
+        for i in (1,2,3):
+            f = open('test/test2.out.%i'%i)
+            lines[i] = f.readlines()
+            f.close()
+            shutil.copy('test/test2.out.%i'%i, self.tempdir)
+        # The third trajectory is still running.
+        path = os.path.join(self.tempdir,'test2.out.3')
+        f = open(path,'w')
+        f.writelines(lines[3][:-3])
+        f.close()
+        self.means()
+        f = open(path,'a')
+        f.writelines(lines[3][-3:])
+        f.close()
+        os.utime(path, (0, os.stat(path).st_mtime+10))
+        result = self.means(update=True)
+        expected = self.means(datadir='test/', outputdir=None)
+        self.assertTrue(np.allclose(result, expected))
+
+    def test08_calculateMeansRagged(self):
+        evs = [qed.load_cppqed('test/test2.out.%i'%i)[0] for i in (1,2,3)]
+        lines = open('test/test2.out.2').readlines()
+        # A truncated trajectory and one with fuzzy times.
+        f = open(os.path.join(self.tempdir,'test2.out.2'),'w')
+        f.writelines(lines[:-3])
+        f.close()
+        f = open(os.path.join(self.tempdir,'test2.out.3'),'w')
+        for line in open('test/test2.out.3'):
+            if line.strip() and not line.startswith('#'):
+                t, rest = line.split(None,1)
+                line = "%r %s" % (float(t)-2e-4*(float(t)>5), rest)
+            f.write(line)
+        f.close()
+        shutil.copy('test/test2.out.1', self.tempdir)
+        result = self.means(variances=[], stdevs=[])
+        self.assertTrue(np.allclose(result[:,0], evs[0][0], atol=1e-3))
+        f = np.load(os.path.join(self.tempdir,'test2.mean.npz'))
+        self.assertEqual(list(f['count']), [3]*9+[2]*2)
+        expected = np.array([np.mean([e[2,i] for e in evs[:1+(i<9)*1]+evs[2:]]) for i in range(11)])
+        self.assertTrue(np.allclose(result[:,2], expected))
+
+    def test09_calculateMeansFirstFile(self):
+        lines = open('test/test2.out.1').readlines()
+        header = [line for line in lines if line.startswith('#') or not line.strip()]
+        rows = [line for line in lines if line not in header]
+        # The first listed files have no rows or a single one.
+        f = open(os.path.join(self.tempdir,'test2.out.4'),'w')
+        f.writelines(header)
+        f.close()
+        f = open(os.path.join(self.tempdir,'test2.out.5'),'w')
+        f.writelines(header+rows[:1])
+        f.close()
+        shutil.copy('test/test2.out.1', self.tempdir)
+        f = open(os.path.join(self.tempdir,'test2.out.3'),'w')
+        for line in open('test/test2.out.3'):
+            if line.strip() and not line.startswith('#'):
+                t, rest = line.split(None,1)
+                line = "%r %s" % (float(t)-2e-4*(float(t)>5), rest)
+            f.write(line)
+        f.close()
+        filelist = [os.path.join(self.tempdir,'test2.out.%i'%i) for i in (4,5,1,3)]
+        with patch.object(helpers, 'generate_filelist', return_value=filelist):
+            result = self.means(variances=[], stdevs=[])
+            self.assertEqual(len(result), 11)
+            f = np.load(os.path.join(self.tempdir,'test2.mean.npz'))
+            self.assertEqual(list(f['count']), [3]+[2]*10)
+            self.assertEqual(float(f['timetol']), 1e-3)
+            f.close()
+            os.utime(filelist[1], (0, os.stat(filelist[1]).st_mtime+10))
+            self.assertEqual(len(self.means(update=True, variances=[], stdevs=[])), 11)
+        self.assertRaises(ValueError, mean.calculateMeans, "test2", evslist=[np.zeros((7,0))], outputdir=None)
+
+class TestHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="teazertools_test_")
+        for name in ('a.out.1', 'a.out.2.bz2', 'a.out.3.gz', 'a.out.3.mat', 'a.out.1.index.npz'):
+            open(os.path.join(self.dir,name),'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test01_generate_filelist(self):
+        names = lambda l: sorted(map(os.path.basename,l))
+        self.assertEqual(names(helpers.generate_filelist('a.out',self.dir)), ['a.out.1','a.out.2.bz2','a.out.3.gz'])
+        self.assertEqual(names(helpers.generate_filelist('a.out',self.dir,bz2only=True)), ['a.out.2.bz2'])
+        self.assertEqual(names(helpers.generate_filelist('a.out',self.dir,compressedonly=True)), ['a.out.2.bz2','a.out.3.gz'])
+
+    def test02_check_if_file_exists(self):
+        base = os.path.join(self.dir,'a.out.')
+        self.assertEqual(helpers.check_if_file_exists(base+'1'), (base+'1',False))
+        self.assertEqual(helpers.check_if_file_exists(base+'2'), (base+'2.bz2',True))
+        self.assertEqual(helpers.check_if_file_exists(base+'3'), (base+'3.gz',True))
+        self.assertEqual(helpers.check_if_file_exists(base+'3','.bz2'), (None,False))
+        self.assertEqual(helpers.check_if_file_exists(base+'4'), (None,False))
+        # After a change of the codec the newest file is used.
+        for ext, mtime in (('.gz',2000), ('.bz2',1000)):
+            open(base+'4'+ext,'w').close()
+            os.utime(base+'4'+ext, (mtime,mtime))
+        self.assertEqual(helpers.check_if_file_exists(base+'4'), (base+'4.gz',True))
+
+    def test03_cppqed_t(self):
+        evs, svs = qed.load_cppqed('test/test1.out.1')
+        self.assertEqual(helpers.cppqed_t('test/test1.out.1'), evs[0,-1])
+        self.assertEqual(helpers.cppqed_t(os.path.join(self.dir,'a.out.1')), None)
+        self.assertEqual(helpers.cppqed_t(os.path.join(self.dir,'a.out.5')), None)
+
 class TestSubmitter(unittest.TestCase):
     
     def setUp(self):
@@ -32,7 +269,7 @@ class TestSubmitter(unittest.TestCase):
                                             '-N', 'Job1particle1mode', '-t', '1-10', '-b', 'y', '-v', 'PYTHONPATH', '-v', 'PATH', 
                                             '-m', 'n', '-j', 'yes', 'cppqedjob'],)
             self.expected_args_averaging.append(['qsub', '-terse','-o', 'test/output/%02d/log/1particle1mode_mean.log'%(i+1), '-hold_jid', '574599', '-b', 'y', '-v', 'PYTHONPATH', 
-                                           '-v', 'PATH', '-m', 'n', '-j', 'yes', 'calculate_mean', '--variances', '4,8', '--expvals', '5,6', 
+                                           '-v', 'PATH', '-m', 'n', '-j', 'yes', 'calculate_mean', '--update', '--variances', '4,8', '--expvals', '5,6', 
                                            '--stdevs', '10', '--datadir', 'test/output/%02d/traj'%(i+1), '--outputdir', 'test/output/%02d/mean'%(i+1), 
                                            '1particle1mode'],)
         self.p = self.popen_patch.start()